@@ -0,0 +1,142 @@
+import json
+import time
+import timeit
+import argparse
+import platform
+
+from network.framing import (PROTOCOL_V1, PROTOCOL_V2, PROTOHEADER_LENGTH, FrameDecoder, json_encode, json_decode,
+                             create_message, encode_v2_content, create_message_v2, encode_frame, decode_frame,
+                             process_v2_header, check_json_header, decode_content, compress_content,
+                             decompress_content, COMPRESSION_THRESHOLD)
+from benchmarks.fanout import git_revision
+
+
+"""
+Micro-benchmarks for each stage of encoding and decoding frames, in both framing versions, over a few realistic
+payloads: a short chat line, a line of mostly non-ASCII text, a room message, and binary bodies of 64 KiB and 1 MiB.
+Version 2 payloads over the compression threshold are also timed compressed.
+
+    python -m benchmarks.codec
+    python -m benchmarks.codec --filter decode --output codec_results.jsonl
+
+Times are the best of --repeat runs, in microseconds per call.
+"""
+
+
+def chat_response(text, room=None):
+    content = {"result": text}
+    if room is not None:
+        content["room"] = room
+    return dict(type="text/json", encoding="utf-8", content=content)
+
+
+PAYLOADS = {
+    'tiny': chat_response('<font color=#8CD8CB><b>&lt;dan&gt;</b> hi</font>'),
+    'unicode': chat_response('<font color=#8CD8CB><b>&lt;ざわ&gt;</b> ' + 'こんにちは世界 😀 Ωμέγα ' * 8 +
+                             '</font>'),
+    'room': chat_response('<font color=#8CD8CB><b>&lt;dan&gt;</b> standup in 5</font>', room='dev'),
+    'request': dict(type="text/json", encoding="utf-8", content={"action": "send_message", "value": "hello there"}),
+    'binary_64k': dict(type="binary/custom-client-binary-type", encoding="binary", content=bytes(range(256)) * 256),
+    'binary_1m': dict(type="binary/custom-client-binary-type", encoding="binary", content=bytes(range(256)) * 4096),
+}
+
+
+def v1_stages(message):
+    content_bytes = (json_encode(message["content"], "utf-8") if message["type"] == "text/json"
+                     else message["content"])
+    frame = encode_frame(message, PROTOCOL_V1)
+    jsonheader_len = int.from_bytes(frame[:PROTOHEADER_LENGTH], "big")
+    jsonheader_bytes = frame[PROTOHEADER_LENGTH:PROTOHEADER_LENGTH + jsonheader_len]
+    jsonheader = json_decode(jsonheader_bytes, "utf-8")
+    content_view = memoryview(frame)[PROTOHEADER_LENGTH + jsonheader_len:]
+    stages = {
+        'create_message': lambda: create_message(content_bytes=content_bytes, content_type=message["type"],
+                                                 content_encoding=message["encoding"]),
+        'decode_json_header': lambda: check_json_header(json_decode(jsonheader_bytes, "utf-8")),
+        'decode_content': lambda: decode_content(jsonheader, content_view),
+    }
+    if message["type"] == "text/json":
+        stages['json_encode'] = lambda: json_encode(message["content"], "utf-8")
+        stages['json_decode'] = lambda: json_decode(content_bytes, "utf-8")
+    return frame, stages
+
+
+def v2_stages(message):
+    type_code, content_bytes = encode_v2_content(message["type"], message["content"])
+    frame = encode_frame(message, PROTOCOL_V2)
+    jsonheader = process_v2_header(frame)
+    content_view = memoryview(frame)[len(frame) - len(content_bytes):]
+    stages = {
+        'encode_content': lambda: encode_v2_content(message["type"], message["content"]),
+        'create_message': lambda: create_message_v2(content_bytes, type_code),
+        'decode_header': lambda: process_v2_header(frame),
+        'decode_content': lambda: decode_content(jsonheader, content_view),
+    }
+    if len(content_bytes) >= COMPRESSION_THRESHOLD:
+        compressed_bytes = compress_content(content_bytes)
+        compressed_frame = encode_frame(message, PROTOCOL_V2, COMPRESSION_THRESHOLD)
+        stages['compress_content'] = lambda: compress_content(content_bytes)
+        stages['decompress_content'] = lambda: decompress_content(compressed_bytes)
+        stages['encode_frame_compressed'] = lambda: encode_frame(message, PROTOCOL_V2, COMPRESSION_THRESHOLD)
+        stages['decode_frame_compressed'] = lambda: decode_frame(compressed_frame)
+    return frame, stages
+
+
+def stream_decode(frame, frames_per_chunk=32):
+    # what a connection does with a read holding several frames, as bursts arrive
+    chunk = frame * frames_per_chunk
+    decoder = FrameDecoder()
+
+    def decode_chunk():
+        decoder.feed(chunk)
+        decoder.frames()
+    return decode_chunk
+
+
+def benchmarks():
+    for payload_name, message in PAYLOADS.items():
+        for protocol, stages_for in ((PROTOCOL_V1, v1_stages), (PROTOCOL_V2, v2_stages)):
+            frame, stages = stages_for(message)
+            prefix = f'v{protocol}/{payload_name}/'
+            for stage_name, stage in stages.items():
+                yield prefix + stage_name, stage
+            yield prefix + 'encode_frame', lambda message=message, protocol=protocol: encode_frame(message, protocol)
+            yield prefix + 'decode_frame', lambda frame=frame: decode_frame(frame)
+            if len(frame) < 64 * 1024:
+                yield prefix + 'stream_decode_32_frames', stream_decode(frame)
+
+
+def time_call(function, repeat, min_time):
+    # picks a number of calls that takes at least min_time, then returns the best time per call of repeat runs
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Time each stage of the frame codecs.')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark, the best is reported')
+    parser.add_argument('--min-time', type=float, default=0.05, help='minimum seconds for each run')
+    parser.add_argument('--output', default=None, help='file to append the results to as a line of JSON')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    results = {}
+    for name, function in benchmarks():
+        if options.filter in name:
+            results[name] = time_call(function, options.repeat, options.min_time) * 1e6
+            print(f'{name:48} {results[name]:12.3f} us')
+    if options.output is not None:
+        with open(options.output, 'a') as output:
+            output.write(json.dumps({'timestamp': time.time(), 'git_revision': git_revision(),
+                                     'python': platform.python_version(), 'platform': platform.platform(),
+                                     'microseconds_per_call': results}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import os
+import re
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import selectors
+import subprocess
+
+from network.bot_client import BotClient, poll_bots
+
+
+"""
+Fan-out benchmark. Starts a local chat server, unless pointed at one with --connect, connects a crowd of headless bots
+and has them send chat messages at a steady total rate. Every message carries the time it was sent, so each bot
+measures how long the server took to get it back to them.
+
+Reports the rates messages were sent and delivered at, the bytes per second the bots sent and received, and
+percentiles of the end-to-end latency. Each run is appended as one line of JSON to the --output file so results can
+be compared over time.
+
+    python -m benchmarks.fanout --bots 100 --rate 500 --duration 10 -- --engine asyncio
+
+Arguments after -- are passed on to chat_server.py. The server started here has no rate limits, as each bot sends
+far faster than a person would.
+"""
+
+BENCH_MESSAGE = re.compile(r"bench (\d+) (\d+) (\d+)")
+CHAT_SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'chat_server.py')
+
+
+class FanoutStats:
+    def __init__(self):
+        self.first_sequence = None
+        self.latencies_ns = []
+        self.last_received_time = None
+
+    def on_line(self, bot, room, line, received_time):
+        match = BENCH_MESSAGE.search(line)
+        # join announcements and anything sent during the warm up are not measured
+        if match is not None and self.first_sequence is not None and int(match.group(2)) >= self.first_sequence:
+            self.latencies_ns.append(received_time - int(match.group(3)))
+            self.last_received_time = received_time
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Measure chat server throughput and fan-out latency.')
+    parser.add_argument('--bots', type=int, default=50, help='number of connected bots')
+    parser.add_argument('--rate', type=float, default=200.0, help='chat messages sent per second, across all bots')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to measure for')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds of sending before measuring starts')
+    parser.add_argument('--drain', type=float, default=5.0,
+                        help='seconds to wait for messages still in flight when sending stops')
+    parser.add_argument('--message-bytes', type=int, default=64, help='size of each chat message')
+    parser.add_argument('--port', type=int, default=25590, help='port for the benchmark server')
+    parser.add_argument('--connect', default=None, metavar='HOST',
+                        help='benchmark a server that is already running on HOST:--port instead of starting one')
+    parser.add_argument('--output', default='fanout_results.jsonl', help='file to append the results to')
+    parser.add_argument('server_args', nargs='*', help='extra arguments for chat_server.py, after --')
+    return parser.parse_args(args)
+
+
+def start_server(port, server_args):
+    server = subprocess.Popen([sys.executable, CHAT_SERVER_SCRIPT, '--host', '127.0.0.1', '--port', str(port),
+                               '--no-rate-limits'] + server_args, stdout=subprocess.DEVNULL)
+    wait_for_port('127.0.0.1', port, server)
+    return server
+
+
+def wait_for_port(host, port, server=None, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f'The benchmark server exited with code {server.returncode}.')
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'Nothing is listening on {(host, port)}.')
+
+
+def pump(selector, seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        poll_bots(selector, timeout=0.01)
+
+
+def connect_bots(selector, host, port, num_bots, stats):
+    bots = []
+    for index in range(num_bots):
+        bots.append(BotClient(selector, host, port, name=f'bot{index}', on_line=stats.on_line))
+        if index % 50 == 49:
+            # let the server accept this batch before the listen backlog fills up
+            pump(selector, 0.05)
+    for bot in bots:
+        bot.first_entry()
+    # the join announcements fan out to every bot, wait for them to settle
+    pump(selector, 1.0 + num_bots / 500)
+    return bots
+
+
+def run_benchmark(options):
+    host = options.connect if options.connect is not None else '127.0.0.1'
+    server = None if options.connect is not None else start_server(options.port, options.server_args)
+    selector = selectors.DefaultSelector()
+    stats = FanoutStats()
+    try:
+        bots = connect_bots(selector, host, options.port, options.bots, stats)
+        padding = 'x' * max(0, options.message_bytes - len('bench 0 0 0000000000000000000 '))
+        interval_ns = int(1e9 / options.rate)
+        start_ns = time.perf_counter_ns()
+        measure_start_ns = start_ns + int(options.warmup * 1e9)
+        stop_ns = measure_start_ns + int(options.duration * 1e9)
+        bytes_sent_at_start = bytes_received_at_start = 0
+        sequence = 0
+        next_send_ns = start_ns
+        while True:
+            now_ns = time.perf_counter_ns()
+            if now_ns >= stop_ns:
+                break
+            if stats.first_sequence is None and now_ns >= measure_start_ns:
+                stats.first_sequence = sequence
+                bytes_sent_at_start = sum(bot.bytes_sent for bot in bots)
+                bytes_received_at_start = sum(bot.bytes_received for bot in bots)
+            while next_send_ns <= now_ns:
+                bot = bots[sequence % len(bots)]
+                if bot.connected:
+                    bot.send_chat_message(f'bench {sequence % len(bots)} {sequence} {time.perf_counter_ns()} {padding}')
+                sequence += 1
+                next_send_ns += interval_ns
+            poll_bots(selector, timeout=max(0.0, (next_send_ns - time.perf_counter_ns()) / 1e9))
+        sent = sequence - stats.first_sequence
+        live_bots = sum(bot.connected for bot in bots)
+        expected_deliveries = sent * live_bots
+        drain_deadline = time.monotonic() + options.drain
+        while len(stats.latencies_ns) < expected_deliveries and time.monotonic() < drain_deadline:
+            poll_bots(selector, timeout=0.01)
+        # rates are over the time from measuring starting to the last measured message arriving
+        elapsed = max(options.duration, ((stats.last_received_time or 0) - measure_start_ns) / 1e9)
+        bytes_sent = sum(bot.bytes_sent for bot in bots) - bytes_sent_at_start
+        bytes_received = sum(bot.bytes_received for bot in bots) - bytes_received_at_start
+        for bot in bots:
+            bot.close()
+    finally:
+        selector.close()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latencies_ms = sorted(latency / 1e6 for latency in stats.latencies_ns)
+    return {
+        'timestamp': time.time(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'bots': options.bots, 'rate': options.rate, 'duration': options.duration,
+                       'message_bytes': options.message_bytes, 'server_args': options.server_args,
+                       'connect': options.connect},
+        'messages_sent': sent,
+        'messages_sent_per_second': sent / options.duration,
+        'messages_delivered': len(latencies_ms),
+        'messages_delivered_per_second': len(latencies_ms) / elapsed,
+        'messages_lost': expected_deliveries - len(latencies_ms),
+        'bytes_sent_per_second': bytes_sent / elapsed,
+        'bytes_received_per_second': bytes_received / elapsed,
+        'latency_ms': {'p50': percentile(latencies_ms, 0.5),
+                       'p99': percentile(latencies_ms, 0.99),
+                       'p999': percentile(latencies_ms, 0.999),
+                       'max': latencies_ms[-1] if latencies_ms else None},
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    latency = results['latency_ms']
+    print(f"sent      {results['messages_sent_per_second']:10.1f} msg/s  {results['bytes_sent_per_second']:12.0f} B/s")
+    print(f"delivered {results['messages_delivered_per_second']:10.1f} msg/s  "
+          f"{results['bytes_received_per_second']:12.0f} B/s  lost {results['messages_lost']}")
+    if latency['p50'] is not None:
+        print(f"latency   p50 {latency['p50']:.2f} ms  p99 {latency['p99']:.2f} ms  p999 {latency['p999']:.2f} ms  "
+              f"max {latency['max']:.2f} ms")
+
+
+def main(args=None):
+    options = parse_args(args)
+    results = run_benchmark(options)
+    print_results(results)
+    with open(options.output, 'a') as output:
+        output.write(json.dumps(results) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import statistics
+import subprocess
+
+from benchmarks.fanout import CHAT_SERVER_SCRIPT, git_revision
+
+
+"""
+Startup benchmark for the headless server. Times, each in a fresh interpreter, how long Python takes to start with
+nothing to do, how long it takes to import the server, and how long a server takes from being launched to accepting
+its first connection. Also checks that importing the server doesn't load the GUI libraries or the engines that
+weren't asked for, which would quietly bring the startup time back up.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 20 --output startup_results.jsonl
+
+Times are in milliseconds, the median and best of --runs runs.
+"""
+
+# modules a selectors server should start without, pygame's import alone takes longer than the rest of the server's
+HEAVY_MODULES = ('pygame', 'pygame_gui', 'asyncio', 'multiprocessing', 'http')
+
+
+def time_process(arguments):
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + arguments, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def time_to_first_connection(port, timeout=10.0):
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, CHAT_SERVER_SCRIPT, '--host', '127.0.0.1', '--port', str(port),
+                               '--no-beacon', '--log-level', 'WARNING'], stdout=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f'The server exited with code {server.returncode}.')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.001)
+        raise RuntimeError(f'The server was not accepting connections on port {port} after {timeout} seconds.')
+    finally:
+        server.kill()
+        server.wait()
+
+
+def heavy_modules_imported():
+    # the heavy modules loaded by importing the server
+    check = ("import sys, chat_server; "
+             f"print(' '.join(sorted({{m.split('.')[0] for m in sys.modules}} & set({HEAVY_MODULES!r}))))")
+    output = subprocess.run([sys.executable, '-c', check], check=True, capture_output=True, text=True).stdout
+    return output.split()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Time how long the headless server takes to start.')
+    parser.add_argument('--runs', type=int, default=10, help='times to start each process')
+    parser.add_argument('--port', type=int, default=25591, help='port for the servers started')
+    parser.add_argument('--output', default=None, help='file to append the results to as a line of JSON')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    stages = {
+        'interpreter': lambda: time_process(['-c', 'pass']),
+        'import_server': lambda: time_process(['-c', 'import chat_server']),
+        'first_connection': lambda: time_to_first_connection(options.port),
+    }
+    results = {}
+    for name, stage in stages.items():
+        times = [stage() * 1000 for _ in range(options.runs)]
+        results[name] = {'median_ms': statistics.median(times), 'best_ms': min(times)}
+        print(f"{name:20} median {results[name]['median_ms']:8.1f} ms  best {results[name]['best_ms']:8.1f} ms")
+    heavy_modules = heavy_modules_imported()
+    if heavy_modules:
+        print(f"importing the server loads {', '.join(heavy_modules)}")
+    if options.output is not None:
+        with open(options.output, 'a') as output:
+            output.write(json.dumps({'timestamp': time.time(), 'git_revision': git_revision(),
+                                     'python': platform.python_version(), 'platform': platform.platform(),
+                                     'startup': results, 'heavy_modules': heavy_modules}) + '\n')
+    return 1 if heavy_modules else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
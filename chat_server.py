@@ -0,0 +1,202 @@
+import logging
+import socket
+import argparse
+
+from network.server import Server, DEFAULT_PORT, DEFAULT_BACKLOG
+from network.metrics import start_metrics_server
+from network.logs import configure_logging, DEFAULT_RATE_LIMIT, DEFAULT_RATE_INTERVAL
+from network.message_log import MessageLog, DEFAULT_SEGMENT_BYTES, DEFAULT_MAX_SEGMENTS, DEFAULT_REPLAY_LINES
+from network.framing import COMPRESSION_THRESHOLD
+from network.discovery import ServerBeacon, BEACON_ADDRESS, DISCOVERY_PORT
+from network.heartbeat import (HeartbeatSettings, DEFAULT_PING_INTERVAL, DEFAULT_PONG_TIMEOUT,
+                               DEFAULT_HANDSHAKE_TIMEOUT)
+from network.sessions import SessionStore, DEFAULT_REPLAY_MESSAGES, DEFAULT_RESUME_TIMEOUT
+from network.rate_limits import RateLimits, RATE_LIMIT_POLICIES, DEFAULT_CONNECTION_LIMIT, DEFAULT_ACTION_LIMITS
+from network.send_queue import (SendLimits, DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK, DEFAULT_COALESCE_BYTES,
+                                SLOW_CONSUMER_POLICIES)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Run a headless network chat server.')
+    parser.add_argument('--host', default=None,
+                        help='IP address to listen on (defaults to the IP of this machine on the LAN)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='port to listen on')
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG,
+                        help='maximum number of queued incoming connections')
+    parser.add_argument('--engine', choices=('selectors', 'asyncio'), default='selectors',
+                        help='server engine to run')
+    parser.add_argument('--uvloop', action='store_true',
+                        help='use uvloop for the asyncio engine when it is installed')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes sharing the port with SO_REUSEPORT (selectors engine only)')
+    parser.add_argument('--send-high-watermark', type=int, default=DEFAULT_HIGH_WATERMARK,
+                        help='bytes queued for one client before the slow consumer policy is applied')
+    parser.add_argument('--send-low-watermark', type=int, default=DEFAULT_LOW_WATERMARK,
+                        help='bytes queued for one client at which a slow client counts as caught up')
+    parser.add_argument('--slow-consumer-policy', choices=SLOW_CONSUMER_POLICIES, default='drop_oldest',
+                        help='what to do with a client whose queue passes the high watermark')
+    parser.add_argument('--coalesce-ms', type=float, default=0.0,
+                        help='hold outbound frames for up to this many milliseconds to send them in one write')
+    parser.add_argument('--coalesce-bytes', type=int, default=DEFAULT_COALESCE_BYTES,
+                        help='send coalesced frames early once this many bytes are waiting for a client')
+    parser.add_argument('--no-tcp-nodelay', dest='tcp_nodelay', action='store_false',
+                        help="leave Nagle's algorithm on for client connections")
+    parser.add_argument('--tcp-cork', action='store_true',
+                        help='cork client connections while frames are written so they go out in full TCP segments '
+                             '(Linux and BSD only)')
+    parser.add_argument('--compression-threshold', type=int, default=COMPRESSION_THRESHOLD,
+                        help='compress frames with at least this many bytes of content for clients that support it')
+    parser.add_argument('--no-compression', dest='compression', action='store_false',
+                        help="don't offer compression to clients")
+    parser.add_argument('--history-dir', default=None,
+                        help='keep the chat history in this directory and replay it to clients joining a room')
+    parser.add_argument('--history-lines', type=int, default=DEFAULT_REPLAY_LINES,
+                        help='number of messages replayed to a client joining a room')
+    parser.add_argument('--history-segment-bytes', type=int, default=DEFAULT_SEGMENT_BYTES,
+                        help='size at which the history log starts a new segment file')
+    parser.add_argument('--history-segments', type=int, default=DEFAULT_MAX_SEGMENTS,
+                        help='number of history segments kept before the oldest is deleted')
+    parser.add_argument('--history-fsync', action='store_true',
+                        help='fsync the history after every message')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics over HTTP on this port, sharded workers use the ports after it')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='address to serve metrics on')
+    parser.add_argument('--name', default=socket.gethostname(),
+                        help='server name shown to clients browsing the LAN')
+    parser.add_argument('--no-beacon', dest='beacon', action='store_false',
+                        help="don't advertise the server on the LAN")
+    parser.add_argument('--beacon-address', default=BEACON_ADDRESS,
+                        help='address to send the LAN beacon to, a broadcast or multicast address')
+    parser.add_argument('--discovery-port', type=int, default=DISCOVERY_PORT,
+                        help='UDP port clients listen on for beacons')
+    parser.add_argument('--ping-interval', type=float, default=DEFAULT_PING_INTERVAL,
+                        help='seconds a client can be quiet before it is pinged')
+    parser.add_argument('--pong-timeout', type=float, default=DEFAULT_PONG_TIMEOUT,
+                        help='seconds a pinged client has to answer before it is disconnected')
+    parser.add_argument('--handshake-timeout', type=float, default=DEFAULT_HANDSHAKE_TIMEOUT,
+                        help='seconds a new connection has to send its on_connection request')
+    parser.add_argument('--no-heartbeats', dest='heartbeats', action='store_false',
+                        help="don't ping clients or time out connections")
+    parser.add_argument('--resume-timeout', type=float, default=DEFAULT_RESUME_TIMEOUT,
+                        help='seconds a dropped client has to reconnect and resume its session')
+    parser.add_argument('--replay-messages', type=int, default=DEFAULT_REPLAY_MESSAGES,
+                        help='messages kept for each room to replay to clients that resume')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help="don't number broadcasts or let dropped clients resume")
+    parser.add_argument('--request-rate', type=float, default=DEFAULT_CONNECTION_LIMIT[0],
+                        help='requests per second each client can make, of any kind')
+    parser.add_argument('--request-burst', type=int, default=DEFAULT_CONNECTION_LIMIT[1],
+                        help='requests a client can make at once before --request-rate applies')
+    parser.add_argument('--message-rate', type=float, default=DEFAULT_ACTION_LIMITS['send_message'][0],
+                        help='chat messages per second each client can send')
+    parser.add_argument('--message-burst', type=int, default=DEFAULT_ACTION_LIMITS['send_message'][1],
+                        help='chat messages a client can send at once before --message-rate applies')
+    parser.add_argument('--rate-limit-policy', choices=RATE_LIMIT_POLICIES, default='error',
+                        help='answer requests over a rate limit with an error, or drop them silently')
+    parser.add_argument('--no-rate-limits', dest='rate_limits', action='store_false',
+                        help="don't limit how fast clients can make requests")
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default='INFO',
+                        help='least severe log messages to show, DEBUG traces every frame')
+    parser.add_argument('--log-rate-limit', type=int, default=DEFAULT_RATE_LIMIT,
+                        help='most log messages of each kind shown per --log-rate-interval, 0 for no limit')
+    parser.add_argument('--log-rate-interval', type=float, default=DEFAULT_RATE_INTERVAL,
+                        help='seconds over which --log-rate-limit applies')
+    parser.add_argument('--log-queue', action='store_true',
+                        help='write log messages from a background thread instead of the event loop')
+    options = parser.parse_args(args)
+    if options.workers < 1:
+        parser.error('--workers must be at least 1')
+    if options.workers > 1 and options.engine != 'selectors':
+        parser.error('--workers is only supported by the selectors engine')
+    return options
+
+
+def create_sessions(session_options, history):
+    if session_options is None:
+        return None
+    # numbering starts past the logged history, which clients may be replayed with sequence numbers from earlier runs
+    return SessionStore(first_sequence=history.next_sequence if history is not None else 0, **session_options)
+
+
+def main(args=None):
+    options = parse_args(args)
+    log_options = dict(level=getattr(logging, options.log_level),
+                       rate_limit=options.log_rate_limit,
+                       rate_interval=options.log_rate_interval,
+                       queued=options.log_queue)
+    log_listener = configure_logging(**log_options)
+    send_limits = SendLimits(high_watermark=options.send_high_watermark,
+                             low_watermark=options.send_low_watermark,
+                             slow_consumer_policy=options.slow_consumer_policy,
+                             coalesce_delay=options.coalesce_ms / 1000.0,
+                             coalesce_bytes=options.coalesce_bytes,
+                             tcp_nodelay=options.tcp_nodelay,
+                             tcp_cork=options.tcp_cork,
+                             compression_threshold=options.compression_threshold if options.compression else None)
+    history_options = dict(segment_bytes=options.history_segment_bytes,
+                           max_segments=options.history_segments,
+                           replay_lines=options.history_lines,
+                           fsync=options.history_fsync)
+    metrics_address = (options.metrics_host, options.metrics_port) if options.metrics_port is not None else None
+    heartbeat_settings = None
+    if options.heartbeats:
+        heartbeat_settings = HeartbeatSettings(ping_interval=options.ping_interval, pong_timeout=options.pong_timeout,
+                                               handshake_timeout=options.handshake_timeout)
+    beacon_options = None
+    if options.beacon:
+        beacon_options = dict(name=options.name, address=options.beacon_address,
+                              discovery_port=options.discovery_port)
+    rate_limits = None
+    if options.rate_limits:
+        message_limit = (options.message_rate, options.message_burst)
+        # binary requests are broadcast like chat messages, so get the same limit
+        rate_limits = RateLimits(connection_limit=(options.request_rate, options.request_burst),
+                                 action_limits=dict(DEFAULT_ACTION_LIMITS, send_message=message_limit,
+                                                    binary=message_limit),
+                                 policy=options.rate_limit_policy)
+    session_options = None
+    if options.resume:
+        session_options = dict(replay_messages=options.replay_messages, resume_timeout=options.resume_timeout)
+    try:
+        # the other engines pull in asyncio or multiprocessing, so they are only imported when they are used
+        if options.engine == 'asyncio':
+            from network.async_server import AsyncServer
+            history = MessageLog(options.history_dir, **history_options) if options.history_dir else None
+            beacon = ServerBeacon(port=options.port, **beacon_options) if beacon_options is not None else None
+            sessions = create_sessions(session_options, history)
+            server = AsyncServer(host=options.host, port=options.port, backlog=options.backlog,
+                                 send_limits=send_limits, history=history, beacon=beacon,
+                                 heartbeat_settings=heartbeat_settings, sessions=sessions, rate_limits=rate_limits)
+            if metrics_address is not None:
+                start_metrics_server(server.metrics, *metrics_address)
+            server.run(use_uvloop=options.uvloop)
+        elif options.workers > 1:
+            from network.sharded_server import ShardedServer
+            server = ShardedServer(host=options.host, port=options.port, backlog=options.backlog,
+                                   num_workers=options.workers, send_limits=send_limits,
+                                   history_dir=options.history_dir, history_options=history_options,
+                                   metrics_address=metrics_address, log_options=log_options,
+                                   beacon_options=beacon_options, heartbeat_settings=heartbeat_settings,
+                                   session_options=session_options, rate_limits=rate_limits)
+            server.serve_forever()
+        else:
+            history = MessageLog(options.history_dir, **history_options) if options.history_dir else None
+            beacon = ServerBeacon(port=options.port, **beacon_options) if beacon_options is not None else None
+            sessions = create_sessions(session_options, history)
+            server = Server(host=options.host, port=options.port, backlog=options.backlog,
+                            send_limits=send_limits, history=history, beacon=beacon,
+                            heartbeat_settings=heartbeat_settings, sessions=sessions, rate_limits=rate_limits)
+            if metrics_address is not None:
+                start_metrics_server(server.metrics, *metrics_address)
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if log_listener is not None:
+            log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+from collections import deque
+
 import pygame
 
 from pygame_gui.elements.ui_window import UIWindow
@@ -9,18 +11,25 @@ from pygame_gui.elements.ui_text_entry_line import UITextEntryLine
 from pygame_gui.core import ObjectID
 
 
+MAX_SCROLLBACK_LINES = 500
+# lines allowed past the scrollback limit before the text box is rebuilt without the evicted ones
+SCROLLBACK_REBUILD_SLACK = 100
+
+
 class ChatWindow(UIWindow):
     def __init__(self,
                  rect: pygame.Rect,
                  room_name: str,
-                 manager: UIManager):
+                 manager: UIManager,
+                 max_scrollback_lines: int = MAX_SCROLLBACK_LINES):
         super().__init__(rect, manager,
                          window_display_title=room_name,
                          object_id=ObjectID('#chat_room_window', None))
 
         self.room_name = room_name
 
-        self.chat_log_list = []
+        self.chat_log_list = deque(maxlen=max_scrollback_lines)
+        self.num_lines_in_text_box = 0
 
         self.chat_log = UITextBox(html_text="",
                                   relative_rect=pygame.Rect((0, 0),
@@ -43,9 +52,36 @@ class ChatWindow(UIWindow):
     def add_new_chat_line_to_log(self, chat_message):
         self.chat_log_list.append(chat_message)
 
-        self.convert_log_to_formatted_block()
+        # Only the new line is laid out, the text box is rebuilt from the capped log once enough old lines have
+        # been evicted from it.
+        if (self.num_lines_in_text_box >= self.chat_log_list.maxlen + SCROLLBACK_REBUILD_SLACK or
+                not hasattr(self.chat_log, 'append_html_text')):
+            self.convert_log_to_formatted_block()
+        else:
+            self.append_line_to_text_box(chat_message)
+
+    def append_line_to_text_box(self, chat_message):
+        scroll_bar = self.chat_log.scroll_bar
+        old_start = 0.0
+        old_visible = 1.0
+        if scroll_bar is not None:
+            old_start = scroll_bar.start_percentage
+            old_visible = scroll_bar.visible_percentage
+        following_latest = old_start + old_visible >= 0.999
+
+        self.chat_log.append_html_text(chat_message if self.num_lines_in_text_box == 0 else "<br>" + chat_message)
+        self.num_lines_in_text_box += 1
+
+        scroll_bar = self.chat_log.scroll_bar
+        if scroll_bar is not None:
+            if following_latest:
+                scroll_bar.set_scroll_from_start_percentage(1.0 - scroll_bar.visible_percentage)
+            else:
+                # keep the lines being read in place as the log grows below them
+                scroll_bar.set_scroll_from_start_percentage(old_start * scroll_bar.visible_percentage / old_visible)
 
     def convert_log_to_formatted_block(self):
+        self.num_lines_in_text_box = len(self.chat_log_list)
         text = "<br>".join(self.chat_log_list)
         self.chat_log.kill()
         self.chat_log = UITextBox(html_text=text,
@@ -56,3 +92,5 @@ class ChatWindow(UIWindow):
                                   container=self,
                                   parent_element=self,
                                   object_id=ObjectID('#chat_log', None))
+        if self.chat_log.scroll_bar is not None:
+            self.chat_log.scroll_bar.set_scroll_from_start_percentage(1.0 - self.chat_log.scroll_bar.visible_percentage)
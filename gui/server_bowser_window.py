@@ -0,0 +1,89 @@
+from typing import List, Optional
+
+import pygame
+
+from pygame_gui.elements.ui_window import UIWindow
+from pygame_gui.ui_manager import UIManager
+from pygame_gui.elements.ui_selection_list import UISelectionList
+from pygame_gui.elements.ui_button import UIButton
+from pygame_gui.elements.ui_label import UILabel
+from pygame_gui.core import ObjectID
+
+from network.discovery import DiscoveredServer
+
+
+class ServerBrowserWindow(UIWindow):
+    def __init__(self,
+                 rect: pygame.Rect,
+                 manager: UIManager):
+        super().__init__(rect, manager,
+                         window_display_title='Join Server',
+                         object_id=ObjectID('#server_browser_window', None))
+
+        self.servers = {}
+        self.server_keys_listed = []
+
+        container_width, container_height = self.get_container().get_size()
+        self.server_list = UISelectionList(pygame.Rect(0, 0, container_width, container_height - 80),
+                                           item_list=[],
+                                           manager=manager,
+                                           container=self,
+                                           parent_element=self,
+                                           object_id=ObjectID('#server_list', None))
+
+        self.server_details = UILabel(pygame.Rect(0, container_height - 80, container_width, 30),
+                                      text='Looking for servers on the LAN...',
+                                      manager=manager,
+                                      container=self,
+                                      parent_element=self,
+                                      object_id=ObjectID('#server_details', None))
+
+        button_width = int(container_width / 3)
+        self.join_button = UIButton(pygame.Rect(0, container_height - 45, button_width, 40),
+                                    text='Join',
+                                    manager=manager,
+                                    container=self,
+                                    parent_element=self,
+                                    object_id=ObjectID('#join_button', None))
+        self.quick_join_button = UIButton(pygame.Rect(button_width, container_height - 45, button_width, 40),
+                                          text='Quick Join',
+                                          manager=manager,
+                                          container=self,
+                                          parent_element=self,
+                                          object_id=ObjectID('#quick_join_button', None))
+        self.enter_address_button = UIButton(pygame.Rect(button_width * 2, container_height - 45,
+                                                         container_width - button_width * 2, 40),
+                                             text='Enter Address',
+                                             manager=manager,
+                                             container=self,
+                                             parent_element=self,
+                                             object_id=ObjectID('#enter_address_button', None))
+
+    @staticmethod
+    def server_list_text(server: DiscoveredServer) -> str:
+        return f'{server.name}  ({server.address}:{server.port})'
+
+    def set_servers(self, servers: List[DiscoveredServer]):
+        # The list itself is only rebuilt when servers come or go, rebuilding it clears the selection. The user count
+        # and load of the selected server change with every beacon, so they are shown in the label underneath.
+        self.servers = {self.server_list_text(server): server for server in servers}
+        server_keys = [(server.address, server.port) for server in servers]
+        if sorted(server_keys) != sorted(self.server_keys_listed):
+            self.server_keys_listed = server_keys
+            self.server_list.set_item_list(list(self.servers.keys()))
+        self.update_server_details()
+
+    def selected_server(self) -> Optional[DiscoveredServer]:
+        selection = self.server_list.get_single_selection()
+        if selection is None:
+            return None
+        return self.servers.get(selection)
+
+    def update_server_details(self):
+        server = self.selected_server()
+        if server is not None:
+            self.server_details.set_text(f'{server.users} users, {server.load:.0%} load')
+        elif self.servers:
+            self.server_details.set_text(f'{len(self.servers)} servers found')
+        else:
+            self.server_details.set_text('Looking for servers on the LAN...')
@@ -0,0 +1,353 @@
+import logging
+import time
+import asyncio
+
+from network.framing import PROTOCOL_V1, FrameDecoder, encode_frame
+from network.server_actions import (create_json_response_content, create_json_response, create_binary_response,
+                                    negotiate_protocol, resume_session, joins_new_room)
+from network.server import Server, DEFAULT_PORT, DEFAULT_BACKLOG, PING_FRAMES
+from network.send_queue import SendLimits, apply_tcp_options, apply_tcp_keepalive, set_tcp_cork
+from network.rooms import RoomIndex, DEFAULT_ROOM
+from network.message_log import history_frames
+from network.metrics import ServerMetrics
+from network.connections import Connection, ConnectionRegistry
+from network.heartbeat import HeartbeatMonitor
+from network.rate_limits import request_action, rate_limited_content
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncConnection(Connection):
+    # the asyncio server writes through the transport rather than a ServerMessage
+    __slots__ = ('transport', 'write_paused', 'coalesced_frames', 'coalesced_bytes')
+
+    def __init__(self, addr, fd, transport):
+        super().__init__(addr, fd)
+        self.transport = transport
+        self.write_paused = False
+        # frames held back to be written together, see AsyncServer.coalesce_frame()
+        self.coalesced_frames = []
+        self.coalesced_bytes = 0
+
+
+class AsyncServerProtocol(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.connections = server.connections
+        self.connection = None
+        self.transport = None
+        self.addr = None
+        self._frame_decoder = FrameDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self.connection = AsyncConnection(self.addr, transport.get_extra_info('socket').fileno(), transport)
+        self.connections.add(self.connection)
+        send_limits = self.server.send_limits
+        transport.set_write_buffer_limits(high=send_limits.high_watermark, low=send_limits.low_watermark)
+        apply_tcp_options(transport.get_extra_info('socket'), nodelay=send_limits.tcp_nodelay)
+        heartbeat_monitor = self.server.heartbeat_monitor
+        if heartbeat_monitor is not None:
+            # for old clients that can't answer pings
+            apply_tcp_keepalive(transport.get_extra_info('socket'), heartbeat_monitor.settings.ping_interval,
+                                heartbeat_monitor.settings.pong_timeout / 3)
+            heartbeat_monitor.watch(self.connection)
+        self.server.metrics.connection_opened()
+        logger.info('Accepted connection from %s', self.addr)
+
+    def connection_lost(self, exc):
+        # exc is None when the client closed the connection, and counted as a normal disconnect either way, as on the
+        # selectors engine
+        if exc is not None:
+            logger.info("%s disconnected: %r", self.addr, exc)
+        logger.info("closing connection to %s", self.addr)
+        self.connections.remove(self.addr)
+        if self.server.heartbeat_monitor is not None:
+            self.server.heartbeat_monitor.forget(self.connection)
+        if self.server.sessions is not None:
+            self.server.sessions.detach(self.connection, self.server.rooms.rooms_of(self.addr))
+        self.server.rooms.leave_all(self.addr)
+        self.server.metrics.connection_closed()
+        self.transport = None
+
+    def pause_writing(self):
+        # the transport's write buffer has passed the high watermark
+        send_limits = self.server.send_limits
+        policy = send_limits.slow_consumer_policy
+        send_limits.policy_counters[policy] += 1
+        self.connection.write_paused = True
+        if policy == 'pause_reads':
+            logger.warning("pausing reads from slow client %s", self.addr)
+            self.transport.pause_reading()
+        elif policy == 'disconnect':
+            logger.warning("disconnecting slow client %s", self.addr)
+            # the transport is kept so that the request being handled can still finish, see closed
+            self.transport.abort()
+
+    def resume_writing(self):
+        self.connection.write_paused = False
+        if self.server.send_limits.slow_consumer_policy == 'pause_reads':
+            logger.info("resuming reads from client %s", self.addr)
+            self.transport.resume_reading()
+
+    def data_received(self, data):
+        # each callback is one tick of work for the event loop
+        tick_start = time.perf_counter()
+        metrics = self.server.metrics
+        metrics.bytes_received.inc(len(data))
+        if self.connection.heartbeat is not None:
+            self.connection.heartbeat.last_received = time.monotonic()
+        self._frame_decoder.feed(data)
+        try:
+            self.process_frames()
+        except Exception:
+            logger.exception("exception for %s", self.addr)
+            metrics.errors.inc()
+            self.close()
+        metrics.loop_tick_seconds.observe(time.perf_counter() - tick_start)
+
+    def send_frames(self, frames):
+        # frames for this client only
+        self.server.metrics.frames_sent.inc(len(frames))
+        self.server.metrics.bytes_sent.inc(sum(len(frame) for frame in frames))
+        if not self.closed:
+            self.transport.writelines(frames)
+
+    @property
+    def closed(self):
+        # closing or already gone, frames written now would never reach the client
+        return self.transport is None or self.transport.is_closing()
+
+    def close(self):
+        if not self.closed:
+            self.transport.close()
+
+    def process_frames(self):
+        # decode every complete frame in the buffer, the decoder keeps any partial frame for the next read
+        decode_start = time.perf_counter()
+        requests = self._frame_decoder.frames()
+        if requests:
+            metrics = self.server.metrics
+            metrics.frames_received.inc(len(requests))
+            metrics.frame_decode_seconds.observe((time.perf_counter() - decode_start) / len(requests), len(requests))
+        for request in requests:
+            if self.closed:
+                break
+            self.process_request(request)
+
+    def process_request(self, request):
+        rate_limits = self.server.rate_limits
+        if rate_limits is not None and not rate_limits.allow(self.connection,
+                                                             request_action(request["type"], request["content"])):
+            # refused requests are dropped before anything is done with them, or answered with an error
+            if rate_limits.should_answer(self.connection):
+                content = rate_limited_content(request["type"], request["content"])
+                self.send_frames([encode_frame(create_json_response(content), *self.connection.frame_format)])
+            return
+        if request["type"] == "text/json":
+            content = request["content"]
+            logger.debug("received request %r from %s", content, self.addr)
+            client = self.connection
+            sessions = self.server.sessions
+            if content.get("action") == "quit":
+                if sessions is not None:
+                    sessions.end(client)
+                self.close()
+                return
+            if content.get("action") == "resume" and sessions is not None:
+                self.resume_session(content)
+                return
+            if content.get("action") == "on_connection":
+                heartbeat_monitor = self.server.heartbeat_monitor
+                ping_interval = heartbeat_monitor.settings.ping_interval if heartbeat_monitor else None
+                reply = negotiate_protocol(content, client, self.server.send_limits.compression_threshold,
+                                           ping_interval, resumable=sessions is not None)
+                if heartbeat_monitor is not None:
+                    heartbeat_monitor.handshake_done(client)
+                if reply is not None:
+                    # sent uncompressed, the client only learns it can expect compression from this reply
+                    self.send_frames([encode_frame(create_json_response(reply), client.protocol)])
+            replay_history = self.server.history is not None and joins_new_room(content, client, self.server.rooms)
+            room, response_content = create_json_response_content(content, client, self.connections,
+                                                                  self.server.rooms)
+            if response_content is None:
+                return
+            if content.get("action") == "first_entry" and sessions is not None and client.sequenced:
+                self.send_frames([encode_frame(create_json_response({'session': sessions.create(client)}),
+                                               *client.frame_format)])
+            response = create_json_response(response_content)
+            if room is None:
+                # a reply for this client only
+                self.send_frames([encode_frame(response, *client.frame_format)])
+                return
+            if replay_history:
+                # catch the client up before it sees its own join announced
+                self.send_frames(history_frames(self.server.history, room, *client.frame_format,
+                                                last=content.get("history"), since=content.get("history_since")))
+        else:
+            # Binary or unknown content-type
+            logger.debug("received %s request from %s", request["type"], self.addr)
+            response = create_binary_response(request["content"])
+            room = DEFAULT_ROOM
+        self.server.broadcast(response, room)
+
+    def resume_session(self, request):
+        client = self.connection
+        reply, missed, previous = resume_session(request, client, self.connections, self.server.rooms,
+                                                 self.server.sessions)
+        if previous is not None and not previous.transport.is_closing():
+            logger.info("%s resumed the session of %s, closing the old connection", self.addr, previous.addr)
+            previous.transport.close()
+        self.send_frames([encode_frame(create_json_response(reply), *client.frame_format)]
+                         + [encode_frame(message, *client.frame_format) for message in missed])
+
+
+class AsyncServer:
+    def __init__(self, host=None, port=DEFAULT_PORT, backlog=DEFAULT_BACKLOG, send_limits=None, history=None,
+                 metrics=None, beacon=None, heartbeat_settings=None, sessions=None, rate_limits=None):
+        self.server_hosting_ip = host if host is not None else Server.get_ip_for_hosting()
+        self.network_port = port
+        self.backlog = backlog
+        self.send_limits = send_limits if send_limits is not None else SendLimits()
+        self.connections = ConnectionRegistry()
+        self.rooms = RoomIndex()
+        self.history = history
+        self.heartbeat_monitor = None
+        if heartbeat_settings is not None:
+            self.heartbeat_monitor = HeartbeatMonitor(heartbeat_settings, self.send_ping, self.close_connection)
+        self.sessions = sessions
+        self.rate_limits = rate_limits
+        self.metrics = metrics if metrics is not None else ServerMetrics(self.send_limits, self.rooms,
+                                                                         self.heartbeat_monitor, self.sessions,
+                                                                         self.rate_limits)
+        # optional ServerBeacon advertising the server to clients on the LAN
+        self.beacon = beacon
+        self.asyncio_server = None
+        self._flush_handle = None
+        # connections with coalesced frames waiting, so a flush only visits those
+        self._coalescing = set()
+        self._beacon_handle = None
+        self._timer_handle = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.asyncio_server = await loop.create_server(lambda: AsyncServerProtocol(self),
+                                                       self.server_hosting_ip, self.network_port,
+                                                       backlog=self.backlog, reuse_address=True)
+        logger.info('Starting async server on %s', (self.server_hosting_ip, self.network_port))
+
+    async def serve_forever(self):
+        await self.start()
+        if self.beacon is not None:
+            self.send_beacon()
+        if self.heartbeat_monitor is not None:
+            self.advance_timers()
+        try:
+            async with self.asyncio_server:
+                await self.asyncio_server.serve_forever()
+        finally:
+            if self._timer_handle is not None:
+                self._timer_handle.cancel()
+            if self._beacon_handle is not None:
+                self._beacon_handle.cancel()
+                self.beacon.close()
+            if self.history is not None:
+                self.history.close()
+
+    def advance_timers(self):
+        wheel = self.heartbeat_monitor.wheel
+        wheel.advance()
+        time_until_tick = wheel.time_until_next_tick()
+        loop = asyncio.get_running_loop()
+        self._timer_handle = loop.call_later(time_until_tick if time_until_tick is not None else wheel.tick,
+                                             self.advance_timers)
+
+    def send_ping(self, connection):
+        frame = PING_FRAMES[connection.protocol]
+        self.metrics.frames_sent.inc()
+        self.metrics.bytes_sent.inc(len(frame))
+        connection.transport.write(frame)
+
+    def close_connection(self, connection):
+        connection.transport.close()
+
+    def send_beacon(self):
+        self.beacon.update(len(self.connections), self.metrics.loop_tick_seconds.sum)
+        loop = asyncio.get_running_loop()
+        self._beacon_handle = loop.call_later(self.beacon.time_until_next_beacon(), self.send_beacon)
+
+    def broadcast(self, message, room=DEFAULT_ROOM):
+        # encode once per frame format in use
+        frames = {}
+        if self.sessions is not None and message["type"] == "text/json":
+            self.sessions.sequence(room, message)
+        if self.history is not None and message["type"] == "text/json":
+            frames[(PROTOCOL_V1, None, False)] = encode_frame(message, PROTOCOL_V1)
+            self.history.append(room, frames[(PROTOCOL_V1, None, False)])
+        # copied as a slow client may be disconnected, and leave its rooms, while the frame is being written
+        for client in list(self.rooms.members(room)):
+            if client.write_paused:
+                # a transport buffer can't give back frames it already holds, so frames for a slow client are
+                # dropped from the newest end instead of the oldest, with reads paused as well so that the buffer
+                # stays bounded while other clients keep talking
+                self.send_limits.dropped_frames += 1
+                continue
+            frame_format = client.frame_format
+            if frame_format not in frames:
+                frames[frame_format] = encode_frame(message, *frame_format)
+            self.metrics.frames_sent.inc()
+            self.metrics.bytes_sent.inc(len(frames[frame_format]))
+            if self.send_limits.coalesce_delay > 0:
+                self.coalesce_frame(client, frames[frame_format])
+            else:
+                client.transport.write(frames[frame_format])
+
+    def coalesce_frame(self, client, frame):
+        if not client.coalesced_frames:
+            self._coalescing.add(client)
+        client.coalesced_frames.append(frame)
+        client.coalesced_bytes += len(frame)
+        if client.coalesced_bytes >= self.send_limits.coalesce_bytes:
+            self.flush_client(client)
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.send_limits.coalesce_delay, self.flush_coalesced_frames)
+
+    def flush_coalesced_frames(self):
+        self._flush_handle = None
+        coalescing = self._coalescing
+        self._coalescing = set()
+        for client in coalescing:
+            if client.coalesced_frames and not client.transport.is_closing():
+                self.flush_client(client)
+
+    def flush_client(self, client):
+        self.metrics.send_queue_frames.observe(len(client.coalesced_frames))
+        if self.send_limits.tcp_cork:
+            sock = client.transport.get_extra_info('socket')
+            set_tcp_cork(sock, True)
+            client.transport.writelines(client.coalesced_frames)
+            set_tcp_cork(sock, False)
+        else:
+            client.transport.writelines(client.coalesced_frames)
+        client.coalesced_frames = []
+        client.coalesced_bytes = 0
+        self._coalescing.discard(client)
+
+    def run(self, use_uvloop=False):
+        if use_uvloop:
+            install_uvloop()
+        asyncio.run(self.serve_forever())
+
+
+def install_uvloop():
+    # uvloop is optional, any loop implementing the asyncio event loop policy interface can be plugged in the same way
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning('uvloop is not installed, falling back to the default asyncio event loop')
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
@@ -0,0 +1,121 @@
+import logging
+import time
+import socket
+import selectors
+
+from network.client_message import ClientMessage, create_request
+from network.framing import PROTOCOL_V1, SUPPORTED_COMPRESSION, COMPRESSION_THRESHOLD
+from network.rooms import DEFAULT_ROOM
+from network.send_queue import apply_tcp_options
+from network.server import DEFAULT_PORT
+
+
+"""
+Headless chat clients for load testing. They speak the same protocol as the pygame client but need no app or chat
+window, and many of them can share one selector so a single thread can drive a whole crowd of them.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class BotConnection(ClientMessage):
+    # a ClientMessage that counts the bytes it moves and skips the per message logging
+    def __init__(self, selector, sock, addr, bot, protocol=PROTOCOL_V1):
+        super().__init__(selector, sock, addr, protocol)
+        self.bot = bot
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def _read(self):
+        try:
+            received = self._frame_decoder.recv_into(self.sock)
+        except BlockingIOError:
+            return
+        if not received:
+            raise RuntimeError("Peer closed.")
+        self.bytes_received += received
+
+    def _write(self):
+        if self._send_queue:
+            try:
+                self.bytes_sent += self._send_queue.send(self.sock)
+            except BlockingIOError:
+                pass
+
+    def process_response(self, response):
+        if response["type"] == "text/json":
+            self.response = response["content"]
+            if "protocol" in self.response:
+                self.protocol = self.response["protocol"]
+            if self.response.get("compression") in SUPPORTED_COMPRESSION:
+                self.compression_threshold = COMPRESSION_THRESHOLD
+            if self.response.get("action") == "ping":
+                self.queue_request(create_request("pong", self.response.get("value", "")))
+                return
+            result = self.response.get("result")
+            if result is not None:
+                self.latest_texts_from_server.append((self.response.get("room", DEFAULT_ROOM), result))
+
+
+class BotClient:
+    def __init__(self, selector, server_ip, port=DEFAULT_PORT, name='bot', on_line=None):
+        # on_line(bot, room, line, received_time) is called for every chat line, received_time is from
+        # time.perf_counter_ns() as the line was decoded
+        self.name = name
+        self.on_line = on_line
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        apply_tcp_options(self.sock)
+        self.sock.connect_ex((server_ip, port))
+        self.connection = BotConnection(selector, self.sock, (server_ip, port), self)
+        selector.register(self.sock, selectors.EVENT_READ, data=self.connection)
+        self.connection.queue_request(create_request('on_connection', server_ip))
+
+    @property
+    def connected(self):
+        return self.connection.sock is not None
+
+    @property
+    def bytes_received(self):
+        return self.connection.bytes_received
+
+    @property
+    def bytes_sent(self):
+        return self.connection.bytes_sent
+
+    def service_connection(self, mask):
+        try:
+            self.connection.process_events(mask)
+        except Exception:
+            logger.exception("bot %s: exception for %s", self.name, self.connection.addr)
+            self.close()
+            return
+        lines = self.connection.get_latest_texts_from_server()
+        if lines and self.on_line is not None:
+            received_time = time.perf_counter_ns()
+            for room, line in lines:
+                self.on_line(self, room, line, received_time)
+
+    def send_request(self, request):
+        self.connection.queue_request(request)
+
+    def first_entry(self):
+        self.send_request(create_request('first_entry', self.name))
+
+    def send_chat_message(self, message, room=DEFAULT_ROOM):
+        self.send_request(create_request('send_message', message, room))
+
+    def join_room(self, room):
+        self.send_request(create_request('join_room', room))
+
+    def close(self):
+        if self.connection.sock is not None:
+            self.connection.close()
+
+
+def poll_bots(selector, timeout=None):
+    # services every bot with I/O ready on the selector, returns the number of events handled
+    events = selector.select(timeout=timeout)
+    for key, mask in events:
+        key.data.bot.service_connection(mask)
+    return len(events)
@@ -1,104 +1,236 @@
+import logging
+import time
+import random
 import socket
 import selectors
-import traceback
+import threading
+from collections import deque
 
-from network.client_message import ClientMessage
+from network.client_message import ClientMessage, create_request, create_resume_request
+from network.framing import PROTOCOL_V1
+from network.send_queue import apply_tcp_options
+from network.rooms import DEFAULT_ROOM
+from network.server import DEFAULT_PORT
+
+
+logger = logging.getLogger(__name__)
+
+# A dropped connection with a session to resume is retried after RECONNECT_DELAY seconds, doubling each time up to
+# RECONNECT_MAX_DELAY. Each delay is cut by a random amount so clients that drop together don't all come back at once.
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 8.0
+RECONNECT_ATTEMPTS = 8
 
 
 class Client:
-    def __init__(self, server_ip, app):
+    def __init__(self, server_ip, app, threaded=False, tcp_nodelay=True, port=DEFAULT_PORT):
         self.app = app
 
-        self.client_ip = server_ip  # need a way to search for IPs using a port?
-        self.network_port = 25574  # Port to listen on (non-privileged ports are > 1023)
+        self.client_ip = server_ip  # servers on the LAN can be found with network.discovery.DiscoveryListener
+        self.network_port = port
         self.client_socket = None
         self.client_selector = selectors.DefaultSelector()
         self.client_num_registered_event_handlers = 0
+        self.connection = None
+        self.tcp_nodelay = tcp_nodelay
 
-        print('Joining server')
+        # With threaded set the selector loop runs in its own thread. Chat lines are handed to the UI thread, and
+        # requests to the network thread, through deques whose append and popleft are atomic, so neither side waits
+        # on a lock. The network thread is woken for outbound requests through a socket pair.
+        self.threaded = threaded
+        self.running = False
+        self.network_thread = None
+        self.received_chat_lines = deque()
+        self.outbound_requests = deque()
+        self._wakeup_receiver = None
+        self._wakeup_sender = None
+
+        # what to join again with if the server no longer has our session when reconnecting
+        self.name = None
+        self.rooms = set()
+        # when to try reconnecting, None while connected or once the client has given up
+        self.reconnect_time = None
+        self.reconnect_attempts = 0
+
+        logger.info('Joining server')
         request = self.create_request('on_connection', self.client_ip)
         self.start_connection(self.client_ip, self.network_port, request)
+        if self.threaded:
+            self.start_network_thread()
+
+    @property
+    def protocol(self):
+        return self.connection.protocol if self.connection is not None else PROTOCOL_V1
 
     def update(self):
+        if self.threaded:
+            # the network thread does the I/O, just pass on anything it has received
+            while self.received_chat_lines:
+                self.add_chat_line_to_log(*self.received_chat_lines.popleft())
+            return
         if self.client_socket is not None and self.client_num_registered_event_handlers > 0:
             events = self.client_selector.select(timeout=0.005)
             for key, mask in events:
                 self.service_connection(key, mask)
+        self.reconnect_if_due()
+
+    def start_network_thread(self):
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self.client_selector.register(self._wakeup_receiver, selectors.EVENT_READ, data=None)
+        self.running = True
+        self.network_thread = threading.Thread(target=self.run_network_loop, name='network_chat_client', daemon=True)
+        self.network_thread.start()
+
+    def run_network_loop(self):
+        while self.running and (self.client_num_registered_event_handlers > 0 or self.reconnect_time is not None):
+            events = self.client_selector.select(timeout=self.time_until_reconnect())
+            for key, mask in events:
+                if key.data is None:
+                    self.send_outbound_requests()
+                else:
+                    self.service_connection(key, mask)
+            self.reconnect_if_due()
+
+    def send_outbound_requests(self):
+        try:
+            while self._wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.queue_outbound_requests()
+
+    def queue_outbound_requests(self):
+        # requests made while reconnecting wait here until there is a connection to send them on
+        while self.outbound_requests and self.connection is not None and self.connection.sock is not None:
+            self.connection.queue_request(self.outbound_requests.popleft())
+
+    def wake_network_thread(self):
+        try:
+            self._wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            # the wakeup socket is full, so the network thread is already due to wake up
+            pass
+
+    def close(self):
+        self.reconnect_time = None
+        if self.network_thread is not None:
+            self.running = False
+            self.wake_network_thread()
+            self.network_thread.join()
+            self.network_thread = None
+            self.client_selector.unregister(self._wakeup_receiver)
+            self._wakeup_receiver.close()
+            self._wakeup_sender.close()
+        if self.connection is not None and self.connection.sock is not None:
+            self.connection.close()
+            self.client_num_registered_event_handlers -= 1
 
     def start_connection(self, host, port, request):
         server_addr = (host, port)
-        print("starting connection to", server_addr)
+        logger.info("starting connection to %s", server_addr)
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.setblocking(False)
+        apply_tcp_options(self.client_socket, nodelay=self.tcp_nodelay)
         self.client_socket.connect_ex(server_addr)
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        message = ClientMessage(self.client_selector, self.client_socket, server_addr, request, self.app)
-        self.client_selector.register(self.client_socket, events, data=message)
+        self.connection = ClientMessage(self.client_selector, self.client_socket, server_addr)
+        self.client_selector.register(self.client_socket, selectors.EVENT_READ, data=self.connection)
         self.client_num_registered_event_handlers += 1
+        self.connection.queue_request(request)
 
     def service_connection(self, key, mask):
         message = key.data
         try:
             message.process_events(mask)
-            new_message = message.get_latest_text_from_server()
-            if new_message is not None and self.app.chat_window is not None:
-                self.app.chat_window.add_new_chat_line_to_log(new_message)
+            if message.resumed is not None:
+                self.finish_resume(message)
+            for room, new_message in message.get_latest_texts_from_server():
+                if self.threaded:
+                    self.received_chat_lines.append((room, new_message))
+                else:
+                    self.add_chat_line_to_log(room, new_message)
         except Exception:
-            print(
-                "main: error: exception for",
-                f"{message.addr}:\n{traceback.format_exc()}",
-            )
+            logger.exception("exception for %s", message.addr)
             message.close()
+            self.client_num_registered_event_handlers -= 1
+            if message.session_token is not None:
+                self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if self.reconnect_attempts >= RECONNECT_ATTEMPTS:
+            logger.error("giving up reconnecting to %s after %d attempts", (self.client_ip, self.network_port),
+                         self.reconnect_attempts)
+            self.reconnect_time = None
+            return
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2 ** self.reconnect_attempts)
+        self.reconnect_attempts += 1
+        self.reconnect_time = time.monotonic() + delay * random.uniform(0.5, 1.0)
+
+    def time_until_reconnect(self):
+        if self.reconnect_time is None:
+            return None
+        return max(0.0, self.reconnect_time - time.monotonic())
+
+    def reconnect_if_due(self):
+        if self.reconnect_time is None or time.monotonic() < self.reconnect_time:
+            return
+        self.reconnect_time = None
+        previous = self.connection
+        logger.info('Reconnecting to server, attempt %d', self.reconnect_attempts)
+        self.start_connection(self.client_ip, self.network_port, self.create_request('on_connection', self.client_ip))
+        # carried over so the session can be resumed again if this connection fails too
+        self.connection.session_token = previous.session_token
+        self.connection.last_sequences = previous.last_sequences
+        self.connection.queue_request(create_resume_request(previous.session_token, previous.last_sequences))
+        self.queue_outbound_requests()
 
-    def create_request(self, action, value):
-        if action == "send_message":
-            return dict(
-                type="text/json",
-                encoding="utf-8",
-                content=dict(action=action, value=value),
-            )
-        elif action == "on_connection":
-            return dict(
-                type="text/json",
-                encoding="utf-8",
-                content=dict(action=action, value=value),
-            )
-        elif action == "first_entry":
-            return dict(
-                type="text/json",
-                encoding="utf-8",
-                content=dict(action=action, value=value),
-            )
-        elif action == "change_name":
-            return dict(
-                type="text/json",
-                encoding="utf-8",
-                content=dict(action=action, value=value),
-            )
+    def finish_resume(self, message):
+        if not message.resumed:
+            # the server has restarted or kept us away too long, so enter the chat again as a new client
+            logger.info('Session expired, joining the chat again')
+            message.session_token = None
+            message.last_sequences = {}
+            if self.name is not None:
+                message.queue_request(self.create_request('first_entry', self.name))
+            # copied as the UI thread may be joining or leaving rooms
+            for room in list(self.rooms):
+                message.queue_request(self.create_request('join_room', room))
+        message.resumed = None
+        self.reconnect_attempts = 0
+
+    def add_chat_line_to_log(self, room, chat_line):
+        if self.app.chat_window is not None and self.app.chat_window.room_name == room:
+            self.app.chat_window.add_new_chat_line_to_log(chat_line)
+
+    def create_request(self, action, value, room=DEFAULT_ROOM):
+        return create_request(action, value, room)
+
+    def send_request(self, request):
+        # requests are queued on the one connection and sent in order, however quickly they are made
+        if self.threaded:
+            self.outbound_requests.append(request)
+            self.wake_network_thread()
+        elif self.reconnect_time is not None:
+            self.outbound_requests.append(request)
         else:
-            return dict(
-                type="binary/custom-client-binary-type",
-                encoding="binary",
-                content=bytes(action + value, encoding="utf-8"),
-            )
-
-    def send_chat_message(self, message):
-        request = self.create_request('send_message', message)
-        message = ClientMessage(self.client_selector, self.client_socket,
-                                (self.client_ip, self.network_port), request, self.app)
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.client_selector.modify(self.client_socket, events, data=message)
+            self.connection.queue_request(request)
+
+    def send_chat_message(self, message, room=DEFAULT_ROOM):
+        self.send_request(self.create_request('send_message', message, room))
+
+    def join_room(self, room):
+        self.rooms.add(room)
+        self.send_request(self.create_request('join_room', room))
+
+    def leave_room(self, room):
+        self.rooms.discard(room)
+        self.send_request(self.create_request('leave_room', room))
 
     def send_name_change(self, new_name):
-        request = self.create_request('change_name', new_name)
-        message = ClientMessage(self.client_selector, self.client_socket,
-                                (self.client_ip, self.network_port), request, self.app)
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.client_selector.modify(self.client_socket, events, data=message)
+        self.name = new_name
+        self.send_request(self.create_request('change_name', new_name))
 
     def first_entry(self, name):
-        request = self.create_request('first_entry', name)
-        message = ClientMessage(self.client_selector, self.client_socket,
-                                (self.client_ip, self.network_port), request, self.app)
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.client_selector.modify(self.client_socket, events, data=message)
+        self.name = name
+        self.send_request(self.create_request('first_entry', name))
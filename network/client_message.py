@@ -1,40 +1,87 @@
-import sys
+import logging
 import selectors
-import json
-import io
-import struct
+
+from network.framing import (PROTOCOL_V1, SUPPORTED_PROTOCOLS, SUPPORTED_COMPRESSION, COMPRESSION_THRESHOLD,
+                             FrameDecoder, encode_frame)
+from network.send_queue import SendQueue
+from network.rooms import DEFAULT_ROOM
 
 
 """
-I think this design is the wrong model for a chat server which works best with a continuous connection between client
-and server. This message model is more of a web browser style outlook where the server does not particularly care who
-is connecting.
+One ClientMessage lives for the whole connection to the server. Requests are queued in order and as many as the
+socket will take are written together, while everything the server sends is decoded from one continuous stream.
+
+It also keeps the session token the server gives it and the last sequence number seen in each room, which a new
+connection sends in a 'resume' request if this one drops.
 """
 
+logger = logging.getLogger(__name__)
+
+
+def create_request(action, value, room=DEFAULT_ROOM):
+    if action == "send_message":
+        content = dict(action=action, value=value)
+        if room != DEFAULT_ROOM:
+            content['room'] = room
+        return dict(
+            type="text/json",
+            encoding="utf-8",
+            content=content,
+        )
+    elif action == "on_connection":
+        return dict(
+            type="text/json",
+            encoding="utf-8",
+            content=dict(action=action, value=value, protocols=list(SUPPORTED_PROTOCOLS),
+                         compression=list(SUPPORTED_COMPRESSION), heartbeat=True, resume=True),
+        )
+    elif action == "first_entry":
+        return dict(
+            type="text/json",
+            encoding="utf-8",
+            content=dict(action=action, value=value),
+        )
+    elif action in ("change_name", "join_room", "leave_room", "ping", "pong"):
+        return dict(
+            type="text/json",
+            encoding="utf-8",
+            content=dict(action=action, value=value),
+        )
+    else:
+        return dict(
+            type="binary/custom-client-binary-type",
+            encoding="binary",
+            content=bytes(action + value, encoding="utf-8"),
+        )
+
+
+def create_resume_request(session_token, last_sequences):
+    return dict(
+        type="text/json",
+        encoding="utf-8",
+        content=dict(action="resume", value=session_token, last_seq=dict(last_sequences)),
+    )
+
 
 class ClientMessage:
-    def __init__(self, selector, sock, addr, request, app):
+    def __init__(self, selector, sock, addr, protocol=PROTOCOL_V1):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self.request = request
-        self.app = app
-
-        self._recv_buffer = b""
-        self._send_buffer = b""
-        self._request_queued = False
-        self._jsonheader_len = None
-        self.jsonheader = None
-        self.response = None
-        self.latest_text_from_server = None
+        # framing version, upgraded when the server answers our 'on_connection' request
+        self.protocol = protocol
+        # size above which requests are compressed, None until the server agrees to compression
+        self.compression_threshold = None
 
-    def clear_response_message_on_new_read(self):
-        # This is needed because a client message is kept open and used to read incomign messages
-        # until we send a new message. This is a bit weird.
-        self._jsonheader_len = None
-        self.jsonheader = None
+        self._frame_decoder = FrameDecoder()
+        self._send_queue = SendQueue()
         self.response = None
-        self.latest_text_from_server = None
+        self.latest_texts_from_server = []
+        # for resuming on a new connection: the token of the server session, room -> last sequence number seen, and
+        # the server's answer to a 'resume' request once it arrives
+        self.session_token = None
+        self.last_sequences = {}
+        self.resumed = None
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -51,63 +98,51 @@ class ClientMessage:
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            received = self._frame_decoder.recv_into(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not received:
                 raise RuntimeError("Peer closed.")
 
     def _write(self):
-        if self._send_buffer:
-            print("sending", repr(self._send_buffer), "to", self.addr)
+        if self._send_queue:
+            logger.debug("sending %d requests to %s", len(self._send_queue), self.addr)
             try:
-                # Should be ready to broadcast
-                sent = self.sock.send(self._send_buffer)
+                # Should be ready to write
+                self._send_queue.send(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
-            else:
-                self._send_buffer = self._send_buffer[sent:]
-
-    @staticmethod
-    def _json_encode(obj, encoding):
-        return json.dumps(obj, ensure_ascii=False).encode(encoding)
-
-    @staticmethod
-    def _json_decode(json_bytes, encoding):
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
-
-    def _create_message(
-        self, *, content_bytes, content_type, content_encoding
-    ):
-        jsonheader = {
-            "byteorder": sys.byteorder,
-            "content-type": content_type,
-            "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
-        }
-        jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
-        message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        return message_hdr + jsonheader_bytes + content_bytes
 
     def _process_response_json_content(self):
         content = self.response
+        if "protocol" in content:
+            self.protocol = content["protocol"]
+        if content.get("compression") in SUPPORTED_COMPRESSION:
+            self.compression_threshold = COMPRESSION_THRESHOLD
+        if content.get("action") == "ping":
+            self.queue_request(create_request("pong", content.get("value", "")))
+            return
+        if "session" in content:
+            self.session_token = content["session"]
+            return
+        if "resumed" in content:
+            self.resumed = bool(content["resumed"])
+            if self.resumed and not content.get("complete", True):
+                logger.warning("resumed the session with %s, but some messages sent while away were lost", self.addr)
+            return
+        room = content.get("room", DEFAULT_ROOM)
+        if isinstance(content.get("seq"), int):
+            self.last_sequences[room] = content["seq"]
         result = content.get("result")
-        print(f"got result: {result}")
-        self.latest_text_from_server = result
+        if result is not None:
+            self.latest_texts_from_server.append((room, result))
 
     def _process_response_binary_content(self):
         content = self.response
-        print(f"got response: {repr(content)}")
+        logger.debug("got response: %r", content)
 
     def process_events(self, mask):
         if mask & selectors.EVENT_READ:
@@ -116,118 +151,54 @@ class ClientMessage:
             self.write()
 
     def read(self):
-        self.clear_response_message_on_new_read()
         self._read()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
-
-        if self._jsonheader_len is not None and self.jsonheader is None:
-            self.process_jsonheader()
-
-        if self.jsonheader and self.response is None:
-            self.process_response()
+        for response in self._frame_decoder.frames():
+            self.process_response(response)
 
     def write(self):
-        if not self._request_queued:
-            self.queue_request()
-
         self._write()
 
-        if self._request_queued and not self._send_buffer:
-            # Set selector to listen for read events, we're done writing.
-            self._set_selector_events_mask("rw")
+        if self.sock is not None and not self._send_queue:
+            # Everything is sent, stop listening for write events until another request is queued.
+            self._set_selector_events_mask("r")
 
     def close(self):
-        print("closing connection to", self.addr)
+        logger.info("closing connection to %s", self.addr)
         try:
             self.selector.unregister(self.sock)
-            self.app.client_num_registered_event_handlers -= 1
         except Exception as e:
-            print(
-                f"error: selector.unregister() exception for",
-                f"{self.addr}: {repr(e)}",
-            )
+            logger.error("selector.unregister() exception for %s: %r", self.addr, e)
 
         try:
             self.sock.close()
         except OSError as e:
-            print(
-                f"error: socket.close() exception for",
-                f"{self.addr}: {repr(e)}",
-            )
+            logger.error("socket.close() exception for %s: %r", self.addr, e)
         finally:
             # Delete reference to socket object for garbage collection
             self.sock = None
 
-    def queue_request(self):
-        content = self.request["content"]
-        content_type = self.request["type"]
-        content_encoding = self.request["encoding"]
-        if content_type == "text/json":
-            req = {
-                "content_bytes": self._json_encode(content, content_encoding),
-                "content_type": content_type,
-                "content_encoding": content_encoding,
-            }
-        else:
-            req = {
-                "content_bytes": content,
-                "content_type": content_type,
-                "content_encoding": content_encoding,
-            }
-        message = self._create_message(**req)
-        self._send_buffer += message
-        self._request_queued = True
-
-    def process_protoheader(self):
-        hdrlen = 2
-        if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
-            )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-
-    def process_jsonheader(self):
-        hdrlen = self._jsonheader_len
-        if len(self._recv_buffer) >= hdrlen:
-            self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
-            )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-            for reqhdr in (
-                "byteorder",
-                "content-length",
-                "content-type",
-                "content-encoding",
-            ):
-                if reqhdr not in self.jsonheader:
-                    raise ValueError(f'Missing required header "{reqhdr}".')
-
-    def process_response(self):
-        content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
+    def queue_request(self, request):
+        if self.sock is None:
+            logger.warning("dropping request, connection to %s is closed", self.addr)
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
-        if self.jsonheader["content-type"] == "text/json":
-            encoding = self.jsonheader["content-encoding"]
-            self.response = self._json_decode(data, encoding)
-            print("received response", repr(self.response), "from", self.addr)
+        was_empty = not self._send_queue
+        self._send_queue.append(encode_frame(request, self.protocol, self.compression_threshold))
+        if was_empty:
+            self._set_selector_events_mask("rw")
+
+    def process_response(self, response):
+        self.response = response["content"]
+        if response["type"] == "text/json":
+            logger.debug("received response %r from %s", self.response, self.addr)
             self._process_response_json_content()
         else:
             # Binary or unknown content-type
-            self.response = data
-            print(
-                f'received {self.jsonheader["content-type"]} response from',
-                self.addr,
-            )
+            logger.debug("received %s response from %s", response["type"], self.addr)
             self._process_response_binary_content()
 
-    def get_latest_text_from_server(self):
-        if self.latest_text_from_server is not None:
-            result = self.latest_text_from_server
-            self.latest_text_from_server = None
-            return result
-        else:
-            return None
+    def get_latest_texts_from_server(self):
+        # (room, text) pairs received since the last call
+        results = self.latest_texts_from_server
+        self.latest_texts_from_server = []
+        return results
@@ -0,0 +1,99 @@
+from network.framing import PROTOCOL_V1
+
+
+"""
+The server's record of each connected client. A registry indexes the live connections by address, by file descriptor
+and by name, and a connection is removed from every index as soon as it closes, so broadcasts and lookups only ever
+touch clients that are still there.
+"""
+
+DEFAULT_NAME = "Dan"
+DEFAULT_COLOUR = '#FFFFFF'
+
+
+class Connection:
+    # __slots__ keeps each record small and stops typos creating new attributes, there is one per connected client
+    __slots__ = ('addr', 'fd', 'name', 'colour', 'protocol', 'compression_threshold', 'sequenced', 'answers_pings',
+                 'heartbeat', 'session', 'rate_limit', 'message')
+
+    def __init__(self, addr, fd, message=None):
+        self.addr = addr
+        self.fd = fd
+        self.name = DEFAULT_NAME
+        self.colour = DEFAULT_COLOUR
+        # framing version agreed with the client, old clients never negotiate so stay on version 1
+        self.protocol = PROTOCOL_V1
+        # size above which frames to the client are compressed, None unless the client agreed to compression
+        self.compression_threshold = None
+        # set when the client reads sequence numbers in compact frames, and the Session it can resume after a drop
+        self.sequenced = False
+        self.session = None
+        # set when the client agreed to answer pings, and the HeartbeatState the server keeps for it
+        self.answers_pings = False
+        self.heartbeat = None
+        # the ClientRateState of the client's token buckets, made with its first request when requests are limited
+        self.rate_limit = None
+        # the ServerMessage handling this connection's I/O, for the selectors based servers
+        self.message = message
+
+    @property
+    def frame_format(self):
+        # the encode_frame() arguments after the message for frames sent to this client, frames are shared between
+        # clients with the same format
+        return self.protocol, self.compression_threshold, self.sequenced
+
+    def __repr__(self):
+        return f'Connection({self.addr}, fd={self.fd}, name={self.name!r})'
+
+
+class ConnectionRegistry:
+    def __init__(self):
+        self._by_addr = {}
+        self._by_fd = {}
+        # name -> {address: connection}, names aren't unique as every client starts with the default one
+        self._by_name = {}
+
+    def __len__(self):
+        return len(self._by_addr)
+
+    def __iter__(self):
+        return iter(self._by_addr.values())
+
+    def __contains__(self, addr):
+        return addr in self._by_addr
+
+    def add(self, connection):
+        self._by_addr[connection.addr] = connection
+        self._by_fd[connection.fd] = connection
+        self._by_name.setdefault(connection.name, {})[connection.addr] = connection
+
+    def remove(self, addr):
+        # returns the removed connection, or None if it had already gone
+        connection = self._by_addr.pop(addr, None)
+        if connection is None:
+            return None
+        if self._by_fd.get(connection.fd) is connection:
+            del self._by_fd[connection.fd]
+        self._remove_name(connection)
+        return connection
+
+    def rename(self, connection, name):
+        if connection.addr in self._by_addr:
+            self._remove_name(connection)
+            self._by_name.setdefault(name, {})[connection.addr] = connection
+        connection.name = name
+
+    def _remove_name(self, connection):
+        named = self._by_name.get(connection.name)
+        if named is not None and named.pop(connection.addr, None) is not None and not named:
+            del self._by_name[connection.name]
+
+    def get(self, addr):
+        return self._by_addr.get(addr)
+
+    def by_fd(self, fd):
+        return self._by_fd.get(fd)
+
+    def by_name(self, name):
+        # the live connections using this name
+        return self._by_name.get(name, {}).values()
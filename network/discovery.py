@@ -0,0 +1,176 @@
+import logging
+import json
+import time
+import socket
+
+
+"""
+Finding chat servers on the local network without knowing their addresses.
+
+A server with a beacon broadcasts a small UDP datagram every second or so, giving its name, chat port, number of
+connected users and how busy its event loop is. Clients listen for these with a DiscoveryListener, which keeps the
+servers heard from recently so a server browser can list them, or a client can go straight to the least loaded one,
+without trying TCP connections to addresses that may not be there.
+
+Each worker of a sharded server sends its own beacon, and the listener adds them up into one entry for the server.
+"""
+
+logger = logging.getLogger(__name__)
+
+DISCOVERY_PORT = 25575
+BEACON_ADDRESS = '<broadcast>'
+BEACON_INTERVAL = 1.0
+# servers not heard from for this long are dropped from the list
+SERVER_TTL = 3.5
+BEACON_MAGIC = b'NCHAT1'
+MAX_BEACON_SIZE = 1024
+
+
+class ServerBeacon:
+    def __init__(self, name, port, address=BEACON_ADDRESS, discovery_port=DISCOVERY_PORT, interval=BEACON_INTERVAL,
+                 worker=None):
+        self.name = name
+        self.port = port
+        self.destination = (address, discovery_port)
+        self.interval = interval
+        # set for the workers of a sharded server, so listeners can tell their beacons apart
+        self.worker = worker
+        self.next_beacon_time = time.monotonic()
+        self.last_busy_seconds = None
+        self.last_beacon_time = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.setblocking(False)
+
+    def time_until_next_beacon(self):
+        return max(0.0, self.next_beacon_time - time.monotonic())
+
+    def update(self, users, busy_seconds):
+        # Sends a beacon if one is due. busy_seconds is the total time the event loop has spent handling I/O, the
+        # load advertised is the fraction of the time since the last beacon that it was busy.
+        now = time.monotonic()
+        if now < self.next_beacon_time:
+            return
+        load = 0.0
+        if self.last_beacon_time is not None and now > self.last_beacon_time:
+            load = min(1.0, (busy_seconds - self.last_busy_seconds) / (now - self.last_beacon_time))
+        self.last_busy_seconds = busy_seconds
+        self.last_beacon_time = now
+        self.next_beacon_time = now + self.interval
+        self.send(users, load)
+
+    def send(self, users, load):
+        beacon = {'name': self.name, 'port': self.port, 'users': users, 'load': round(load, 3)}
+        if self.worker is not None:
+            beacon['worker'] = self.worker
+        try:
+            self.sock.sendto(BEACON_MAGIC + json.dumps(beacon, separators=(",", ":")).encode('utf-8'),
+                             self.destination)
+        except OSError as e:
+            # no network, or the kernel buffer is full, the next beacon will try again
+            logger.debug("beacon to %s not sent: %r", self.destination, e)
+
+    def close(self):
+        self.sock.close()
+
+
+class DiscoveredServer:
+    __slots__ = ('address', 'port', 'name', 'users', 'load', 'last_seen')
+
+    def __init__(self, address, port, name, users, load, last_seen):
+        self.address = address
+        self.port = port
+        self.name = name
+        self.users = users
+        self.load = load
+        self.last_seen = last_seen
+
+    def __repr__(self):
+        return (f'DiscoveredServer({self.name!r}, {self.address}:{self.port}, users={self.users}, '
+                f'load={self.load})')
+
+
+def parse_beacon(data):
+    # returns the beacon as a dict, or None for anything that isn't a well formed beacon
+    if not data.startswith(BEACON_MAGIC):
+        return None
+    try:
+        beacon = json.loads(data[len(BEACON_MAGIC):].decode('utf-8'))
+    except ValueError:
+        return None
+    if (not isinstance(beacon, dict) or not isinstance(beacon.get('name'), str)
+            or not isinstance(beacon.get('port'), int) or not isinstance(beacon.get('users'), int)
+            or not isinstance(beacon.get('load'), (int, float))):
+        return None
+    return beacon
+
+
+class DiscoveryListener:
+    def __init__(self, port=DISCOVERY_PORT, ttl=SERVER_TTL, group=None):
+        # group is a multicast address to join, for servers sending their beacons to it rather than broadcasting
+        self.ttl = ttl
+        # (address, port, worker) -> (beacon, time received)
+        self._beacons = {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # lets several clients on the same machine listen for beacons at once
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind(('', port))
+        if group is not None:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                 socket.inet_aton(group) + socket.inet_aton('0.0.0.0'))
+        self.sock.setblocking(False)
+
+    def poll(self):
+        # Takes in every beacon waiting on the socket without blocking, returns True if any arrived.
+        received = False
+        while True:
+            try:
+                data, (address, _) = self.sock.recvfrom(MAX_BEACON_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logger.debug("discovery socket error: %r", e)
+                break
+            beacon = parse_beacon(data)
+            if beacon is not None:
+                self._beacons[(address, beacon['port'], beacon.get('worker'))] = (beacon, time.monotonic())
+                received = True
+        return received
+
+    def expire(self):
+        # Forgets servers that have gone quiet, returns True if any were dropped.
+        oldest = time.monotonic() - self.ttl
+        expired = [key for key, (_, received_time) in self._beacons.items() if received_time < oldest]
+        for key in expired:
+            del self._beacons[key]
+        return bool(expired)
+
+    def servers(self):
+        # The servers heard from within the TTL, least loaded first. The workers of a sharded server are combined:
+        # their users are added up and their loads averaged.
+        self.expire()
+        servers = {}
+        workers = {}
+        for (address, port, _), (beacon, received_time) in self._beacons.items():
+            server = servers.get((address, port))
+            if server is None:
+                servers[(address, port)] = DiscoveredServer(address, port, beacon['name'], beacon['users'],
+                                                            beacon['load'], received_time)
+                workers[(address, port)] = 1
+            else:
+                server.users += beacon['users']
+                server.load += beacon['load']
+                server.last_seen = max(server.last_seen, received_time)
+                workers[(address, port)] += 1
+        for key, server in servers.items():
+            server.load /= workers[key]
+        return sorted(servers.values(), key=lambda server: (server.load, server.users))
+
+    def best_server(self):
+        servers = self.servers()
+        return servers[0] if servers else None
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,361 @@
+import sys
+import json
+import io
+import zlib
+import struct
+
+
+"""
+Wire formats shared by the client and the server engines.
+
+Version 1 frames are a 2 byte big endian length, a JSON header describing the content and then the content itself.
+
+Version 2 frames replace the JSON header with a fixed 6 byte struct: a byte holding the version 2 marker and a type
+code, a flags byte and a 4 byte big endian content length. The content is encoded compactly for the common chat
+shapes, a bare 'result' string or an action request, either of them optionally for a named room, and falls back to
+compact JSON or raw bytes otherwise. The first byte of a version 2 frame is always 0xF0 or above, which no version 1
+JSON header length can start with, so both versions can be told apart frame by frame on the same connection.
+
+Version 2 content can also be compressed with raw deflate, primed with a dictionary of the HTML every chat line is
+wrapped in, which the compressed flag marks. Compression is only used when both ends agreed to it at connect and only
+for content above a size threshold, though either end can always decode a compressed frame.
+
+Broadcasts to a room carry the room's sequence number as a 'seq' key. In the compact version 2 encodings it is sent as
+a varint prefix to the content, which the sequenced flag marks, but only to clients that said at connect that they
+read it. Other version 2 clients get the compact frame without it.
+"""
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+SUPPORTED_PROTOCOLS = (PROTOCOL_V1, PROTOCOL_V2)
+
+PROTOHEADER_LENGTH = 2
+REQUIRED_JSON_HEADERS = ("byteorder", "content-length", "content-type", "content-encoding")
+
+V2_HEADER = struct.Struct(">BBI")
+V2_MARKER = 0xF0
+V2_TYPE_MASK = 0x0F
+V2_TYPE_JSON = 0
+V2_TYPE_BINARY = 1
+V2_TYPE_RESULT = 2
+V2_TYPE_ACTION = 3
+V2_TYPE_ROOM_RESULT = 4
+V2_TYPE_ROOM_ACTION = 5
+V2_BINARY_CONTENT_TYPE = "binary/custom-binary-type"
+V2_FLAG_COMPRESSED = 0x01
+V2_FLAG_SEQUENCED = 0x02
+
+# longest content either version can carry, a header asking for more is refused before any buffer is grown for it
+MAX_FRAME_LENGTH = 64 * 1024 * 1024
+
+SUPPORTED_COMPRESSION = ("deflate",)
+# content shorter than this is sent as it is, the dictionary lets even a short chat line shrink by half
+COMPRESSION_THRESHOLD = 32
+# compressed content can't unpack to more than an uncompressed frame could hold
+MAX_DECOMPRESSED_LENGTH = MAX_FRAME_LENGTH
+# a 4 KiB window and a smaller memory level make setting up a compressor for each frame much cheaper, chat frames
+# are small enough that a bigger window barely helps
+COMPRESSION_WBITS = -12
+COMPRESSION_MEM_LEVEL = 5
+# deflate finds matches for the end of the dictionary most cheaply, so the most common strings go last
+COMPRESSION_DICTIONARY = (b'Error: you are not in this room. Name successfully changed to  has left  has joined '
+                          b' has entered the chat...</font><font color=#><b>&lt;&gt;</b> ')
+
+ACTION_CODES = {"on_connection": 1, "first_entry": 2, "send_message": 3, "change_name": 4, "quit": 5,
+                "join_room": 6, "leave_room": 7, "ping": 8, "pong": 9}
+ACTIONS_BY_CODE = {code: action for action, code in ACTION_CODES.items()}
+
+
+def json_encode(obj, encoding):
+    return json.dumps(obj, ensure_ascii=False).encode(encoding)
+
+
+def json_decode(json_bytes, encoding):
+    tiow = io.TextIOWrapper(
+        io.BytesIO(json_bytes), encoding=encoding, newline=""
+    )
+    obj = json.load(tiow)
+    tiow.close()
+    return obj
+
+
+def create_message(*, content_bytes, content_type, content_encoding):
+    jsonheader = {
+        "byteorder": sys.byteorder,
+        "content-type": content_type,
+        "content-encoding": content_encoding,
+        "content-length": len(content_bytes),
+    }
+    jsonheader_bytes = json_encode(jsonheader, "utf-8")
+    message_hdr = struct.pack(">H", len(jsonheader_bytes))
+    return message_hdr + jsonheader_bytes + content_bytes
+
+
+def check_json_header(jsonheader):
+    for reqhdr in REQUIRED_JSON_HEADERS:
+        if reqhdr not in jsonheader:
+            raise ValueError(f'Missing required header "{reqhdr}".')
+
+
+def is_v2_frame(first_byte):
+    return first_byte >= V2_MARKER
+
+
+def check_content_length(content_length):
+    if not isinstance(content_length, int) or not 0 <= content_length <= MAX_FRAME_LENGTH:
+        raise ValueError(f"Invalid frame content length {content_length!r}, the limit is {MAX_FRAME_LENGTH} bytes.")
+
+
+def create_message_v2(content_bytes, type_code, flags=0):
+    return V2_HEADER.pack(V2_MARKER | type_code, flags, len(content_bytes)) + content_bytes
+
+
+def encode_v2_content(content_type, content):
+    if content_type != "text/json":
+        return V2_TYPE_BINARY, content
+    # a room name goes in front of the content, prefixed with its length in one byte
+    room_prefix = b""
+    num_keys = len(content)
+    if isinstance(content.get("seq"), int):
+        # left to encode_frame(), which prefixes it for clients that read it
+        num_keys -= 1
+    if isinstance(content.get("room"), str):
+        room_bytes = content["room"].encode("utf-8")
+        if len(room_bytes) <= 0xFF:
+            room_prefix = bytes((len(room_bytes),)) + room_bytes
+            num_keys -= 1
+    if num_keys == 1 and isinstance(content.get("result"), str):
+        type_code = V2_TYPE_ROOM_RESULT if room_prefix else V2_TYPE_RESULT
+        return type_code, room_prefix + content["result"].encode("utf-8")
+    if (num_keys == 2 and content.get("action") in ACTION_CODES
+            and isinstance(content.get("value"), str)):
+        type_code = V2_TYPE_ROOM_ACTION if room_prefix else V2_TYPE_ACTION
+        return type_code, room_prefix + bytes((ACTION_CODES[content["action"]],)) + content["value"].encode("utf-8")
+    return V2_TYPE_JSON, json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_varint(number):
+    # 7 bits to a byte, least significant first, with the top bit set on every byte but the last
+    varint = bytearray()
+    while number > 0x7F:
+        varint.append(0x80 | (number & 0x7F))
+        number >>= 7
+    varint.append(number)
+    return bytes(varint)
+
+
+def decode_varint(data):
+    # Returns the number at the start of data and the length of its varint.
+    number = 0
+    for position, byte in enumerate(data):
+        number |= (byte & 0x7F) << (7 * position)
+        if not byte & 0x80:
+            return number, position + 1
+    raise ValueError("Truncated varint.")
+
+
+def compress_content(content_bytes):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, COMPRESSION_WBITS, COMPRESSION_MEM_LEVEL,
+                                  zdict=COMPRESSION_DICTIONARY)
+    return compressor.compress(content_bytes) + compressor.flush()
+
+
+def decompress_content(data):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=COMPRESSION_DICTIONARY)
+    try:
+        content_bytes = decompressor.decompress(data, MAX_DECOMPRESSED_LENGTH)
+    except zlib.error as e:
+        raise ValueError(f"Invalid compressed content: {e}")
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Compressed content is over {MAX_DECOMPRESSED_LENGTH} bytes.")
+    return content_bytes
+
+
+def split_v2_room(data):
+    room_end = 1 + data[0]
+    return str(data[1:room_end], "utf-8"), data[room_end:]
+
+
+def decode_v2_content(type_code, data):
+    if type_code == V2_TYPE_RESULT:
+        return {"result": str(data, "utf-8")}
+    elif type_code == V2_TYPE_ACTION:
+        return {"action": ACTIONS_BY_CODE[data[0]], "value": str(data[1:], "utf-8")}
+    elif type_code == V2_TYPE_ROOM_RESULT:
+        room, data = split_v2_room(data)
+        return {"result": str(data, "utf-8"), "room": room}
+    elif type_code == V2_TYPE_ROOM_ACTION:
+        room, data = split_v2_room(data)
+        return {"action": ACTIONS_BY_CODE[data[0]], "value": str(data[1:], "utf-8"), "room": room}
+    elif type_code == V2_TYPE_JSON:
+        return json.loads(str(data, "utf-8"))
+    elif type_code == V2_TYPE_BINARY:
+        return bytes(data)
+    else:
+        raise ValueError(f"Invalid version 2 frame type {type_code}.")
+
+
+def process_v2_header(buffer, offset=0):
+    # Returns a JSON style header for the version 2 frame starting at offset so that the version 1 processing code
+    # can read the content that follows it.
+    marker_and_type, flags, content_length = V2_HEADER.unpack_from(buffer, offset)
+    if flags & ~(V2_FLAG_COMPRESSED | V2_FLAG_SEQUENCED):
+        raise ValueError(f"Unsupported version 2 frame flags {flags}.")
+    type_code = marker_and_type & V2_TYPE_MASK
+    binary = type_code == V2_TYPE_BINARY
+    return {
+        "content-type": V2_BINARY_CONTENT_TYPE if binary else "text/json",
+        "content-encoding": "binary" if binary else "utf-8",
+        "content-length": content_length,
+        "protocol": PROTOCOL_V2,
+        "v2-type": type_code,
+        "v2-compressed": bool(flags & V2_FLAG_COMPRESSED),
+        "v2-sequenced": bool(flags & V2_FLAG_SEQUENCED),
+    }
+
+
+def encode_frame(message, protocol=PROTOCOL_V1, compression_threshold=None, sequenced=False):
+    # message is a dict of 'type', 'encoding' and 'content', the same shape as the requests built by the client.
+    # Version 2 content of at least compression_threshold bytes is compressed, if that makes it any smaller, and a
+    # sequence number is only kept in compact content when sequenced is set.
+    content = message["content"]
+    content_type = message["type"]
+    content_encoding = message["encoding"]
+    if protocol == PROTOCOL_V2:
+        type_code, content_bytes = encode_v2_content(content_type, content)
+        flags = 0
+        if sequenced and type_code not in (V2_TYPE_JSON, V2_TYPE_BINARY) and isinstance(content.get("seq"), int):
+            content_bytes = encode_varint(content["seq"]) + content_bytes
+            flags = V2_FLAG_SEQUENCED
+        if compression_threshold is not None and len(content_bytes) >= compression_threshold:
+            compressed_bytes = compress_content(content_bytes)
+            if len(compressed_bytes) < len(content_bytes):
+                return create_message_v2(compressed_bytes, type_code, flags | V2_FLAG_COMPRESSED)
+        return create_message_v2(content_bytes, type_code, flags)
+    if content_type == "text/json":
+        content_bytes = json_encode(content, content_encoding)
+    else:
+        content_bytes = content
+    return create_message(content_bytes=content_bytes, content_type=content_type,
+                          content_encoding=content_encoding)
+
+
+def decode_frame(buffer, offset=0, end=None):
+    # Decodes one complete frame of either version starting at offset. Returns the frame as a message dict and the
+    # offset just past it, or None and the unchanged offset if the frame has not been fully received yet.
+    if end is None:
+        end = len(buffer)
+    available = end - offset
+    if available < 1:
+        return None, offset
+    if is_v2_frame(buffer[offset]):
+        if available < V2_HEADER.size:
+            return None, offset
+        jsonheader = process_v2_header(buffer, offset)
+        content_start = offset + V2_HEADER.size
+    else:
+        if available < PROTOHEADER_LENGTH:
+            return None, offset
+        jsonheader_len = struct.unpack_from(">H", buffer, offset)[0]
+        jsonheader_start = offset + PROTOHEADER_LENGTH
+        content_start = jsonheader_start + jsonheader_len
+        if end < content_start:
+            return None, offset
+        jsonheader = json_decode(bytes(buffer[jsonheader_start:content_start]), "utf-8")
+        check_json_header(jsonheader)
+    check_content_length(jsonheader["content-length"])
+    content_end = content_start + jsonheader["content-length"]
+    if end < content_end:
+        return None, offset
+    return decode_content(jsonheader, buffer[content_start:content_end]), content_end
+
+
+def frame_length_needed(buffer, offset, end):
+    # Total length of the frame starting at offset if its header has arrived, otherwise the header length needed.
+    available = end - offset
+    if available >= 1 and is_v2_frame(buffer[offset]):
+        if available < V2_HEADER.size:
+            return V2_HEADER.size
+        content_length = V2_HEADER.unpack_from(buffer, offset)[2]
+        check_content_length(content_length)
+        return V2_HEADER.size + content_length
+    if available < PROTOHEADER_LENGTH:
+        return PROTOHEADER_LENGTH
+    # a version 1 content length is only known once the JSON header is decoded, so just ask for the JSON header
+    return PROTOHEADER_LENGTH + struct.unpack_from(">H", buffer, offset)[0]
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for a stream of frames of either version.
+
+    Data is received straight into one reusable bytearray and decoded in place through memoryviews. Every complete
+    frame in the buffer is decoded on each pass and a partially received frame stays in the buffer until the rest of
+    it arrives. Unread bytes are only moved back to the start of the buffer when there is no room left at the end.
+    """
+    def __init__(self, initial_size=8192):
+        self._buffer = bytearray(initial_size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _reserve(self, size):
+        # make room for at least size more bytes after the end of the buffered data
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if self._start > 0:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start = 0
+            self._end = pending
+        if len(self._buffer) - self._end < size:
+            self._buffer.extend(bytes(max(size - (len(self._buffer) - self._end), len(self._buffer))))
+
+    def recv_into(self, sock, size=4096):
+        # Reads up to size bytes from the socket straight into the buffer, returns the number of bytes read.
+        with memoryview(self._buffer) as view:
+            needed = frame_length_needed(view, self._start, self._end)
+        self._reserve(max(size, needed - (self._end - self._start)))
+        with memoryview(self._buffer) as view:
+            received = sock.recv_into(view[self._end:])
+        self._end += received
+        return received
+
+    def feed(self, data):
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def frames(self):
+        # Decodes every complete frame that is buffered, returned as a list of message dicts.
+        messages = []
+        with memoryview(self._buffer) as view:
+            while self._start < self._end:
+                message, self._start = decode_frame(view, self._start, self._end)
+                if message is None:
+                    break
+                messages.append(message)
+        if self._start == self._end:
+            self._start = 0
+            self._end = 0
+        return messages
+
+
+def decode_content(jsonheader, data):
+    # data may be a memoryview into a receive buffer, so anything kept from it is copied out
+    if jsonheader.get("protocol") == PROTOCOL_V2:
+        if jsonheader["v2-compressed"]:
+            data = decompress_content(data)
+        if jsonheader["v2-sequenced"]:
+            sequence, varint_length = decode_varint(data)
+            content = decode_v2_content(jsonheader["v2-type"], data[varint_length:])
+            content["seq"] = sequence
+        else:
+            content = decode_v2_content(jsonheader["v2-type"], data)
+    elif jsonheader["content-type"] == "text/json":
+        content = json_decode(data, jsonheader["content-encoding"])
+    else:
+        content = bytes(data)
+    return dict(type=jsonheader["content-type"], encoding=jsonheader["content-encoding"], content=content)
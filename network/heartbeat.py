@@ -0,0 +1,101 @@
+import logging
+import time
+
+from network.timer_wheel import TimerWheel
+
+
+"""
+Finding connections whose client has gone away without the TCP connection being closed, such as a client that
+crashed or a laptop that left the network, so they stop being sent every broadcast.
+
+A connection has to send its 'on_connection' handshake within the handshake timeout. After that, clients that agreed
+to heartbeats are pinged once they have been quiet for the ping interval and closed if nothing at all arrives within
+the pong timeout. Older clients can't answer pings, so their sockets get TCP keepalives instead and the kernel
+reports the connection broken.
+
+Every connection has one timer on a TimerWheel. Receiving a frame only records the time, and the timer works out
+when it fires whether the connection was active in the meantime, so a busy connection costs one timer firing per
+ping interval rather than a reschedule per frame.
+"""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PING_INTERVAL = 15.0
+DEFAULT_PONG_TIMEOUT = 10.0
+DEFAULT_HANDSHAKE_TIMEOUT = 10.0
+TIMEOUT_REASONS = ('handshake', 'pong')
+
+
+class HeartbeatSettings:
+    def __init__(self, ping_interval=DEFAULT_PING_INTERVAL, pong_timeout=DEFAULT_PONG_TIMEOUT,
+                 handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT):
+        if ping_interval <= 0 or pong_timeout <= 0 or handshake_timeout <= 0:
+            raise ValueError("Heartbeat intervals and timeouts must be above zero.")
+        self.ping_interval = ping_interval
+        self.pong_timeout = pong_timeout
+        self.handshake_timeout = handshake_timeout
+
+
+class HeartbeatState:
+    __slots__ = ('last_received', 'handshake_done', 'ping_sent_time', 'timer')
+
+    def __init__(self, now):
+        self.last_received = now
+        self.handshake_done = False
+        # when the unanswered ping was sent, None when no ping is waiting for an answer
+        self.ping_sent_time = None
+        self.timer = None
+
+
+class HeartbeatMonitor:
+    def __init__(self, settings, send_ping, close, wheel=None):
+        # send_ping(connection) and close(connection) are supplied by the server engine
+        self.settings = settings
+        self.send_ping = send_ping
+        self.close = close
+        self.wheel = wheel if wheel is not None else TimerWheel()
+        self.timeouts = {reason: 0 for reason in TIMEOUT_REASONS}
+
+    def watch(self, connection):
+        connection.heartbeat = HeartbeatState(time.monotonic())
+        connection.heartbeat.timer = self.wheel.schedule(self.settings.handshake_timeout, self._check, connection)
+
+    def forget(self, connection):
+        if connection.heartbeat is not None:
+            connection.heartbeat.timer.cancel()
+            connection.heartbeat = None
+
+    def handshake_done(self, connection):
+        if connection.heartbeat is None:
+            return
+        connection.heartbeat.handshake_done = True
+        connection.heartbeat.timer.cancel()
+        if connection.answers_pings:
+            connection.heartbeat.timer = self.wheel.schedule(self.settings.ping_interval, self._check, connection)
+
+    def _check(self, connection):
+        state = connection.heartbeat
+        if state is None:
+            return
+        now = time.monotonic()
+        if not state.handshake_done:
+            self._time_out(connection, 'handshake')
+            return
+        if state.ping_sent_time is not None:
+            if state.last_received < state.ping_sent_time:
+                self._time_out(connection, 'pong')
+                return
+            state.ping_sent_time = None
+        quiet_time = now - state.last_received
+        if quiet_time >= self.settings.ping_interval:
+            state.ping_sent_time = now
+            self.send_ping(connection)
+            state.timer = self.wheel.schedule(self.settings.pong_timeout, self._check, connection)
+        else:
+            state.timer = self.wheel.schedule(self.settings.ping_interval - quiet_time, self._check, connection)
+
+    def _time_out(self, connection, reason):
+        self.timeouts[reason] += 1
+        logger.info("closing connection to %s, no %s within the timeout", connection.addr, reason)
+        self.forget(connection)
+        self.close(connection)
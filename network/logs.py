@@ -0,0 +1,80 @@
+import time
+import queue
+import logging
+import logging.handlers
+
+
+"""
+Logging set up for the chat client and servers.
+
+Every module logs through logging.getLogger(__name__) with %-style arguments, so a message below the configured level
+costs one level check and is never formatted. Per message tracing, such as each request received or frame sent, is
+logged at DEBUG. Connection events are logged at INFO and problems at WARNING and above.
+
+configure_logging() can also rate limit each kind of message and hand records to a background thread to write out,
+so a slow terminal or disk doesn't hold up the event loop.
+"""
+
+DEFAULT_RATE_LIMIT = 20
+DEFAULT_RATE_INTERVAL = 1.0
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most rate_limit records of each category every interval seconds. A record's category is the
+    logger it came from and its unformatted message, so each logging call is limited separately. When a category
+    is let through again the first record notes how many were dropped in between.
+    """
+    def __init__(self, rate_limit=DEFAULT_RATE_LIMIT, interval=DEFAULT_RATE_INTERVAL):
+        super().__init__()
+        self.rate_limit = rate_limit
+        self.interval = interval
+        # category -> [start of the current interval, records let through in it, records suppressed]
+        self._categories = {}
+
+    def filter(self, record):
+        now = time.monotonic()
+        category = (record.name, record.msg)
+        state = self._categories.get(category)
+        if state is None or now - state[0] >= self.interval:
+            suppressed = state[2] if state is not None else 0
+            self._categories[category] = [now, 1, 0]
+            if suppressed:
+                record.msg = f'{record.msg} (suppressed {suppressed} similar messages)'
+            return True
+        if state[1] < self.rate_limit:
+            state[1] += 1
+            return True
+        state[2] += 1
+        return False
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler formats each record before queueing it, this leaves that to the listener thread as well. Records
+    # never leave the process, so their arguments don't need to be made picklable.
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(level=logging.INFO, rate_limit=DEFAULT_RATE_LIMIT, rate_interval=DEFAULT_RATE_INTERVAL,
+                      queued=False, stream=None):
+    # Sets up the root logger. Returns a QueueListener when queued is set, which should be stopped on exit so the
+    # last records are written out.
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(rate_limit, rate_interval))
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    for old_handler in list(root_logger.handlers):
+        root_logger.removeHandler(old_handler)
+    if not queued:
+        root_logger.addHandler(handler)
+        return None
+    # the logging call only puts the record on a queue, formatting, filtering and writing happen on the listener thread
+    log_queue = queue.SimpleQueue()
+    root_logger.addHandler(DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
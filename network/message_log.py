@@ -0,0 +1,250 @@
+import logging
+import math
+import os
+import mmap
+import time
+import struct
+import bisect
+from array import array
+
+from network.framing import PROTOCOL_V1, decode_frame, encode_frame
+
+
+"""
+Durable chat history, so that clients joining a room can be sent what was said in it before they arrived.
+
+Broadcast frames are appended to a log split into segments. Each segment is a pair of files named after the sequence
+number of its first message: a .log file of records, each the frame length and room name length, the room name and
+then the version 1 frame, and a .index file of fixed size entries giving the offset of each record in the .log file and
+the time it was logged. A message's sequence number is its segment's first sequence number plus its position in the
+index, so finding any message is a lookup rather than a search. Both files are memory mapped for reading. Each
+segment also keeps the positions of every room's records in memory, rebuilt from the files when the server starts, so
+replaying a room's history reads only that room's records however busy the other rooms are.
+
+A new segment is started once the newest one passes the segment size, and the oldest segments are deleted to keep
+the number of segments bounded.
+"""
+
+logger = logging.getLogger(__name__)
+
+INDEX_ENTRY = struct.Struct(">Qd")
+RECORD_HEADER = struct.Struct(">IH")
+
+DEFAULT_SEGMENT_BYTES = 8 * 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 8
+DEFAULT_REPLAY_LINES = 50
+
+
+class LogSegment:
+    def __init__(self, directory, first_sequence):
+        self.first_sequence = first_sequence
+        base_path = os.path.join(directory, f"{first_sequence:020d}")
+        self.log_path = base_path + ".log"
+        self.index_path = base_path + ".index"
+        self.log_file = open(self.log_path, "a+b")
+        self.index_file = open(self.index_path, "a+b")
+        self._log_map = None
+        self._index_map = None
+        self.num_records = 0
+        self.log_size = 0
+        # room name bytes -> positions in the index of the room's records, oldest first
+        self.room_positions = {}
+        self._recover()
+
+    def _recover(self):
+        # drops anything past the last record that was completely written before the server stopped
+        log_file_size = os.path.getsize(self.log_path)
+        self.num_records = os.path.getsize(self.index_path) // INDEX_ENTRY.size
+        self.log_size = log_file_size
+        while self.num_records:
+            # records are back to back, so the last entry must point just past the record before it
+            offset, _ = self.index_entry(self.num_records - 1)
+            try:
+                expected_offset = 0
+                if self.num_records > 1:
+                    expected_offset = self._record_end(self.index_entry(self.num_records - 2)[0])
+                if offset == expected_offset and self._record_end(offset) <= log_file_size:
+                    self.log_size = self._record_end(offset)
+                    break
+            except struct.error:
+                # the entry points past the end of the .log file
+                pass
+            self.num_records -= 1
+        else:
+            self.log_size = 0
+        self._close_maps()
+        self.index_file.truncate(self.num_records * INDEX_ENTRY.size)
+        self.log_file.truncate(self.log_size)
+        for position in range(self.num_records):
+            self._add_room_position(self.record_room(self.index_entry(position)[0]), position)
+
+    def _add_room_position(self, room_bytes, position):
+        positions = self.room_positions.get(room_bytes)
+        if positions is None:
+            positions = self.room_positions[room_bytes] = array("I")
+        positions.append(position)
+
+    def _record_end(self, offset):
+        frame_length, room_length = RECORD_HEADER.unpack_from(self._log_view(), offset)
+        return offset + RECORD_HEADER.size + room_length + frame_length
+
+    def _log_view(self):
+        # the mapping is only replaced when records have been appended since it was made
+        if self._log_map is None or len(self._log_map) < self.log_size:
+            if self._log_map is not None:
+                self._log_map.close()
+            self._log_map = mmap.mmap(self.log_file.fileno(), self.log_size, access=mmap.ACCESS_READ)
+        return self._log_map
+
+    def _index_view(self):
+        index_size = self.num_records * INDEX_ENTRY.size
+        if self._index_map is None or len(self._index_map) < index_size:
+            if self._index_map is not None:
+                self._index_map.close()
+            self._index_map = mmap.mmap(self.index_file.fileno(), index_size, access=mmap.ACCESS_READ)
+        return self._index_map
+
+    def _close_maps(self):
+        for mapping in (self._log_map, self._index_map):
+            if mapping is not None:
+                mapping.close()
+        self._log_map = None
+        self._index_map = None
+
+    def append(self, room_bytes, frame, timestamp, fsync=False):
+        offset = self.log_size
+        # the record is written before its index entry, so an index entry always points at a whole record
+        self.log_file.write(RECORD_HEADER.pack(len(frame), len(room_bytes)))
+        self.log_file.write(room_bytes)
+        self.log_file.write(frame)
+        self.log_file.flush()
+        self.index_file.write(INDEX_ENTRY.pack(offset, timestamp))
+        self.index_file.flush()
+        if fsync:
+            os.fsync(self.log_file.fileno())
+            os.fsync(self.index_file.fileno())
+        self.log_size = offset + RECORD_HEADER.size + len(room_bytes) + len(frame)
+        self._add_room_position(room_bytes, self.num_records)
+        self.num_records += 1
+
+    def index_entry(self, position):
+        # the offset of a record in the .log file and the time it was logged
+        return INDEX_ENTRY.unpack_from(self._index_view(), position * INDEX_ENTRY.size)
+
+    def record_room(self, offset):
+        frame_length, room_length = RECORD_HEADER.unpack_from(self._log_view(), offset)
+        room_start = offset + RECORD_HEADER.size
+        return self._log_view()[room_start:room_start + room_length]
+
+    def record_frame(self, offset):
+        frame_length, room_length = RECORD_HEADER.unpack_from(self._log_view(), offset)
+        frame_start = offset + RECORD_HEADER.size + room_length
+        return self._log_view()[frame_start:frame_start + frame_length]
+
+    def close(self):
+        self._close_maps()
+        self.log_file.close()
+        self.index_file.close()
+
+    def delete(self):
+        self.close()
+        os.remove(self.log_path)
+        os.remove(self.index_path)
+
+
+class MessageLog:
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, max_segments=DEFAULT_MAX_SEGMENTS,
+                 replay_lines=DEFAULT_REPLAY_LINES, fsync=False):
+        if max_segments < 1:
+            raise ValueError("A message log needs at least one segment.")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        # how many messages a client joining a room is sent when it doesn't ask for a number
+        self.replay_lines = replay_lines
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        first_sequences = sorted(int(name[:-len(".log")]) for name in os.listdir(directory)
+                                 if name.endswith(".log") and name[:-len(".log")].isdigit())
+        self.segments = [LogSegment(directory, first_sequence) for first_sequence in first_sequences]
+        if not self.segments:
+            self.segments.append(LogSegment(directory, 0))
+        logger.info('Message history in %s holds %d messages', directory, self.next_sequence - self.first_sequence)
+
+    @property
+    def first_sequence(self):
+        return self.segments[0].first_sequence
+
+    @property
+    def next_sequence(self):
+        newest = self.segments[-1]
+        return newest.first_sequence + newest.num_records
+
+    def append(self, room, frame, timestamp=None):
+        # Logs a version 1 frame broadcast to a room, returns its sequence number.
+        if self.segments[-1].log_size >= self.segment_bytes:
+            self.rotate()
+        sequence = self.next_sequence
+        self.segments[-1].append(room.encode("utf-8"), frame, time.time() if timestamp is None else timestamp,
+                                 self.fsync)
+        return sequence
+
+    def rotate(self):
+        self.segments.append(LogSegment(self.directory, self.next_sequence))
+        while len(self.segments) > self.max_segments:
+            self.segments.pop(0).delete()
+
+    def read(self, sequence):
+        # Returns the frame logged with a sequence number, or None if it has been rotated away or not logged yet.
+        if not self.first_sequence <= sequence < self.next_sequence:
+            return None
+        segment = self.segments[bisect.bisect_right([s.first_sequence for s in self.segments], sequence) - 1]
+        offset, _ = segment.index_entry(sequence - segment.first_sequence)
+        return segment.record_frame(offset)
+
+    def replay(self, room, last=None, since=None):
+        # Returns the frames most recently logged for a room, oldest first: no more than last of them, defaulting to
+        # replay_lines, and none logged before the time since.
+        if last is None:
+            last = self.replay_lines
+        room_bytes = room.encode("utf-8")
+        frames = []
+        for segment in reversed(self.segments):
+            positions = segment.room_positions.get(room_bytes, ())
+            for position in reversed(positions):
+                if len(frames) >= last:
+                    break
+                offset, timestamp = segment.index_entry(position)
+                if since is not None and timestamp < since:
+                    break
+                frames.append(segment.record_frame(offset))
+            else:
+                continue
+            break
+        frames.reverse()
+        return frames
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+def request_number(value):
+    # a number from a client's request, or None for anything else, including booleans, NaN and infinities
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def history_frames(history, room, protocol=PROTOCOL_V1, compression_threshold=None, sequenced=False, last=None,
+                   since=None):
+    # The frames to send a client joining a room, in the client's frame format, see Connection.frame_format. last
+    # and since are as the client asked for them, a client can't ask for more than replay_lines messages.
+    last = request_number(last)
+    last = history.replay_lines if last is None else max(0, min(int(last), history.replay_lines))
+    frames = history.replay(room, last, request_number(since))
+    if protocol == PROTOCOL_V1:
+        return frames
+    return [encode_frame(decode_frame(frame)[0], protocol, compression_threshold, sequenced) for frame in frames]
@@ -0,0 +1,189 @@
+import logging
+import bisect
+import threading
+
+
+"""
+Runtime metrics for the chat servers, rendered in the Prometheus text exposition format.
+
+The servers update the metrics from their event loop and a small HTTP listener serves them from its own thread, so a
+scrape never waits on the chat traffic. Values are only ever replaced or incremented, which is safe to read from
+another thread in CPython.
+"""
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0)
+QUEUE_DEPTH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, function=None):
+        # function, when given, is called for the value each time the counter is rendered
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        value = self.function() if self.function is not None else self.value
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter', f'{self.name} {value}']
+
+
+class Gauge:
+    def __init__(self, name, help_text, function=None):
+        # function, when given, is called for the value each time the gauge is rendered
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def render(self):
+        value = self.function() if self.function is not None else self.value
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge', f'{self.name} {value}']
+
+
+class LabelledCounter:
+    # counters of the same thing split by one label, read from a dict kept elsewhere such as SendLimits
+    def __init__(self, name, help_text, label, function):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.function = function
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        for label_value, value in self.function().items():
+            lines.append(f'{self.name}{format_labels({self.label: label_value})} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        # one count per bucket plus one for values above the largest bucket, made cumulative when rendered
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value, count=1):
+        self.counts[bisect.bisect_left(self.buckets, value)] += count
+        self.sum += value * count
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        cumulative = 0
+        counts = list(self.counts)
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{format_labels({"le": bound})} {cumulative}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {cumulative}')
+        return lines
+
+
+class ServerMetrics:
+    def __init__(self, send_limits=None, rooms=None, heartbeat_monitor=None, sessions=None, rate_limits=None):
+        self.frames_received = Counter('chat_frames_received_total', 'Frames received from clients.')
+        self.frames_sent = Counter('chat_frames_sent_total', 'Frames queued to be sent to clients.')
+        self.bytes_received = Counter('chat_bytes_received_total', 'Bytes received from clients.')
+        self.bytes_sent = Counter('chat_bytes_sent_total', 'Bytes sent to clients.')
+        self.errors = Counter('chat_errors_total',
+                              'Connections closed by an exception, not counting clients that hang up.')
+        self.connections_accepted = Counter('chat_connections_accepted_total', 'Client connections accepted.')
+        self.connections_closed = Counter('chat_connections_closed_total', 'Client connections closed.')
+        self.connections = Gauge('chat_connections', 'Client connections currently open.')
+        self.loop_tick_seconds = Histogram('chat_loop_tick_seconds',
+                                           'Time spent handling the I/O from one wake up of the event loop.')
+        self.frame_decode_seconds = Histogram('chat_frame_decode_seconds', 'Time spent decoding each received frame.')
+        self.send_queue_frames = Histogram('chat_send_queue_frames',
+                                           'Frames waiting in a connection\'s outbound queue when it is written.',
+                                           QUEUE_DEPTH_BUCKETS)
+        self.collectors = [self.frames_received, self.frames_sent, self.bytes_received, self.bytes_sent, self.errors,
+                           self.connections_accepted, self.connections_closed, self.connections,
+                           self.loop_tick_seconds, self.frame_decode_seconds, self.send_queue_frames]
+        if rooms is not None:
+            self.collectors.append(Gauge('chat_rooms', 'Rooms with at least one member.', lambda: len(rooms)))
+        if send_limits is not None:
+            self.collectors.append(LabelledCounter('chat_slow_consumer_actions_total',
+                                                   'Times the slow consumer policy was applied to a client.',
+                                                   'policy', lambda: send_limits.policy_counters))
+            self.collectors.append(Counter('chat_dropped_frames_total', 'Frames dropped for slow clients.',
+                                           lambda: send_limits.dropped_frames))
+        if heartbeat_monitor is not None:
+            self.collectors.append(LabelledCounter('chat_connections_timed_out_total',
+                                                   'Connections closed for not answering in time.',
+                                                   'reason', lambda: heartbeat_monitor.timeouts))
+            self.collectors.append(Gauge('chat_timers', 'Timers waiting on the heartbeat timer wheel.',
+                                         lambda: len(heartbeat_monitor.wheel)))
+        if sessions is not None:
+            self.collectors.append(Gauge('chat_sessions', 'Sessions that can be resumed, including clients away.',
+                                         lambda: len(sessions)))
+            self.collectors.append(Counter('chat_sessions_resumed_total', 'Dropped connections resumed by clients.',
+                                           lambda: sessions.resumed))
+            self.collectors.append(Counter('chat_sessions_expired_total',
+                                           'Sessions forgotten after their client stayed away too long.',
+                                           lambda: sessions.expired))
+        if rate_limits is not None:
+            self.collectors.append(LabelledCounter('chat_rate_limited_total',
+                                                   'Requests refused for being over a client\'s rate limit.',
+                                                   'action', lambda: rate_limits.limited))
+
+    def connection_opened(self):
+        self.connections_accepted.inc()
+        self.connections.inc()
+
+    def connection_closed(self):
+        self.connections_closed.inc()
+        self.connections.dec()
+
+    def render(self):
+        lines = []
+        for collector in self.collectors:
+            lines.extend(collector.render())
+        return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(metrics, host='127.0.0.1', port=9100):
+    # Serves metrics.render() at /metrics from a daemon thread, returns the HTTP server so it can be shut down.
+    # http.server is slow to import, so servers without a metrics endpoint don't load it
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes are too frequent to be worth printing
+            pass
+
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name='metrics_http', daemon=True).start()
+    logger.info('Serving metrics on http://%s:%d/metrics', host, port)
+    return http_server
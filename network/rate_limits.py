@@ -0,0 +1,120 @@
+import time
+
+from network.rooms import DEFAULT_ROOM, room_content
+
+
+"""
+Token bucket limits on the requests each client can make.
+
+Every request a client sends can cost the server far more than it cost the client, as a chat message is sent on to
+everyone in the room. Each connection has a bucket for all its requests and one for each action with a limit of its
+own, which fill at a steady rate up to a burst size. A request takes a token from each bucket it uses and is refused
+when any of them is empty, before the server does anything with it.
+
+A refused request is either dropped or answered with an error. Only the first request refused after one that got
+through is answered, so a client flooding the server gets one error per burst rather than one per request.
+"""
+
+RATE_LIMIT_POLICIES = ('error', 'drop')
+# (tokens per second, burst)
+DEFAULT_CONNECTION_LIMIT = (20.0, 40)
+DEFAULT_ACTION_LIMITS = {
+    'send_message': (5.0, 10),
+    # binary requests are broadcast to the default room as well
+    'binary': (5.0, 10),
+    'change_name': (0.5, 3),
+    'join_room': (2.0, 5),
+    'leave_room': (2.0, 5),
+}
+# answering pings keeps the connection alive, and a client should always be able to leave
+UNLIMITED_ACTIONS = ('pong', 'quit')
+RATE_LIMITED_RESULT = 'Error: you are sending too fast, please slow down.'
+
+
+def request_action(request_type, request):
+    # the action a request is limited as, binary requests have no action of their own
+    if request_type != "text/json":
+        return 'binary'
+    action = request.get("action")
+    return action if isinstance(action, str) else 'other'
+
+
+def rate_limited_content(request_type, request):
+    # the error for a refused request, in the room it was for
+    room = DEFAULT_ROOM
+    if request_type == "text/json" and request.get("action") == "send_message":
+        room = request.get("room", DEFAULT_ROOM)
+    return room_content(room if isinstance(room, str) else DEFAULT_ROOM, RATE_LIMITED_RESULT)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'last_time')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_time = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+
+class ClientRateState:
+    __slots__ = ('connection_bucket', 'action_buckets', 'warned')
+
+    def __init__(self, connection_bucket):
+        self.connection_bucket = connection_bucket
+        # action -> TokenBucket, made when the client first uses the action
+        self.action_buckets = {}
+        # set once the client has been told it is over the limit, until a request gets through again
+        self.warned = False
+
+
+class RateLimits:
+    def __init__(self, connection_limit=DEFAULT_CONNECTION_LIMIT, action_limits=None, policy='error'):
+        # connection_limit and the values of action_limits are (tokens per second, burst) pairs, an action can be
+        # given None for no limit of its own
+        if policy not in RATE_LIMIT_POLICIES:
+            raise ValueError(f"Unknown rate limit policy {policy!r}, expected one of {RATE_LIMIT_POLICIES}.")
+        self.connection_limit = connection_limit
+        self.action_limits = dict(DEFAULT_ACTION_LIMITS if action_limits is None else action_limits)
+        self.policy = policy
+        # action -> requests refused, with the actions that have no limit of their own counted together
+        self.limited = {action: 0 for action in self.action_limits}
+        self.limited['other'] = 0
+
+    def allow(self, connection, action):
+        # Takes a token for the request from the connection's buckets, returns False if it is over a limit.
+        if action in UNLIMITED_ACTIONS:
+            return True
+        now = time.monotonic()
+        state = connection.rate_limit
+        if state is None:
+            state = connection.rate_limit = ClientRateState(TokenBucket(*self.connection_limit, now))
+        connection_bucket = state.connection_bucket
+        connection_bucket.refill(now)
+        action_bucket = None
+        action_limit = self.action_limits.get(action)
+        if action_limit is not None:
+            action_bucket = state.action_buckets.get(action)
+            if action_bucket is None:
+                action_bucket = state.action_buckets[action] = TokenBucket(*action_limit, now)
+            action_bucket.refill(now)
+        # a refused request takes nothing, so it doesn't use up the other bucket
+        if connection_bucket.tokens >= 1 and (action_bucket is None or action_bucket.tokens >= 1):
+            connection_bucket.tokens -= 1
+            if action_bucket is not None:
+                action_bucket.tokens -= 1
+            state.warned = False
+            return True
+        self.limited[action if action in self.limited else 'other'] += 1
+        return False
+
+    def should_answer(self, connection):
+        # For a refused request, whether to send the client an error rather than drop the request silently.
+        if self.policy != 'error' or connection.rate_limit.warned:
+            return False
+        connection.rate_limit.warned = True
+        return True
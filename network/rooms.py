@@ -0,0 +1,71 @@
+"""
+Chat rooms. Every client is put in the default room when it enters the chat, which is the only room old clients know
+about, and can join and leave others by name. The server keeps an index from each room to its members so that a
+message to a room only visits the connections in it, however many other rooms the server is hosting.
+"""
+
+DEFAULT_ROOM = 'Hello World'
+MAX_ROOM_NAME_LENGTH = 64
+
+
+def room_content(room, result):
+    # messages for the default room leave the room out, so old clients and the compact frames see no change
+    if room == DEFAULT_ROOM:
+        return {'result': result}
+    return {'result': result, 'room': room}
+
+
+def room_of_response(response):
+    # the room a broadcast response is for, used when it arrives from another worker process
+    if response["type"] == "text/json":
+        return response["content"].get('room', DEFAULT_ROOM)
+    return DEFAULT_ROOM
+
+
+def check_room_name(room):
+    if not isinstance(room, str):
+        raise ValueError("A room name must be a string.")
+    if not room.strip():
+        raise ValueError("A room name can't be empty.")
+    if len(room) > MAX_ROOM_NAME_LENGTH:
+        raise ValueError(f"Room names are limited to {MAX_ROOM_NAME_LENGTH} characters.")
+
+
+class RoomIndex:
+    def __init__(self):
+        # room name -> {connection address: client}, rooms are removed once their last member leaves
+        self._members = {}
+        # connection address -> names of the rooms it is in, so a closed connection leaves them all
+        self._rooms_by_member = {}
+
+    def __len__(self):
+        return len(self._members)
+
+    def join(self, room, addr, client):
+        self._members.setdefault(room, {})[addr] = client
+        self._rooms_by_member.setdefault(addr, set()).add(room)
+
+    def leave(self, room, addr):
+        members = self._members.get(room)
+        if members is None or members.pop(addr, None) is None:
+            return False
+        if not members:
+            del self._members[room]
+        self._rooms_by_member[addr].discard(room)
+        return True
+
+    def leave_all(self, addr):
+        for room in self._rooms_by_member.pop(addr, ()):
+            members = self._members[room]
+            del members[addr]
+            if not members:
+                del self._members[room]
+
+    def is_member(self, room, addr):
+        return addr in self._members.get(room, ())
+
+    def members(self, room):
+        return self._members.get(room, {}).values()
+
+    def rooms_of(self, addr):
+        return self._rooms_by_member.get(addr, set())
@@ -0,0 +1,188 @@
+import logging
+import os
+import time
+import socket
+from collections import deque
+
+from network.framing import COMPRESSION_THRESHOLD
+
+
+logger = logging.getLogger(__name__)
+
+
+try:
+    MAX_FRAMES_PER_SEND = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    MAX_FRAMES_PER_SEND = 16
+
+# BSD and macOS call the same thing TCP_NOPUSH
+TCP_CORK_OPTION = getattr(socket, 'TCP_CORK', None) or getattr(socket, 'TCP_NOPUSH', None)
+
+
+class SendQueue:
+    """
+    Outbound frames waiting to be sent on one socket.
+
+    Frames are immutable bytes objects, so a broadcast frame is encoded once and the same object is queued for every
+    recipient. Queued frames are written together with a single vectored send where the platform supports it, and a
+    partially sent frame is tracked with an offset rather than by slicing it. Only frames queued as droppable, the
+    broadcasts a slow client can miss, are given up when the queue is too long.
+    """
+    def __init__(self):
+        self.frames = deque()
+        # whether each queued frame may be dropped, in the same order as frames
+        self.droppable = deque()
+        self.offset = 0
+        self.pending_bytes = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __bool__(self):
+        return bool(self.frames)
+
+    def append(self, frame, droppable=False):
+        self.frames.append(frame)
+        self.droppable.append(droppable)
+        self.pending_bytes += len(frame)
+
+    def send(self, sock):
+        # Sends as much of the queue as the socket will take, returns the number of bytes sent.
+        # BlockingIOError is left to the caller, as with socket.send().
+        if not self.frames:
+            return 0
+        if hasattr(sock, 'sendmsg'):
+            buffers = [memoryview(frame) for frame, _ in zip(self.frames, range(MAX_FRAMES_PER_SEND))]
+            buffers[0] = buffers[0][self.offset:]
+            sent = sock.sendmsg(buffers)
+        else:
+            sent = sock.send(memoryview(self.frames[0])[self.offset:])
+        self._consume(sent)
+        return sent
+
+    def _consume(self, sent):
+        self.pending_bytes -= sent
+        sent += self.offset
+        while self.frames and sent >= len(self.frames[0]):
+            sent -= len(self.frames.popleft())
+            self.droppable.popleft()
+        self.offset = sent
+
+    def drop_oldest(self, target_bytes):
+        # Drops the oldest droppable frames until no more than target_bytes are pending. Replies for this client alone
+        # are always kept, as is a frame that has been partially sent as the peer would receive a broken frame.
+        # Returns the number dropped.
+        dropped = 0
+        frames = deque()
+        droppable = deque()
+        for position, (frame, frame_droppable) in enumerate(zip(self.frames, self.droppable)):
+            if frame_droppable and self.pending_bytes > target_bytes and not (position == 0 and self.offset):
+                self.pending_bytes -= len(frame)
+                dropped += 1
+            else:
+                frames.append(frame)
+                droppable.append(frame_droppable)
+        self.frames = frames
+        self.droppable = droppable
+        return dropped
+
+
+DEFAULT_HIGH_WATERMARK = 1024 * 1024
+DEFAULT_LOW_WATERMARK = 256 * 1024
+DEFAULT_COALESCE_BYTES = 16 * 1024
+SLOW_CONSUMER_POLICIES = ('drop_oldest', 'pause_reads', 'disconnect')
+
+
+class SendLimits:
+    """
+    How frames are sent to each connection.
+
+    The high and low watermarks bound the outbound queue, with a policy for a client whose queue passes the high
+    watermark:
+
+    'drop_oldest' drops the oldest queued broadcasts until the queue is back down to the low watermark.
+    'pause_reads' stops reading requests from the client until its queue drains to the low watermark. Broadcasts from
+    other clients that take the queue past the high watermark again meanwhile are dropped as with 'drop_oldest'.
+    'disconnect' closes the connection.
+
+    With a coalesce delay above zero, frames queued for a connection are held for up to that many seconds, or until
+    coalesce_bytes are waiting, and then written together. tcp_nodelay is applied to every connection socket. With
+    tcp_cork a socket is corked while frames are written to it and uncorked straight after, so a flush goes out in
+    full segments without its last partial segment being held back. Frames to clients that agreed to compression are
+    compressed when their content is at least compression_threshold bytes, or never when it is None.
+
+    The counters are shared by every connection using these limits.
+    """
+    def __init__(self, high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK,
+                 slow_consumer_policy='drop_oldest', coalesce_delay=0.0, coalesce_bytes=DEFAULT_COALESCE_BYTES,
+                 tcp_nodelay=True, tcp_cork=False, compression_threshold=COMPRESSION_THRESHOLD):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Invalid slow consumer policy {repr(slow_consumer_policy)}.")
+        if low_watermark > high_watermark:
+            raise ValueError("The low watermark must not be above the high watermark.")
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_consumer_policy = slow_consumer_policy
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_bytes = coalesce_bytes
+        self.tcp_nodelay = tcp_nodelay
+        if tcp_cork and TCP_CORK_OPTION is None:
+            logger.warning("TCP corking is not supported on this platform")
+            tcp_cork = False
+        self.tcp_cork = tcp_cork
+        self.compression_threshold = compression_threshold
+        self.policy_counters = {policy: 0 for policy in SLOW_CONSUMER_POLICIES}
+        self.dropped_frames = 0
+
+
+def apply_tcp_keepalive(sock, idle, interval, count=3):
+    # The kernel probes a connection that has been idle for idle seconds every interval seconds and reports it broken
+    # after count probes go unanswered. Platforms without the tuning options use their own defaults.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # macOS calls the idle time TCP_KEEPALIVE
+    idle_option = getattr(socket, 'TCP_KEEPIDLE', None) or getattr(socket, 'TCP_KEEPALIVE', None)
+    for option, value in ((idle_option, idle), (getattr(socket, 'TCP_KEEPINTVL', None), interval),
+                          (getattr(socket, 'TCP_KEEPCNT', None), count)):
+        if option is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, option, max(1, int(value)))
+
+
+def apply_tcp_options(sock, nodelay=True):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if nodelay else 0)
+
+
+def set_tcp_cork(sock, corked):
+    # Linux holds partial segments back while corked, and sends them as soon as the socket is uncorked
+    sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK_OPTION, 1 if corked else 0)
+
+
+class FlushScheduler:
+    """
+    Delays flushing connections so that frames queued within the coalesce delay go out in one write. Every
+    connection waits the same delay, so deadlines are due in the order they were scheduled and a FIFO is enough.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self._due = deque()
+
+    def schedule(self, message):
+        if not message.flush_scheduled:
+            message.flush_scheduled = True
+            self._due.append((time.monotonic() + self.delay, message))
+
+    def time_until_next_flush(self):
+        if not self._due:
+            return None
+        return max(0.0, self._due[0][0] - time.monotonic())
+
+    def flush_due(self, flush):
+        # Calls flush(message) for each connection whose delay is up, flush is expected to handle the connection
+        # failing so that one broken client can't stop the rest being flushed.
+        now = time.monotonic()
+        while self._due and self._due[0][0] <= now:
+            _, message = self._due.popleft()
+            # connections flushed early because enough bytes were waiting are no longer scheduled
+            if message.flush_scheduled:
+                message.flush_scheduled = False
+                if message.sock is not None:
+                    flush(message)
@@ -1,38 +1,148 @@
+import logging
+import time
 import socket
 import selectors
-import traceback
 
-from network.server_message import ServerMessage
+from network.framing import SUPPORTED_PROTOCOLS, decode_frame, encode_frame
+from network.server_message import ServerMessage, queue_for_clients
+from network.send_queue import SendLimits, FlushScheduler, apply_tcp_options, apply_tcp_keepalive
+from network.rooms import RoomIndex, room_of_response
+from network.metrics import ServerMetrics
+from network.connections import Connection, ConnectionRegistry
+from network.heartbeat import HeartbeatMonitor
+from network.server_actions import create_json_response
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_PORT = 25574  # Port to listen on (non-privileged ports are > 1023)
+DEFAULT_BACKLOG = 128
+PING_FRAMES = {protocol: encode_frame(create_json_response({'action': 'ping', 'value': ''}), protocol)
+               for protocol in SUPPORTED_PROTOCOLS}
 
 
 class Server:
-    def __init__(self):
+    def __init__(self, host=None, port=DEFAULT_PORT, backlog=DEFAULT_BACKLOG, reuse_port=False, peer_channel=None,
+                 send_limits=None, history=None, metrics=None, beacon=None, heartbeat_settings=None, sessions=None,
+                 rate_limits=None):
         # network server stuff
-        self.server_hosting_ip = self.get_ip_for_hosting()
-        self.network_port = 25574  # Port to listen on (non-privileged ports are > 1023)
+        self.server_hosting_ip = host if host is not None else self.get_ip_for_hosting()
+        self.network_port = port
+        self.running = False
         self.server_listening_socket = None
-        self.client_connection_sockets = {}
+        self.connections = ConnectionRegistry()
+        self.rooms = RoomIndex()
+        # optional MessageLog of everything broadcast, so clients joining a room can catch up
+        self.history = history
+        # outbound queue watermarks and slow consumer policy, shared by every connection
+        self.send_limits = send_limits if send_limits is not None else SendLimits()
+        # pings clients and closes connections that have gone quiet, when heartbeat_settings are given
+        self.heartbeat_monitor = None
+        if heartbeat_settings is not None:
+            self.heartbeat_monitor = HeartbeatMonitor(heartbeat_settings, self.send_ping, self.close_connection)
+        # optional SessionStore, so clients whose connection drops can resume where they left off
+        self.sessions = sessions
+        # optional RateLimits on the requests each client can make
+        self.rate_limits = rate_limits
+        # counters and histograms of what the server is doing, see network/metrics.py
+        self.metrics = metrics if metrics is not None else ServerMetrics(self.send_limits, self.rooms,
+                                                                         self.heartbeat_monitor, self.sessions,
+                                                                         self.rate_limits)
+        # optional ServerBeacon advertising the server to clients on the LAN
+        self.beacon = beacon
+        self.flush_scheduler = None
+        if self.send_limits.coalesce_delay > 0:
+            self.flush_scheduler = FlushScheduler(self.send_limits.coalesce_delay)
         # network event stuff
         self.server_selector = selectors.DefaultSelector()
         self.server_num_registered_event_handlers = 0
 
         self.server_listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # lets several worker processes accept on the same port, the kernel spreads connections between them
+            self.server_listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_listening_socket.bind((self.server_hosting_ip, self.network_port))
-        self.server_listening_socket.listen()
-        print('Starting server on', (self.server_hosting_ip, self.network_port))
+        self.server_listening_socket.listen(backlog)
+        logger.info('Starting server on %s', (self.server_hosting_ip, self.network_port))
         self.server_listening_socket.setblocking(False)
         self.server_selector.register(self.server_listening_socket, selectors.EVENT_READ, data=None)
         self.server_num_registered_event_handlers += 1
 
-    def update(self):
+        # broadcast frames exchanged with other worker processes of a sharded server
+        self.peer_channel = peer_channel
+        if self.peer_channel is not None:
+            self.server_selector.register(self.peer_channel.sock, selectors.EVENT_READ, data=self.peer_channel)
+            self.server_num_registered_event_handlers += 1
+
+    def update(self, timeout=0.005):
+        # the default timeout keeps the pygame frame loop ticking, pass None to block until there is real I/O
         if self.server_num_registered_event_handlers > 0:
-            events = self.server_selector.select(timeout=0.005)
+            if self.flush_scheduler is not None:
+                # wake up in time to flush any coalesced frames
+                time_until_flush = self.flush_scheduler.time_until_next_flush()
+                if time_until_flush is not None and (timeout is None or time_until_flush < timeout):
+                    timeout = time_until_flush
+            if self.peer_channel is not None and self.peer_channel.has_pending():
+                # retry broadcasts that the other workers couldn't take yet
+                timeout = 0.001 if timeout is None else min(timeout, 0.001)
+            if self.beacon is not None:
+                time_until_beacon = self.beacon.time_until_next_beacon()
+                if timeout is None or time_until_beacon < timeout:
+                    timeout = time_until_beacon
+            if self.heartbeat_monitor is not None:
+                time_until_tick = self.heartbeat_monitor.wheel.time_until_next_tick()
+                if time_until_tick is not None and (timeout is None or time_until_tick < timeout):
+                    timeout = time_until_tick
+            events = self.server_selector.select(timeout=timeout)
+            tick_start = time.perf_counter()
             for key, mask in events:
                 if key.data is None:
                     self.accept_wrapper(key.fileobj)
+                elif key.data is self.peer_channel:
+                    self.receive_peer_broadcasts()
                 else:
                     self.service_connection(key, mask)
+            if self.flush_scheduler is not None:
+                self.flush_scheduler.flush_due(self.flush_connection)
+            if self.peer_channel is not None and self.peer_channel.has_pending():
+                self.peer_channel.send_pending()
+            if self.heartbeat_monitor is not None:
+                self.heartbeat_monitor.wheel.advance()
+            if events:
+                self.metrics.loop_tick_seconds.observe(time.perf_counter() - tick_start)
+            if self.beacon is not None:
+                self.beacon.update(len(self.connections), self.metrics.loop_tick_seconds.sum)
+
+    def serve_forever(self):
+        # headless event loop, only wakes up when the selector reports I/O
+        self.running = True
+        try:
+            while self.running:
+                self.update(timeout=None)
+        finally:
+            self.close()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        logger.info('Stopping server on %s', (self.server_hosting_ip, self.network_port))
+        for key in list(self.server_selector.get_map().values()):
+            if key.data is not None and key.data is not self.peer_channel:
+                key.data.close()
+        if self.peer_channel is not None:
+            self.server_selector.unregister(self.peer_channel.sock)
+            self.peer_channel.close()
+        self.server_selector.unregister(self.server_listening_socket)
+        self.server_listening_socket.close()
+        self.server_selector.close()
+        self.server_num_registered_event_handlers = 0
+        if self.history is not None:
+            self.history.close()
+        if self.beacon is not None:
+            self.beacon.close()
 
     @staticmethod
     def get_ip_for_hosting():
@@ -49,26 +159,69 @@ class Server:
 
     def accept_wrapper(self, listening_socket):
         new_connection, connection_address = listening_socket.accept()
-        self.client_connection_sockets[connection_address] = {'socket': new_connection,
-                                                              'send_buffer': b"",
-                                                              'name': "Dan",
-                                                              'colour': '#FFFFFF'}
-        print('Accepted connection from', connection_address)
+        client = Connection(connection_address, new_connection.fileno())
+        self.connections.add(client)
+        logger.info('Accepted connection from %s', connection_address)
         new_connection.setblocking(False)
+        apply_tcp_options(new_connection, nodelay=self.send_limits.tcp_nodelay)
+        if self.heartbeat_monitor is not None:
+            # for old clients that can't answer pings
+            settings = self.heartbeat_monitor.settings
+            apply_tcp_keepalive(new_connection, settings.ping_interval, settings.pong_timeout / 3)
 
         # separate this ?
         message = ServerMessage(self.server_selector, new_connection,
-                                connection_address, self.client_connection_sockets)
+                                client, self.connections, self.rooms,
+                                peer_channel=self.peer_channel, send_limits=self.send_limits,
+                                flush_scheduler=self.flush_scheduler, history=self.history,
+                                metrics=self.metrics, heartbeat_monitor=self.heartbeat_monitor,
+                                sessions=self.sessions, rate_limits=self.rate_limits)
+        client.message = message
+        if self.heartbeat_monitor is not None:
+            self.heartbeat_monitor.watch(client)
         self.server_selector.register(new_connection, selectors.EVENT_READ, data=message)
         self.server_num_registered_event_handlers += 1
+        self.metrics.connection_opened()
+
+    def send_ping(self, connection):
+        connection.message.queue_frame(PING_FRAMES[connection.protocol])
+
+    def close_connection(self, connection):
+        connection.message.close()
+
+    def receive_peer_broadcasts(self):
+        # frames broadcast by clients of other workers, queue them for our own clients
+        for frame in self.peer_channel.receive_frames():
+            message, _ = decode_frame(frame)
+            room = room_of_response(message)
+            if self.sessions is not None and message["type"] == "text/json":
+                # each worker numbers every broadcast it sends on, as its clients can only resume with it
+                self.sessions.sequence(room, message)
+            frame = queue_for_clients(self.rooms.members(room), message)
+            if self.history is not None and message["type"] == "text/json":
+                self.history.append(room, frame)
 
     def service_connection(self, key, mask):
         message = key.data
         try:
             message.process_events(mask)
+        except ConnectionError as e:
+            # the client hung up or its connection broke, not a fault in the server
+            logger.info("%s disconnected: %r", message.addr, e)
+            message.close()
+        except Exception:
+            logger.exception("exception for %s", message.addr)
+            self.metrics.errors.inc()
+            message.close()
+
+    def flush_connection(self, message):
+        # writes the frames held back for a connection, a connection that fails is closed like in service_connection
+        try:
+            message.write()
+        except ConnectionError as e:
+            logger.info("%s disconnected: %r", message.addr, e)
+            message.close()
         except Exception:
-            print(
-                "main: error: exception for",
-                f"{message.addr}:\n{traceback.format_exc()}",
-            )
+            logger.exception("exception flushing %s", message.addr)
+            self.metrics.errors.inc()
             message.close()
@@ -0,0 +1,175 @@
+import logging
+import html
+import colorsys
+
+from network.framing import PROTOCOL_V1, PROTOCOL_V2, SUPPORTED_PROTOCOLS
+from network.rooms import DEFAULT_ROOM, room_content, check_room_name
+
+
+"""
+The chat actions understood by the server, kept separate from the transport so that every server engine gives the
+same answers to the same requests.
+"""
+
+logger = logging.getLogger(__name__)
+
+GOLDEN_RATIO = ((5 ** 0.5) - 1) / 2
+
+
+def hsl_colour(hue, saturation, lightness):
+    # hue, saturation and lightness from 0 to 1 as a '#RRGGBB' code, truncated to 8 bits a channel like pygame.Color
+    red, green, blue = colorsys.hls_to_rgb(hue, lightness, saturation)
+    return f'#{int(red * 255):02X}{int(green * 255):02X}{int(blue * 255):02X}'
+
+
+# Join colours step round the hue circle by the golden ratio, so each new client's colour is far from the last few.
+# They are worked out once here rather than for every join, and repeat after the table's length.
+JOIN_PALETTE_SIZE = 256
+JOIN_PALETTE = tuple(hsl_colour((join_index * GOLDEN_RATIO) % 1, 0.5, 0.7) for join_index in range(JOIN_PALETTE_SIZE))
+
+
+def create_join_colour(join_index):
+    return JOIN_PALETTE[join_index % JOIN_PALETTE_SIZE]
+
+
+def joins_new_room(request, client, rooms):
+    # Whether a request puts the client in a room it isn't in yet. Asked before the request is carried out, as the
+    # client is then sent the room's history if the server keeps one, and a client already in the room has had it.
+    action = request.get("action")
+    if action == "first_entry":
+        room = DEFAULT_ROOM
+    elif action == "join_room":
+        room = request.get("value")
+    else:
+        return False
+    return isinstance(room, str) and not rooms.is_member(room, client.addr)
+
+
+def create_json_response_content(request, client, connections, rooms):
+    # Returns the room to send the response to and the response content. The room is None when only the requesting
+    # client should get the response, and the content is None when the action has nothing to send.
+    # The 'quit' action is left to the caller as closing a connection depends on the server engine.
+    action = request.get("action")
+    if action == "send_message":
+        room = request.get("room", DEFAULT_ROOM)
+        try:
+            check_room_name(room)
+        except ValueError as e:
+            return None, {'result': f'Error: {e}'}
+        if not rooms.is_member(room, client.addr):
+            return None, room_content(room, 'Error: you are not in this room.')
+        message = html.escape(request.get("value"))
+        message_and_name = '<font color=' + client.colour + '><b>&lt;' + client.name + '&gt;</b> ' + message + '</font>'
+        return room, room_content(room, message_and_name)
+    elif action == "change_name":
+        name = html.escape(request.get("value"))
+        connections.rename(client, name)
+        return DEFAULT_ROOM, {'result': 'Name successfully changed to ' + name}
+    elif action == "on_connection":
+        logger.info('%s Connected', request.get("value"))
+        return None, None
+    elif action == "ping":
+        return None, {'action': 'pong', 'value': request.get("value", "")}
+    elif action == "pong":
+        # arriving at all is what counts, the server engine has already noted the connection is alive
+        return None, None
+    elif action == "first_entry":
+        name = html.escape(request.get("value"))
+        connections.rename(client, name)
+        client.colour = create_join_colour(len(connections))
+        # only now, so a client replayed the room's history isn't also sent what was said while it was entering
+        rooms.join(DEFAULT_ROOM, client.addr, client)
+        return DEFAULT_ROOM, {'result': name + ' has entered the chat...'}
+    elif action == "join_room":
+        room = request.get("value")
+        try:
+            check_room_name(room)
+        except ValueError as e:
+            return None, {'result': f'Error: {e}'}
+        rooms.join(room, client.addr, client)
+        return room, room_content(room, client.name + ' has joined ' + html.escape(room))
+    elif action == "leave_room":
+        room = request.get("value")
+        try:
+            check_room_name(room)
+        except ValueError as e:
+            return None, {'result': f'Error: {e}'}
+        if not rooms.leave(room, client.addr):
+            return None, {'result': 'Error: you are not in this room.'}
+        # the client has already left, so this only reaches the members that are still in the room
+        return room, room_content(room, client.name + ' has left ' + html.escape(room))
+    else:
+        return None, {"result": f'Error: invalid action "{action}".'}
+
+
+def negotiate_protocol(request, client, compression_threshold=None, ping_interval=None, resumable=False):
+    # Picks the newest framing version offered in an 'on_connection' request, and compression if the client offered
+    # it and the server allows it by passing a compression_threshold. Clients that offer to answer pings are told
+    # the ping_interval when the server sends heartbeats, and clients that can resume are sent sequence numbers when
+    # the server keeps sessions. Returns the content of the reply to send back to that client only, or None for old
+    # clients that did not offer any versions. Offers that aren't lists are ignored, leaving the client on version 1
+    # without compression.
+    offered_protocols = request.get("protocols")
+    if not offered_protocols or not isinstance(offered_protocols, (list, tuple)):
+        return None
+    client.protocol = max((protocol for protocol in offered_protocols if protocol in SUPPORTED_PROTOCOLS),
+                          default=PROTOCOL_V1)
+    reply = {'protocol': client.protocol}
+    # only version 2 frames have a flag to mark compressed content
+    offered_compression = request.get("compression")
+    if (compression_threshold is not None and client.protocol == PROTOCOL_V2
+            and isinstance(offered_compression, (list, tuple)) and "deflate" in offered_compression):
+        client.compression_threshold = compression_threshold
+        reply['compression'] = "deflate"
+    if ping_interval is not None and request.get("heartbeat"):
+        client.answers_pings = True
+        reply['heartbeat'] = ping_interval
+    if resumable and request.get("resume"):
+        client.sequenced = True
+        reply['resume'] = True
+    return reply
+
+
+def resume_session(request, client, connections, rooms, sessions):
+    # Puts a reconnected client back in the rooms of the session named in a 'resume' request, under its old name and
+    # colour and without announcing it. Returns the content of the reply for the client, the messages it missed in
+    # each room since the sequence numbers it sent, and its old connection if that is still open, which the caller
+    # should close.
+    session, previous = sessions.resume(request.get("value"), client)
+    if session is None:
+        return {'resumed': False}, [], None
+    if previous is not None:
+        session.rooms = set(rooms.rooms_of(previous.addr))
+    connections.rename(client, session.name)
+    client.colour = session.colour
+    for room in rooms.rooms_of(client.addr) - session.rooms:
+        rooms.leave(room, client.addr)
+    last_sequences = request.get("last_seq")
+    if not isinstance(last_sequences, dict):
+        last_sequences = {}
+    missed = []
+    complete = True
+    for room in session.rooms:
+        rooms.join(room, client.addr, client)
+        last_sequence = last_sequences.get(room)
+        if isinstance(last_sequence, int):
+            room_missed, room_complete = sessions.missed(room, last_sequence)
+            missed.extend(room_missed)
+            complete = complete and room_complete
+    return {'resumed': True, 'complete': complete}, missed, previous
+
+
+def create_json_response(content):
+    return dict(
+        type="text/json",
+        encoding="utf-8",
+        content=content,
+    )
+
+
+def create_binary_response(request):
+    return dict(
+        type="binary/custom-server-binary-type",
+        encoding="binary",
+        content=b"First 10 bytes of request: " + request[:10],
+    )
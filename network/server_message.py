@@ -1,33 +1,69 @@
-import sys
+import logging
+import time
 import selectors
-import json
-import io
-import struct
-import html
-import pygame
-import math
+
+from network.framing import PROTOCOL_V1, FrameDecoder, encode_frame
+from network.send_queue import SendQueue, SendLimits, set_tcp_cork
+from network.rooms import DEFAULT_ROOM
+from network.message_log import history_frames
+from network.metrics import ServerMetrics
+from network.rate_limits import request_action, rate_limited_content
+from network.server_actions import (create_json_response_content, create_json_response, create_binary_response,
+                                    negotiate_protocol, resume_session, joins_new_room)
+
+
+logger = logging.getLogger(__name__)
+
+
+class PeerClosed(ConnectionError):
+    # the client closed its end of the connection, which is how most connections end
+    pass
+
+
+def queue_for_clients(clients, message):
+    # encodes the message once per framing version and compression in use and queues the same frame object for every
+    # client, returns the version 1 frame so it can be shared with other server processes
+    frames = {(PROTOCOL_V1, None, False): encode_frame(message, PROTOCOL_V1)}
+    # copied as a slow client may be disconnected, and leave its rooms, while the frame is being queued
+    for client in list(clients):
+        frame_format = client.frame_format
+        if frame_format not in frames:
+            frames[frame_format] = encode_frame(message, *frame_format)
+        client.message.queue_frame(frames[frame_format], droppable=True)
+    return frames[(PROTOCOL_V1, None, False)]
 
 
 class ServerMessage:
-    def __init__(self, selector, sock, addr, all_clients):
+    def __init__(self, selector, sock, connection, connections, rooms, peer_channel=None, send_limits=None,
+                 flush_scheduler=None, history=None, metrics=None, heartbeat_monitor=None, sessions=None,
+                 rate_limits=None):
         self.selector = selector
         self.sock = sock
-        self.addr = addr
-        self._recv_buffer = b""
-        self._jsonheader_len = None
-        self.jsonheader = None
+        self.connection = connection
+        self.addr = connection.addr
+        self._frame_decoder = FrameDecoder()
+        self.request_type = None
         self.request = None
-        self.response_created = False
+        self.send_queue = SendQueue()
+        self.send_limits = send_limits if send_limits is not None else SendLimits()
+        self.reads_paused = False
+        self._events_mode = "r"
+        # set while queued frames are being held back to be coalesced into one write
+        self.flush_scheduler = flush_scheduler
+        self.flush_scheduled = False
 
-        self.all_clients = all_clients
-        self.golden_ratio = ((5 ** 0.5) - 1) / 2
-
-    def clear_server_message_on_new_read(self):
-        self._recv_buffer = b""
-        self._jsonheader_len = None
-        self.jsonheader = None
-        self.request = None
-        self.response_created = False
+        self.connections = connections
+        self.rooms = rooms
+        self.response_room = None
+        self.peer_channel = peer_channel
+        # durable chat history, replayed to clients as they join a room
+        self.history = history
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self.heartbeat_monitor = heartbeat_monitor
+        # SessionStore numbering broadcasts and keeping sessions for clients to resume, None when not resumable
+        self.sessions = sessions
+        # RateLimits on the requests the client can make, None for no limits
+        self.rate_limits = rate_limits
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -41,214 +77,227 @@ class ServerMessage:
             raise ValueError(f"Invalid events mask mode {repr(mode)}.")
         self.selector.modify(self.sock, events, data=self)
 
+    def _update_selector_events(self):
+        # listen for reads unless they are paused, and for writes only while there is something to send now
+        if self.reads_paused:
+            mode = "w"
+        elif self.send_queue and not self.flush_scheduled:
+            mode = "rw"
+        else:
+            mode = "r"
+        if mode != self._events_mode:
+            self._set_selector_events_mask(mode)
+            self._events_mode = mode
+
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            received = self._frame_decoder.recv_into(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
-                raise RuntimeError("Peer closed.")
-
-    def _broadcast(self):
-        # Should be ready to broadcast
-        all_buffers_empty = True
-        for client_address in self.all_clients:
-            if self.all_clients[client_address]['send_buffer']:
-                print("broadcasting", repr(self.all_clients[client_address]['send_buffer']), "to", client_address)
-                try:
-                    sent = self.all_clients[client_address]['socket'].send(self.all_clients[client_address]['send_buffer'])
-                except BlockingIOError:
-                    # Resource temporarily unavailable (errno EWOULDBLOCK)
-                    pass
-                else:
-                    self.all_clients[client_address]['send_buffer'] = self.all_clients[client_address]['send_buffer'][sent:]
-                    if len(self.all_clients[client_address]['send_buffer']) != 0:
-                        all_buffers_empty = False
-        if all_buffers_empty:
-            self._set_selector_events_mask("r")
-
-    @staticmethod
-    def _json_encode(obj, encoding):
-        return json.dumps(obj, ensure_ascii=False).encode(encoding)
-
-    @staticmethod
-    def _json_decode(json_bytes, encoding):
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
-
-    def _create_message(
-        self, *, content_bytes, content_type, content_encoding
-    ):
-        jsonheader = {
-            "byteorder": sys.byteorder,
-            "content-type": content_type,
-            "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
-        }
-        jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
-        message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        return message_hdr + jsonheader_bytes + content_bytes
+            if not received:
+                raise PeerClosed("Peer closed.")
+            self.metrics.bytes_received.inc(received)
+            if self.connection.heartbeat is not None:
+                self.connection.heartbeat.last_received = time.monotonic()
+
+    def _write(self):
+        if self.send_queue:
+            logger.debug("sending %d frames to %s", len(self.send_queue), self.addr)
+            self.metrics.send_queue_frames.observe(len(self.send_queue))
+            corked = self.send_limits.tcp_cork
+            if corked:
+                set_tcp_cork(self.sock, True)
+            try:
+                # Should be ready to write
+                self.metrics.bytes_sent.inc(self.send_queue.send(self.sock))
+            except BlockingIOError:
+                # Resource temporarily unavailable (errno EWOULDBLOCK)
+                pass
+            finally:
+                if corked:
+                    # lets the last partial segment go rather than holding it for the next flush
+                    set_tcp_cork(self.sock, False)
+
+    def queue_frame(self, frame, droppable=False):
+        # droppable frames are the broadcasts the slow consumer policy may drop, see SendQueue.drop_oldest()
+        self.send_queue.append(frame, droppable)
+        self.metrics.frames_sent.inc()
+        if self.send_queue.pending_bytes > self.send_limits.high_watermark:
+            self.handle_slow_consumer()
+        if self.sock is None:
+            return
+        if self.flush_scheduler is not None and self.send_queue.pending_bytes < self.send_limits.coalesce_bytes:
+            self.flush_scheduler.schedule(self)
+        else:
+            self.flush_scheduled = False
+        self._update_selector_events()
+
+    def handle_slow_consumer(self):
+        policy = self.send_limits.slow_consumer_policy
+        if policy == 'pause_reads' and self.reads_paused:
+            # the client's own requests are no longer read, but broadcasts from other clients still arrive
+            self.drop_oldest_frames()
+            return
+        self.send_limits.policy_counters[policy] += 1
+        if policy == 'drop_oldest':
+            self.drop_oldest_frames()
+        elif policy == 'pause_reads':
+            logger.warning("pausing reads from slow client %s", self.addr)
+            self.reads_paused = True
+        else:
+            logger.warning("disconnecting slow client %s", self.addr)
+            self.close()
+
+    def drop_oldest_frames(self):
+        dropped = self.send_queue.drop_oldest(self.send_limits.low_watermark)
+        self.send_limits.dropped_frames += dropped
+        logger.warning("dropped %d frames queued for slow client %s", dropped, self.addr)
 
     def _create_response_json_content(self):
-        action = self.request.get("action")
-        if action == "send_message":
-            message = html.escape(self.request.get("value"))
-            message_and_name = '<font color=' + self.all_clients[self.addr]['colour'] + '><b>&lt;' + self.all_clients[self.addr]['name'] + '&gt;</b> ' + message + '</font>'
-            content = {"result": message_and_name}
-        elif action == "change_name":
-            name = html.escape(self.request.get("value"))
-            self.all_clients[self.addr]['name'] = name
-            content = {'result': 'Name successfully changed to ' + name}
-        elif action == "on_connection":
-            print(self.request.get("value") + ' Connected')
-            return {}
-        elif action == "first_entry":
-            color = pygame.Color("#000000")
-            color.hsla = 360 * ((len(self.all_clients) * self.golden_ratio) % 1), 50, 70, 100
-            hex_code_map = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'A', 'B', 'C', 'D', 'E', 'F']
-            red_first = hex_code_map[int(math.floor(color.r / 16.0))]
-            red_second = hex_code_map[int(math.floor((color.r % 16.0)))]
-            green_first = hex_code_map[int(math.floor(color.g / 16.0))]
-            green_second = hex_code_map[int(math.floor((color.g % 16.0)))]
-            blue_first = hex_code_map[int(math.floor(color.b / 16.0))]
-            blue_second = hex_code_map[int(math.floor((color.b % 16.0)))]
-            color_code = '#' + red_first + red_second + green_first + green_second + blue_first + blue_second
-
-            name = html.escape(self.request.get("value"))
-            self.all_clients[self.addr]['name'] = name
-            self.all_clients[self.addr]['colour'] = color_code
-            content = {'result': name + ' has entered the chat...'}
-        elif action == "quit":
+        if self.request.get("action") == "quit":
+            if self.sessions is not None:
+                self.sessions.end(self.connection)
             self.close()
             return {}
-            # message = self.request.get("value")
-            # content = {"result": message}
-        else:
-            content = {"result": f'Error: invalid action "{action}".'}
-        content_encoding = "utf-8"
-        return {
-                "content_bytes": self._json_encode(content, content_encoding),
-                "content_type": "text/json",
-                "content_encoding": content_encoding,
-            }
+        if self.request.get("action") == "resume" and self.sessions is not None:
+            self.resume_session()
+            return {}
+        if self.request.get("action") == "on_connection":
+            ping_interval = self.heartbeat_monitor.settings.ping_interval if self.heartbeat_monitor else None
+            reply = negotiate_protocol(self.request, self.connection, self.send_limits.compression_threshold,
+                                       ping_interval, resumable=self.sessions is not None)
+            if self.heartbeat_monitor is not None:
+                self.heartbeat_monitor.handshake_done(self.connection)
+            if reply is not None:
+                # sent uncompressed, the client only learns it can expect compression from this reply
+                self.queue_frame(encode_frame(create_json_response(reply), self.connection.protocol))
+        replay_history = self.history is not None and joins_new_room(self.request, self.connection, self.rooms)
+        self.response_room, content = create_json_response_content(self.request, self.connection, self.connections,
+                                                                    self.rooms)
+        if content is None:
+            return {}
+        if self.request.get("action") == "first_entry" and self.sessions is not None and self.connection.sequenced:
+            token = self.sessions.create(self.connection)
+            self.queue_frame(encode_frame(create_json_response({'session': token}), *self.connection.frame_format))
+        if replay_history and self.response_room is not None:
+            # catch the client up before it sees its own join announced
+            self.queue_history(self.response_room)
+        return create_json_response(content)
+
+    def queue_history(self, room):
+        for frame in history_frames(self.history, room, *self.connection.frame_format,
+                                    last=self.request.get("history"), since=self.request.get("history_since")):
+            self.queue_frame(frame)
+
+    def resume_session(self):
+        reply, missed, previous = resume_session(self.request, self.connection, self.connections, self.rooms,
+                                                 self.sessions)
+        if previous is not None and previous.message.sock is not None:
+            logger.info("%s resumed the session of %s, closing the old connection", self.addr, previous.addr)
+            previous.message.close()
+        self.queue_frame(encode_frame(create_json_response(reply), *self.connection.frame_format))
+        for message in missed:
+            self.queue_frame(encode_frame(message, *self.connection.frame_format))
 
     def _create_response_binary_content(self):
-        return {
-                "content_bytes": b"First 10 bytes of request: "
-                + self.request[:10],
-                "content_type": "binary/custom-server-binary-type",
-                "content_encoding": "binary",
-            }
+        self.response_room = DEFAULT_ROOM
+        return create_binary_response(self.request)
 
     def process_events(self, mask):
         if mask & selectors.EVENT_READ:
             self.read()
         if mask & selectors.EVENT_WRITE:
-            self.broadcast()
+            self.write()
 
     def read(self):
-        self.clear_server_message_on_new_read()
         self._read()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
-
-        if self._jsonheader_len is not None and self.jsonheader is None:
-            self.process_jsonheader()
-
-        if self.jsonheader and self.request is None:
-            self.process_request()
-
-    def broadcast(self):
-        if self.request and not self.response_created:
+        # a single read can hold several pipelined requests, and the tail of the buffer may be a partial one
+        decode_start = time.perf_counter()
+        requests = self._frame_decoder.frames()
+        if requests:
+            self.metrics.frames_received.inc(len(requests))
+            self.metrics.frame_decode_seconds.observe((time.perf_counter() - decode_start) / len(requests),
+                                                      len(requests))
+        for request in requests:
+            self.process_request(request)
             self.create_response()
+            if self.sock is None:
+                # closed by a 'quit' request
+                return
+
+    def write(self):
+        self._write()
 
-        self._broadcast()
+        if self.reads_paused and self.send_queue.pending_bytes <= self.send_limits.low_watermark:
+            logger.info("resuming reads from client %s", self.addr)
+            self.reads_paused = False
+        if self.sock is not None:
+            # stops listening for write events once everything is sent
+            self._update_selector_events()
 
     def close(self):
-        print("closing connection to", self.addr)
+        logger.info("closing connection to %s", self.addr)
         try:
             self.selector.unregister(self.sock)
         except Exception as e:
-            print(
-                f"error: selector.unregister() exception for",
-                f"{self.addr}: {repr(e)}",
-            )
+            logger.error("selector.unregister() exception for %s: %r", self.addr, e)
 
         try:
             self.sock.close()
         except OSError as e:
-            print(
-                f"error: socket.close() exception for",
-                f"{self.addr}: {repr(e)}",
-            )
+            logger.error("socket.close() exception for %s: %r", self.addr, e)
         finally:
             # Delete reference to socket object for garbage collection
             self.sock = None
-            self.all_clients[self.addr] = None
-
-    def process_protoheader(self):
-        hdrlen = 2
-        if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
-            )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-
-    def process_jsonheader(self):
-        hdrlen = self._jsonheader_len
-        if len(self._recv_buffer) >= hdrlen:
-            self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
-            )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-            for reqhdr in (
-                "byteorder",
-                "content-length",
-                "content-type",
-                "content-encoding",
-            ):
-                if reqhdr not in self.jsonheader:
-                    raise ValueError(f'Missing required header "{reqhdr}".')
-
-    def process_request(self):
-        content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
-            return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
-        if self.jsonheader["content-type"] == "text/json":
-            encoding = self.jsonheader["content-encoding"]
-            self.request = self._json_decode(data, encoding)
-            print("received request", repr(self.request), "from", self.addr)
+            self.connections.remove(self.addr)
+            if self.heartbeat_monitor is not None:
+                self.heartbeat_monitor.forget(self.connection)
+            if self.sessions is not None:
+                self.sessions.detach(self.connection, self.rooms.rooms_of(self.addr))
+            self.rooms.leave_all(self.addr)
+            self.metrics.connection_closed()
+
+    def process_request(self, request):
+        self.request_type = request["type"]
+        self.request = request["content"]
+        if self.request_type == "text/json":
+            logger.debug("received request %r from %s", self.request, self.addr)
         else:
             # Binary or unknown content-type
-            self.request = data
-            print(
-                f'received {self.jsonheader["content-type"]} request from',
-                self.addr,
-            )
-        # Set selector to listen for broadcast events, we're done reading.
-        self._set_selector_events_mask("w")
+            logger.debug("received %s request from %s", self.request_type, self.addr)
+
+    def allow_request(self):
+        # refused requests are dropped before anything is done with them, or answered with an error
+        if self.rate_limits.allow(self.connection, request_action(self.request_type, self.request)):
+            return True
+        if self.rate_limits.should_answer(self.connection):
+            self.queue_frame(encode_frame(create_json_response(rate_limited_content(self.request_type, self.request)),
+                                          *self.connection.frame_format))
+        return False
 
     def create_response(self):
-        if self.jsonheader["content-type"] == "text/json":
+        if self.rate_limits is not None and not self.allow_request():
+            return
+        if self.request_type == "text/json":
             response = self._create_response_json_content()
         else:
             # Binary or unknown content-type
             response = self._create_response_binary_content()
 
-        if len(response) > 0:
-            message = self._create_message(**response)
-            self.response_created = True
-            for client_addr in self.all_clients:
-                self.all_clients[client_addr]['send_buffer'] += message
+        if len(response) == 0:
+            return
+        if self.response_room is None:
+            # a reply for this client only
+            self.queue_frame(encode_frame(response, *self.connection.frame_format))
+            return
+        if self.sessions is not None and self.request_type == "text/json":
+            self.sessions.sequence(self.response_room, response)
+        message = queue_for_clients(self.rooms.members(self.response_room), response)
+        if self.history is not None and self.request_type == "text/json":
+            self.history.append(self.response_room, message)
+        if self.peer_channel is not None:
+            self.peer_channel.publish(message)
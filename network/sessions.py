@@ -0,0 +1,170 @@
+import time
+import secrets
+from collections import deque, OrderedDict
+
+
+"""
+Resuming a dropped connection without rejoining the chat.
+
+Every broadcast to a room is given the room's next sequence number and kept in a short replay buffer for the room.
+A client is given a session token when it enters the chat, and when its connection drops the session keeps its name,
+colour and rooms for a while. If the client reconnects within that time and sends a 'resume' request with its token
+and the last sequence number it saw in each room, it gets its place back without a join announcement and is sent only
+the messages it missed. A client on flaky Wi-Fi can drop and reconnect many times without the room seeing it enter
+again each time.
+
+The buffers are bounded in the number of messages per room and the number of rooms, so a client away for longer
+than the buffers cover is told its replay is incomplete.
+"""
+
+DEFAULT_REPLAY_MESSAGES = 256
+DEFAULT_RESUME_TIMEOUT = 60.0
+DEFAULT_REPLAY_ROOMS = 1024
+
+
+class ReplayBuffer:
+    __slots__ = ('sequence', 'messages', 'dropped_through')
+
+    def __init__(self, first_sequence, size):
+        # the last sequence number given out in the room
+        self.sequence = first_sequence
+        # (sequence number, message) pairs, oldest first
+        self.messages = deque(maxlen=size)
+        # every message numbered up to this one is no longer held
+        self.dropped_through = first_sequence
+
+    def append(self, message):
+        self.sequence += 1
+        if len(self.messages) == self.messages.maxlen:
+            self.dropped_through = self.messages[0][0]
+        self.messages.append((self.sequence, message))
+        return self.sequence
+
+    def since(self, sequence):
+        # Returns the messages numbered after sequence, oldest first, and whether every one of them is still held.
+        missed = [message for message_sequence, message in self.messages if message_sequence > sequence]
+        return missed, sequence >= self.dropped_through
+
+
+class Session:
+    __slots__ = ('token', 'connection', 'name', 'colour', 'rooms', 'detached_time')
+
+    def __init__(self, token, connection):
+        self.token = token
+        # the connection using the session, None while the client is away
+        self.connection = connection
+        # kept from the connection when it closes
+        self.name = connection.name
+        self.colour = connection.colour
+        self.rooms = set()
+        self.detached_time = None
+
+
+class SessionStore:
+    def __init__(self, replay_messages=DEFAULT_REPLAY_MESSAGES, resume_timeout=DEFAULT_RESUME_TIMEOUT,
+                 replay_rooms=DEFAULT_REPLAY_ROOMS, first_sequence=0):
+        # first_sequence should be above any sequence number a client may already have seen, such as in a replayed
+        # history, so sequence numbers keep going up across restarts
+        self.replay_messages = replay_messages
+        self.resume_timeout = resume_timeout
+        self.replay_rooms = replay_rooms
+        # room -> ReplayBuffer, least recently used first
+        self._buffers = OrderedDict()
+        # the highest sequence number given out in any room, a room starts counting from here
+        self.last_sequence = first_sequence
+        # the highest sequence number that was in a buffer dropped to make room for another
+        self._evicted_through = first_sequence
+        # token -> Session
+        self._sessions = {}
+        # token -> time the connection closed, oldest first
+        self._detached = OrderedDict()
+        self.resumed = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def sequence(self, room, message):
+        # Numbers a message broadcast to a room and keeps it for replay, returns its sequence number.
+        buffer = self._buffers.get(room)
+        if buffer is None:
+            buffer = self._buffers[room] = ReplayBuffer(self.last_sequence, self.replay_messages)
+            if len(self._buffers) > self.replay_rooms:
+                _, evicted = self._buffers.popitem(last=False)
+                self._evicted_through = max(self._evicted_through, evicted.sequence)
+        else:
+            self._buffers.move_to_end(room)
+        message["content"]["seq"] = buffer.append(message)
+        self.last_sequence = max(self.last_sequence, buffer.sequence)
+        return buffer.sequence
+
+    def missed(self, room, sequence):
+        # Returns the messages broadcast to a room after sequence and whether that is all of them.
+        buffer = self._buffers.get(room)
+        if buffer is None:
+            return [], sequence >= self._evicted_through
+        return buffer.since(sequence)
+
+    def create(self, connection):
+        # Starts a session for a connection, returns its token.
+        self.end(connection)
+        token = secrets.token_urlsafe(16)
+        connection.session = self._sessions[token] = Session(token, connection)
+        return token
+
+    def detach(self, connection, rooms):
+        # Keeps a closed connection's session for resume_timeout seconds, along with the rooms it was in.
+        session = connection.session
+        connection.session = None
+        if session is None or session.connection is not connection:
+            # the session has already moved to a newer connection
+            return
+        session.connection = None
+        session.name = connection.name
+        session.colour = connection.colour
+        session.rooms = set(rooms)
+        session.detached_time = time.monotonic()
+        self._detached[session.token] = session.detached_time
+        self.expire()
+
+    def end(self, connection):
+        # For a client that quit, there is nothing to resume.
+        session = connection.session
+        connection.session = None
+        if session is not None and session.connection is connection:
+            del self._sessions[session.token]
+
+    def resume(self, token, connection):
+        # Moves a session to a new connection. Returns the session and the connection it was on if that is still open,
+        # as a client can reconnect before the server notices its old connection has gone. The session is None for
+        # unknown and expired tokens.
+        self.expire()
+        session = self._sessions.get(token) if isinstance(token, str) else None
+        if session is None:
+            return None, None
+        if connection.session is not session:
+            self.end(connection)
+        previous = session.connection
+        if previous is connection:
+            previous = None
+        elif previous is not None:
+            session.name = previous.name
+            session.colour = previous.colour
+            previous.session = None
+        self._detached.pop(token, None)
+        session.connection = connection
+        session.detached_time = None
+        connection.session = session
+        self.resumed += 1
+        return session, previous
+
+    def expire(self):
+        # Forgets sessions whose client has been away longer than resume_timeout.
+        oldest = time.monotonic() - self.resume_timeout
+        while self._detached:
+            token, detached_time = next(iter(self._detached.items()))
+            if detached_time >= oldest:
+                break
+            del self._detached[token]
+            del self._sessions[token]
+            self.expired += 1
@@ -0,0 +1,173 @@
+import logging
+import os
+import socket
+import shutil
+import signal
+import tempfile
+import multiprocessing
+from collections import deque
+
+from network.server import Server, DEFAULT_PORT, DEFAULT_BACKLOG
+from network.message_log import MessageLog
+from network.metrics import start_metrics_server
+from network.logs import configure_logging
+from network.discovery import ServerBeacon
+from network.sessions import SessionStore
+
+
+"""
+Runs several selector based servers in separate processes, all accepting on the same port with SO_REUSEPORT. Each
+worker only knows about its own clients, so every broadcast frame is also published to the other workers over a
+Unix datagram socket and they send it on to their clients.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+# frames held for a peer whose receive queue is full before the oldest are dropped
+MAX_PENDING_PEER_FRAMES = 4096
+
+
+class PeerChannel:
+    def __init__(self, own_path, peer_paths):
+        self.own_path = own_path
+        self.peer_paths = peer_paths
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(own_path)
+        self.sock.setblocking(False)
+        self.max_frame_size = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        # a peer's datagram queue is short, so frames it can't take yet wait here and are retried
+        self.pending = {peer_path: deque(maxlen=MAX_PENDING_PEER_FRAMES) for peer_path in peer_paths}
+
+    def publish(self, message):
+        if len(message) > self.max_frame_size:
+            logger.error("broadcast frame of %d bytes is too large to share with other workers", len(message))
+            return
+        for peer_path in self.peer_paths:
+            pending = self.pending[peer_path]
+            if len(pending) == pending.maxlen:
+                logger.error("dropping broadcast to %s, the worker is not keeping up", peer_path)
+            pending.append(message)
+        self.send_pending()
+
+    def has_pending(self):
+        return any(self.pending.values())
+
+    def send_pending(self):
+        for peer_path, pending in self.pending.items():
+            while pending:
+                try:
+                    self.sock.sendto(pending[0], peer_path)
+                except BlockingIOError:
+                    # the peer's receive queue is full, try again once it has had a chance to read
+                    break
+                except OSError as e:
+                    # the peer is not up yet or has gone away
+                    logger.error("could not publish broadcast to %s: %r", peer_path, e)
+                    pending.clear()
+                    break
+                pending.popleft()
+
+    def receive_frames(self):
+        frames = []
+        while True:
+            try:
+                frames.append(self.sock.recv(self.max_frame_size))
+            except BlockingIOError:
+                return frames
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.own_path)
+        except OSError:
+            pass
+
+
+def stop_on_sigterm(signum, frame):
+    raise SystemExit(0)
+
+
+def run_worker(host, port, backlog, send_limits, worker_index, channel_paths, history_dir, history_options,
+               metrics_address, log_options, beacon_options, heartbeat_settings, session_options, rate_limits):
+    if log_options is not None:
+        # a queued log listener thread doesn't survive into the worker process, so logging is set up again
+        configure_logging(**log_options)
+    peer_paths = [path for index, path in enumerate(channel_paths) if index != worker_index]
+    peer_channel = PeerChannel(channel_paths[worker_index], peer_paths)
+    history = None
+    if history_dir is not None:
+        # every worker sees every broadcast, so each keeps a full history of its own
+        history = MessageLog(os.path.join(history_dir, f'worker_{worker_index}'), **history_options)
+    beacon = None
+    if beacon_options is not None:
+        # each worker advertises its own clients, listeners add the workers up
+        beacon = ServerBeacon(port=port, worker=worker_index, **beacon_options)
+    sessions = None
+    if session_options is not None:
+        sessions = SessionStore(first_sequence=history.next_sequence if history is not None else 0, **session_options)
+    server = Server(host=host, port=port, backlog=backlog, reuse_port=True, peer_channel=peer_channel,
+                    send_limits=send_limits, history=history, beacon=beacon, heartbeat_settings=heartbeat_settings,
+                    sessions=sessions, rate_limits=rate_limits)
+    if metrics_address is not None:
+        # workers are separate processes, so each serves its own metrics on the next port along
+        metrics_host, metrics_port = metrics_address
+        start_metrics_server(server.metrics, metrics_host, metrics_port + worker_index)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+class ShardedServer:
+    def __init__(self, host=None, port=DEFAULT_PORT, backlog=DEFAULT_BACKLOG, num_workers=None, send_limits=None,
+                 history_dir=None, history_options=None, metrics_address=None, log_options=None,
+                 beacon_options=None, heartbeat_settings=None, session_options=None, rate_limits=None):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('Sharded servers need SO_REUSEPORT, which this platform does not support.')
+        self.server_hosting_ip = host if host is not None else Server.get_ip_for_hosting()
+        self.network_port = port
+        self.backlog = backlog
+        self.send_limits = send_limits
+        # keyword arguments for each worker's MessageLog
+        self.history_dir = history_dir
+        self.history_options = history_options if history_options is not None else {}
+        # (host, first port) to serve worker metrics on
+        self.metrics_address = metrics_address
+        # keyword arguments for configure_logging() in each worker
+        self.log_options = log_options
+        # keyword arguments for each worker's ServerBeacon, other than the port and worker index, or None for no beacon
+        self.beacon_options = beacon_options
+        self.heartbeat_settings = heartbeat_settings
+        # keyword arguments for each worker's SessionStore, or None for clients not to resume
+        self.session_options = session_options
+        self.rate_limits = rate_limits
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+        self.workers = []
+
+    def serve_forever(self):
+        # a plain kill would otherwise leave the workers running, still accepting on the port
+        signal.signal(signal.SIGTERM, stop_on_sigterm)
+        channel_dir = tempfile.mkdtemp(prefix='network_chat_')
+        channel_paths = [os.path.join(channel_dir, f'worker_{index}.sock') for index in range(self.num_workers)]
+        logger.info('Starting %d server workers on %s', self.num_workers, (self.server_hosting_ip, self.network_port))
+        try:
+            for worker_index in range(self.num_workers):
+                worker = multiprocessing.Process(target=run_worker,
+                                                 args=(self.server_hosting_ip, self.network_port, self.backlog,
+                                                       self.send_limits, worker_index, channel_paths,
+                                                       self.history_dir, self.history_options,
+                                                       self.metrics_address, self.log_options,
+                                                       self.beacon_options, self.heartbeat_settings,
+                                                       self.session_options, self.rate_limits),
+                                                 daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            for worker in self.workers:
+                worker.join()
+        finally:
+            for worker in self.workers:
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+            shutil.rmtree(channel_dir, ignore_errors=True)
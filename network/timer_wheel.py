@@ -0,0 +1,93 @@
+import time
+
+
+"""
+A hashed timer wheel, for keeping a timeout on every connection without a heap or a scan of all of them.
+
+Time is cut into ticks and each tick hashes to one of a fixed number of slots. Scheduling and cancelling a timer are a
+set insert and removal, and advancing the wheel by one tick only visits the timers in that tick's slot. Timers more
+than one turn of the wheel away wait out the extra turns in their slot. Timers never fire early but can fire up to a
+tick late, which is fine for timeouts measured in seconds.
+"""
+
+DEFAULT_TICK = 0.5
+DEFAULT_SLOTS = 512
+
+
+class Timer:
+    __slots__ = ('wheel', 'slot', 'rounds', 'callback', 'args')
+
+    def __init__(self, wheel, slot, rounds, callback, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        if self.slot is not None:
+            self.wheel.slots[self.slot].discard(self)
+            self.wheel.num_timers -= 1
+            self.slot = None
+
+
+class TimerWheel:
+    def __init__(self, tick=DEFAULT_TICK, num_slots=DEFAULT_SLOTS, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.slots = [set() for _ in range(num_slots)]
+        self.num_timers = 0
+        # the last tick that has been processed, counted from the clock's zero
+        self.current_tick = self._tick_at(self.clock())
+
+    def __len__(self):
+        return self.num_timers
+
+    def _tick_at(self, now):
+        return int(now / self.tick)
+
+    def schedule(self, delay, callback, *args):
+        # Calls callback(*args) once delay seconds have passed, returns a Timer that can be cancelled.
+        now = self.clock()
+        if self.num_timers == 0:
+            # nothing was waiting, so the ticks since the wheel last moved don't need processing
+            self.current_tick = self._tick_at(now)
+        # the first tick to start after the deadline, so a timer never fires early
+        ticks = self._tick_at(now + delay) + 1 - self.current_tick
+        num_slots = len(self.slots)
+        slot = (self.current_tick + ticks) % num_slots
+        timer = Timer(self, slot, (ticks - 1) // num_slots, callback, args)
+        self.slots[slot].add(timer)
+        self.num_timers += 1
+        return timer
+
+    def time_until_next_tick(self):
+        # seconds until advance() next has work to do, or None when there are no timers
+        if self.num_timers == 0:
+            return None
+        return max(0.0, (self.current_tick + 1) * self.tick - self.clock())
+
+    def advance(self):
+        # Processes every tick that has passed, firing the timers that are due. Returns the number fired.
+        now_tick = self._tick_at(self.clock())
+        fired = 0
+        num_slots = len(self.slots)
+        while self.current_tick < now_tick and self.num_timers:
+            self.current_tick += 1
+            slot = self.slots[self.current_tick % num_slots]
+            # copied as callbacks may schedule or cancel timers in this slot
+            for timer in list(slot):
+                if timer.slot is None:
+                    continue
+                if timer.rounds > 0:
+                    timer.rounds -= 1
+                    continue
+                timer.cancel()
+                timer.callback(*timer.args)
+                fired += 1
+        self.current_tick = now_tick
+        return fired
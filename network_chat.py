@@ -1,17 +1,40 @@
+import logging
+import socket
+
 import pygame
 import pygame_gui
 
-from network.server import Server
+from network.server import Server, DEFAULT_PORT
 from network.client import Client
+from network.discovery import ServerBeacon, DiscoveryListener
+from network.heartbeat import HeartbeatSettings
+from network.sessions import SessionStore
+from network.rate_limits import RateLimits
+from network.rooms import DEFAULT_ROOM
+from network.logs import configure_logging
 
 from pygame_gui.ui_manager import UIManager
 from pygame_gui.elements.ui_button import UIButton
 
 from gui.chat_room_window import ChatWindow
 from gui.enter_name_window import EnterNameWindow
+from gui.server_bowser_window import ServerBrowserWindow
+from gui.enter_server_name_window import EnterServerNameWindow
+
+
+logger = logging.getLogger(__name__)
 
+CLIENT_NETWORK_THREAD = True  # Run the client's networking in its own thread so it never holds up a frame.
 
-SERVER_IP = '192.168.1.36'  # This has to be set to whatever IP is printed to the console when you create a server.
+
+def parse_server_address(text, default_port=DEFAULT_PORT):
+    # 'host' or 'host:port' to a (host, port) pair, raises ValueError for anything else
+    host, separator, port = text.strip().rpartition(':')
+    if not separator:
+        host, port = port, ''
+    if not host:
+        raise ValueError('A server address is needed.')
+    return host, int(port) if port else default_port
 
 
 class NetworkChatApp:
@@ -38,10 +61,14 @@ class NetworkChatApp:
 
         self.chat_window = None
         self.name_entry_window = None
+        self.server_browser_window = None
+        self.server_address_window = None
 
         # networking
         self.server = None
         self.client = None
+        # listens for server beacons while the server browser is open
+        self.discovery = None
 
         self.clock = pygame.time.Clock()
         self.running = True
@@ -55,28 +82,55 @@ class NetworkChatApp:
                     self.running = False
 
                 if event.type == pygame_gui.UI_BUTTON_PRESSED:
-                    if event.ui_element == self.start_server_button:
-                        self.server = Server()
+                    if event.ui_element == self.start_server_button and self.server is None:
+                        self.server = Server(beacon=ServerBeacon(name=socket.gethostname(), port=DEFAULT_PORT),
+                                             heartbeat_settings=HeartbeatSettings(), sessions=SessionStore(),
+                                             rate_limits=RateLimits())
 
                     if event.ui_element == self.join_server_button:
-                        self.client = Client(server_ip='192.168.1.36', app=self)
-                        enter_name_rect = pygame.Rect(100, 100, 300, 60)
-                        enter_name_rect.center = (int(self.window_size[0]/2), int(self.window_size[1]/2))
-                        self.name_entry_window = EnterNameWindow(rect=enter_name_rect,
-                                                                 manager=self.ui_manager)
+                        self.open_server_browser()
+
+                    if self.server_browser_window is not None:
+                        if event.ui_element == self.server_browser_window.join_button:
+                            self.join_discovered_server(self.server_browser_window.selected_server())
+                        elif event.ui_element == self.server_browser_window.quick_join_button:
+                            self.join_discovered_server(self.discovery.best_server()
+                                                        if self.discovery is not None else None)
+                        elif event.ui_element == self.server_browser_window.enter_address_button:
+                            self.open_server_address_window()
+
+                if (self.server_browser_window is not None
+                        and event.type in (pygame_gui.UI_SELECTION_LIST_NEW_SELECTION,
+                                           pygame_gui.UI_SELECTION_LIST_DOUBLE_CLICKED_SELECTION)
+                        and event.ui_element == self.server_browser_window.server_list):
+                    if event.type == pygame_gui.UI_SELECTION_LIST_NEW_SELECTION:
+                        self.server_browser_window.update_server_details()
+                    else:
+                        self.join_discovered_server(self.server_browser_window.selected_server())
+
+                if event.type == pygame_gui.UI_WINDOW_CLOSE:
+                    if event.ui_element == self.server_browser_window:
+                        self.server_browser_window = None
+                        self.close_server_browser()
+                    elif event.ui_element == self.server_address_window:
+                        self.server_address_window = None
 
                 if event.type == pygame_gui.UI_TEXT_ENTRY_FINISHED:
                     if self.chat_window is not None and event.ui_element == self.chat_window.chat_entry:
-                        self.client.send_chat_message(event.text)
                         self.chat_window.chat_entry.set_text('')
+                        self.send_chat_text(event.text)
+                    elif (self.server_address_window is not None
+                          and event.ui_element == self.server_address_window.server_name_entry):
+                        try:
+                            host, port = parse_server_address(event.text)
+                        except ValueError:
+                            logger.warning('%r is not a server address', event.text)
+                        else:
+                            self.join_server(host, port)
                     elif self.name_entry_window is not None and event.ui_element == self.name_entry_window.name_entry:
                         self.client.first_entry(event.text)
                         self.name_entry_window.kill()
-                        if self.chat_window is not None:
-                            self.chat_window.kill()
-                        self.chat_window = ChatWindow(rect=pygame.Rect(50, 50, 700, 500),
-                                                      room_name='Hello World',
-                                                      manager=self.ui_manager)
+                        self.open_chat_window(DEFAULT_ROOM)
 
                 self.ui_manager.process_events(event)
 
@@ -86,6 +140,9 @@ class NetworkChatApp:
             if self.client is not None:
                 self.client.update()
 
+            if self.discovery is not None and (self.discovery.poll() or self.discovery.expire()):
+                self.server_browser_window.set_servers(self.discovery.servers())
+
             self.ui_manager.update(time_delta)
 
             self.window_surface.blit(self.background_surface, (0, 0))
@@ -93,7 +150,75 @@ class NetworkChatApp:
 
             pygame.display.flip()
 
+        self.close_server_browser()
+        if self.client is not None:
+            self.client.close()
+
+    def send_chat_text(self, text):
+        # '/join <room>' and '/leave' move the chat window between rooms, anything else is said in the window's room.
+        # The client only shows the lines for the room in the window.
+        command, _, room = text.partition(' ')
+        room = room.strip()
+        if command == '/join' and room:
+            if room not in self.client.rooms and room != DEFAULT_ROOM:
+                self.client.join_room(room)
+            self.open_chat_window(room)
+        elif command == '/leave':
+            if self.chat_window.room_name != DEFAULT_ROOM:
+                self.client.leave_room(self.chat_window.room_name)
+                self.open_chat_window(DEFAULT_ROOM)
+        else:
+            self.client.send_chat_message(text, self.chat_window.room_name)
+
+    def open_chat_window(self, room):
+        if self.chat_window is not None:
+            self.chat_window.kill()
+        self.chat_window = ChatWindow(rect=pygame.Rect(50, 50, 700, 500), room_name=room, manager=self.ui_manager)
+
+    def centred_rect(self, width, height):
+        rect = pygame.Rect(0, 0, width, height)
+        rect.center = (int(self.window_size[0]/2), int(self.window_size[1]/2))
+        return rect
+
+    def open_server_browser(self):
+        if self.server_browser_window is not None:
+            return
+        try:
+            self.discovery = DiscoveryListener()
+        except OSError as e:
+            # another program has the discovery port, servers can still be joined by address
+            logger.warning('Not listening for servers on the LAN: %r', e)
+        self.server_browser_window = ServerBrowserWindow(rect=self.centred_rect(500, 400), manager=self.ui_manager)
+
+    def close_server_browser(self):
+        if self.discovery is not None:
+            self.discovery.close()
+            self.discovery = None
+        if self.server_browser_window is not None:
+            self.server_browser_window.kill()
+            self.server_browser_window = None
+        if self.server_address_window is not None:
+            self.server_address_window.kill()
+            self.server_address_window = None
+
+    def open_server_address_window(self):
+        if self.server_address_window is None:
+            self.server_address_window = EnterServerNameWindow(rect=self.centred_rect(300, 60),
+                                                               manager=self.ui_manager)
+
+    def join_discovered_server(self, server):
+        if server is not None:
+            self.join_server(server.address, server.port)
+
+    def join_server(self, host, port):
+        self.close_server_browser()
+        if self.client is not None:
+            self.client.close()
+        self.client = Client(server_ip=host, port=port, app=self, threaded=CLIENT_NETWORK_THREAD)
+        self.name_entry_window = EnterNameWindow(rect=self.centred_rect(300, 60), manager=self.ui_manager)
+
 
 if __name__ == '__main__':
+    configure_logging()
     app = NetworkChatApp()
     app.run()
@@ -0,0 +1,154 @@
+import json
+import struct
+import unittest
+
+from network.framing import (PROTOCOL_V1, PROTOCOL_V2, MAX_FRAME_LENGTH, FrameDecoder, V2_HEADER, V2_MARKER,
+                             V2_TYPE_BINARY, V2_BINARY_CONTENT_TYPE, V2_FLAG_SEQUENCED, V2_FLAG_COMPRESSED,
+                             encode_frame, decode_frame)
+
+
+class ChunkedSocket:
+    # hands out the data given to it one chunk per recv_into() call, like a socket reading a slow sender
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view):
+        chunk = self.chunks.pop(0)
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def v1_header_only(content_length):
+    jsonheader = json.dumps({"byteorder": "big", "content-length": content_length, "content-type": "text/json",
+                             "content-encoding": "utf-8"}).encode("utf-8")
+    return struct.pack(">H", len(jsonheader)) + jsonheader
+
+
+class FrameLengthLimitTest(unittest.TestCase):
+    def test_v2_length_over_limit_is_refused_before_the_buffer_grows(self):
+        decoder = FrameDecoder()
+        sock = ChunkedSocket([bytes([V2_MARKER, 0x00, 0x7F, 0xFF, 0xFF, 0xFF]), b"x"])
+        decoder.recv_into(sock)
+        with self.assertRaises(ValueError):
+            decoder.recv_into(sock)
+        self.assertLess(len(decoder._buffer), 1024 * 1024)
+
+    def test_largest_v2_length_is_refused(self):
+        decoder = FrameDecoder()
+        decoder.feed(V2_HEADER.pack(V2_MARKER | V2_TYPE_BINARY, 0, 0xFFFFFFFF))
+        with self.assertRaises(ValueError):
+            decoder.frames()
+
+    def test_v1_content_length_over_limit_is_refused(self):
+        decoder = FrameDecoder()
+        decoder.feed(v1_header_only(MAX_FRAME_LENGTH + 1))
+        with self.assertRaises(ValueError):
+            decoder.frames()
+
+    def test_v1_content_length_must_be_a_number(self):
+        with self.assertRaises(ValueError):
+            decode_frame(v1_header_only("12"))
+
+    def test_frames_within_the_limit_still_decode(self):
+        message = dict(type="text/json", encoding="utf-8", content={"result": "hello"})
+        decoder = FrameDecoder()
+        for protocol in (PROTOCOL_V1, PROTOCOL_V2):
+            decoder.feed(encode_frame(message, protocol))
+        self.assertEqual([frame["content"] for frame in decoder.frames()], [{"result": "hello"}] * 2)
+
+
+def json_message(**content):
+    return dict(type="text/json", encoding="utf-8", content=content)
+
+
+# one of each shape version 2 encodes compactly, and some it falls back to JSON for
+V2_MESSAGES = [
+    json_message(result="<font color=#8CD8CB><b>&lt;dan&gt;</b> hi</font>"),
+    json_message(result="standup in 5", room="dev"),
+    json_message(action="send_message", value="hello there"),
+    json_message(action="join_room", value="ops", room="dev"),
+    json_message(result="ざわ こんにちは世界 😀", room="部屋"),
+    json_message(protocol=2, compression="deflate", heartbeat=15.0),
+    json_message(result="room name too long for a prefix", room="r" * 300),
+    dict(type=V2_BINARY_CONTENT_TYPE, encoding="binary", content=bytes(range(256))),
+]
+
+
+def decode_all(frames, chunk_size):
+    # feeds the frames to a decoder chunk_size bytes at a time, as if they arrived in that many partial reads
+    data = b"".join(frames)
+    decoder = FrameDecoder(initial_size=16)
+    decoded = []
+    for start in range(0, len(data), chunk_size):
+        decoder.feed(data[start:start + chunk_size])
+        decoded.extend(decoder.frames())
+    return decoded
+
+
+class V2RoundTripTest(unittest.TestCase):
+    def test_every_shape_round_trips(self):
+        for message in V2_MESSAGES:
+            frame = encode_frame(message, PROTOCOL_V2)
+            self.assertEqual(decode_frame(frame), (message, len(frame)))
+
+    def test_sequence_numbers_round_trip(self):
+        for sequence in (0, 1, 127, 128, 16383, 16384, 2 ** 40):
+            message = json_message(result="hi", room="dev", seq=sequence)
+            frame = encode_frame(message, PROTOCOL_V2, sequenced=True)
+            self.assertTrue(frame[1] & V2_FLAG_SEQUENCED)
+            self.assertEqual(decode_frame(frame)[0], message)
+
+    def test_sequence_number_is_left_out_for_clients_that_dont_read_it(self):
+        frame = encode_frame(json_message(result="hi", seq=7), PROTOCOL_V2)
+        self.assertEqual(decode_frame(frame)[0], json_message(result="hi"))
+
+    def test_frames_split_across_partial_reads(self):
+        frames = [encode_frame(message, PROTOCOL_V2) for message in V2_MESSAGES]
+        frames += [encode_frame(message, PROTOCOL_V1) for message in V2_MESSAGES[:4]]
+        for chunk_size in (1, 2, 5, 7, 4096):
+            self.assertEqual(decode_all(frames, chunk_size), V2_MESSAGES + V2_MESSAGES[:4])
+
+
+class CompressedRoundTripTest(unittest.TestCase):
+    long_line = ("<font color=#8CD8CB><b>&lt;dan&gt;</b> " + "the quick brown fox jumps over the lazy dog " * 20 +
+                 "</font>")
+
+    def compressed_messages(self):
+        return [json_message(result=self.long_line), json_message(result=self.long_line, room="dev", seq=300),
+                json_message(action="send_message", value=self.long_line, room="dev"),
+                dict(type=V2_BINARY_CONTENT_TYPE, encoding="binary", content=b"\x00" * 4096)]
+
+    def test_compressed_frames_round_trip(self):
+        for message in self.compressed_messages():
+            frame = encode_frame(message, PROTOCOL_V2, compression_threshold=32, sequenced=True)
+            self.assertTrue(frame[1] & V2_FLAG_COMPRESSED)
+            self.assertLess(len(frame), 1000)
+            self.assertEqual(decode_frame(frame), (message, len(frame)))
+
+    def test_short_content_is_not_compressed(self):
+        frame = encode_frame(json_message(result="hi"), PROTOCOL_V2, compression_threshold=32)
+        self.assertFalse(frame[1] & V2_FLAG_COMPRESSED)
+
+    def test_compressed_frames_split_across_partial_reads(self):
+        messages = self.compressed_messages() + V2_MESSAGES
+        frames = [encode_frame(message, PROTOCOL_V2, compression_threshold=32, sequenced=True)
+                  for message in messages]
+        for chunk_size in (1, 3, 64, 4096):
+            self.assertEqual(decode_all(frames, chunk_size), messages)
+        sock = ChunkedSocket(chunk for frame in frames for chunk in (frame[:5], frame[5:]))
+        decoder = FrameDecoder(initial_size=16)
+        decoded = []
+        for _ in range(2 * len(frames)):
+            decoder.recv_into(sock)
+            decoded.extend(decoder.frames())
+        self.assertEqual(decoded, messages)
+
+    def test_corrupt_compressed_content_is_refused(self):
+        frame = bytearray(encode_frame(json_message(result=self.long_line), PROTOCOL_V2, compression_threshold=32))
+        frame[V2_HEADER.size:] = b"\xff" * (len(frame) - V2_HEADER.size)
+        with self.assertRaises(ValueError):
+            decode_frame(frame)
+
+
+if __name__ == '__main__':
+    unittest.main()
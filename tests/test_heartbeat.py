@@ -0,0 +1,78 @@
+import unittest
+from unittest import mock
+
+from network.connections import Connection
+from network.heartbeat import HeartbeatMonitor, HeartbeatSettings
+from network.timer_wheel import TimerWheel
+
+
+class HeartbeatMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('network.heartbeat.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pinged = []
+        self.closed = []
+        self.monitor = HeartbeatMonitor(HeartbeatSettings(ping_interval=15, pong_timeout=10, handshake_timeout=5),
+                                        self.pinged.append, self.closed.append,
+                                        TimerWheel(tick=0.5, clock=lambda: self.now))
+        self.connection = Connection(('127.0.0.1', 1234), 5)
+        self.monitor.watch(self.connection)
+
+    def advance(self, seconds):
+        self.now += seconds
+        self.monitor.wheel.advance()
+
+    def receive(self):
+        self.connection.heartbeat.last_received = self.now
+
+    def test_no_handshake_times_out(self):
+        self.advance(4)
+        self.assertEqual(self.closed, [])
+        self.advance(2)
+        self.assertEqual(self.closed, [self.connection])
+        self.assertEqual(self.monitor.timeouts['handshake'], 1)
+        self.assertIsNone(self.connection.heartbeat)
+
+    def test_old_client_is_left_to_keepalives_after_its_handshake(self):
+        self.monitor.handshake_done(self.connection)
+        self.advance(100)
+        self.assertEqual((self.pinged, self.closed), ([], []))
+        self.assertEqual(len(self.monitor.wheel), 0)
+
+    def test_quiet_client_is_pinged_and_closed_without_a_pong(self):
+        self.connection.answers_pings = True
+        self.monitor.handshake_done(self.connection)
+        self.advance(16)
+        self.assertEqual(self.pinged, [self.connection])
+        self.advance(11)
+        self.assertEqual(self.closed, [self.connection])
+        self.assertEqual(self.monitor.timeouts['pong'], 1)
+
+    def test_pong_keeps_the_connection_open(self):
+        self.connection.answers_pings = True
+        self.monitor.handshake_done(self.connection)
+        self.advance(16)
+        self.receive()
+        self.advance(11)
+        self.assertEqual(self.closed, [])
+        self.assertEqual(self.connection.heartbeat.ping_sent_time, None)
+
+    def test_busy_client_is_not_pinged(self):
+        self.connection.answers_pings = True
+        self.monitor.handshake_done(self.connection)
+        for _ in range(10):
+            self.advance(5)
+            self.receive()
+        self.assertEqual((self.pinged, self.closed), ([], []))
+
+    def test_forgotten_connection_is_never_closed(self):
+        self.monitor.forget(self.connection)
+        self.advance(100)
+        self.assertEqual(self.closed, [])
+        self.assertEqual(len(self.monitor.wheel), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import shutil
+import tempfile
+import unittest
+
+from network.message_log import MessageLog, history_frames
+
+
+class MessageLogReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def open_log(self, **kwargs):
+        history = MessageLog(self.directory, **kwargs)
+        self.addCleanup(history.close)
+        return history
+
+    def test_replay_returns_only_the_rooms_latest_frames(self):
+        history = self.open_log(segment_bytes=256)
+        for i in range(40):
+            history.append("busy", b"busy %d" % i, timestamp=i)
+            if i % 10 == 0:
+                history.append("quiet", b"quiet %d" % i, timestamp=i)
+        self.assertGreater(len(history.segments), 1)
+        self.assertEqual(history.replay("quiet", last=3), [b"quiet 10", b"quiet 20", b"quiet 30"])
+        self.assertEqual(history.replay("busy", last=2), [b"busy 38", b"busy 39"])
+        self.assertEqual(history.replay("busy", since=37), [b"busy 37", b"busy 38", b"busy 39"])
+        self.assertEqual(history.replay("nobody"), [])
+
+    def test_room_index_is_rebuilt_on_reopen(self):
+        history = self.open_log()
+        for i in range(5):
+            history.append("a" if i % 2 else "b", b"frame %d" % i)
+        history.close()
+        reopened = self.open_log()
+        self.assertEqual(reopened.replay("a"), [b"frame 1", b"frame 3"])
+        self.assertEqual(reopened.replay("b", last=1), [b"frame 4"])
+        reopened.append("a", b"frame 5")
+        self.assertEqual(reopened.replay("a"), [b"frame 1", b"frame 3", b"frame 5"])
+
+    def test_client_history_request_is_clamped(self):
+        history = self.open_log(replay_lines=3)
+        for i in range(10):
+            history.append("room", b"frame %d" % i, timestamp=i)
+        self.assertEqual(len(history_frames(history, "room", last=1000000)), 3)
+        self.assertEqual(len(history_frames(history, "room", last=10 ** 400)), 3)
+        self.assertEqual(history_frames(history, "room", last=-5), [])
+        self.assertEqual(history_frames(history, "room", last=1.5), [b"frame 9"])
+        for last in ("all", None, True, float("nan"), [5]):
+            self.assertEqual(len(history_frames(history, "room", last=last)), 3)
+        for since in ("yesterday", float("nan"), {"t": 0}):
+            self.assertEqual(len(history_frames(history, "room", since=since)), 3)
+        self.assertEqual(history_frames(history, "room", since=8), [b"frame 8", b"frame 9"])
+
+
+if __name__ == '__main__':
+    unittest.main()
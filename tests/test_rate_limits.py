@@ -0,0 +1,91 @@
+import unittest
+from unittest import mock
+
+from network.connections import Connection
+from network.rate_limits import RateLimits, TokenBucket, request_action, rate_limited_content, RATE_LIMITED_RESULT
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_refill_is_steady_and_capped_at_the_burst(self):
+        bucket = TokenBucket(rate=2.0, burst=4, now=0.0)
+        bucket.tokens = 0
+        bucket.refill(1.0)
+        self.assertEqual(bucket.tokens, 2.0)
+        bucket.refill(10.0)
+        self.assertEqual(bucket.tokens, 4)
+
+
+class RateLimitsTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('network.rate_limits.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connection = Connection(('127.0.0.1', 1234), 5)
+
+    def allowed(self, limits, action, times):
+        return sum(limits.allow(self.connection, action) for _ in range(times))
+
+    def test_action_limit_refills_over_time(self):
+        limits = RateLimits(connection_limit=(100.0, 100), action_limits={'send_message': (2.0, 3)})
+        self.assertEqual(self.allowed(limits, 'send_message', 10), 3)
+        self.assertEqual(limits.limited['send_message'], 7)
+        self.now += 1.0
+        self.assertEqual(self.allowed(limits, 'send_message', 10), 2)
+        # other actions only use the connection's bucket
+        self.assertEqual(self.allowed(limits, 'change_name', 10), 10)
+
+    def test_connection_limit_covers_every_action(self):
+        limits = RateLimits(connection_limit=(1.0, 4), action_limits={})
+        self.assertEqual(self.allowed(limits, 'join_room', 3) + self.allowed(limits, 'send_message', 3), 4)
+        self.assertEqual(limits.limited['other'], 2)
+
+    def test_refused_request_takes_no_token(self):
+        limits = RateLimits(connection_limit=(1.0, 5), action_limits={'send_message': (1.0, 1)})
+        self.assertEqual(self.allowed(limits, 'send_message', 5), 1)
+        self.assertEqual(self.allowed(limits, 'join_room', 5), 4)
+
+    def test_pongs_and_quits_are_never_limited(self):
+        limits = RateLimits(connection_limit=(1.0, 1), action_limits={})
+        self.assertEqual(self.allowed(limits, 'pong', 20) + self.allowed(limits, 'quit', 20), 40)
+
+    def test_error_policy_answers_once_per_burst(self):
+        limits = RateLimits(connection_limit=(1.0, 1), action_limits={}, policy='error')
+        limits.allow(self.connection, 'send_message')
+        answers = []
+        for _ in range(3):
+            self.assertFalse(limits.allow(self.connection, 'send_message'))
+            answers.append(limits.should_answer(self.connection))
+        self.assertEqual(answers, [True, False, False])
+        # a request getting through again means the next refusal is answered
+        self.now += 1.0
+        self.assertTrue(limits.allow(self.connection, 'send_message'))
+        self.assertFalse(limits.allow(self.connection, 'send_message'))
+        self.assertTrue(limits.should_answer(self.connection))
+
+    def test_drop_policy_never_answers(self):
+        limits = RateLimits(connection_limit=(1.0, 1), action_limits={}, policy='drop')
+        limits.allow(self.connection, 'send_message')
+        self.assertFalse(limits.allow(self.connection, 'send_message'))
+        self.assertFalse(limits.should_answer(self.connection))
+
+    def test_unknown_policy_is_refused(self):
+        with self.assertRaises(ValueError):
+            RateLimits(policy='ignore')
+
+
+class RequestActionTest(unittest.TestCase):
+    def test_action_a_request_is_limited_as(self):
+        self.assertEqual(request_action("text/json", {"action": "send_message"}), 'send_message')
+        self.assertEqual(request_action("text/json", {"action": ["send_message"]}), 'other')
+        self.assertEqual(request_action("binary/custom-client-binary-type", b"data"), 'binary')
+
+    def test_error_goes_to_the_room_the_message_was_for(self):
+        self.assertEqual(rate_limited_content("text/json", {"action": "send_message", "room": "dev"}),
+                         {'result': RATE_LIMITED_RESULT, 'room': 'dev'})
+        self.assertEqual(rate_limited_content("text/json", {"action": "send_message", "room": ["dev"]}),
+                         {'result': RATE_LIMITED_RESULT})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from network.send_queue import SendQueue
+
+
+class DropOldestTest(unittest.TestCase):
+    def test_only_droppable_frames_are_dropped(self):
+        queue = SendQueue()
+        queue.append(b"reply" * 10)
+        for i in range(5):
+            queue.append(b"broadcast %d" % i * 10, droppable=True)
+        queue.append(b"ping" * 10)
+        self.assertEqual(queue.drop_oldest(0), 5)
+        self.assertEqual(list(queue.frames), [b"reply" * 10, b"ping" * 10])
+        self.assertEqual(queue.pending_bytes, 90)
+
+    def test_oldest_broadcasts_go_first(self):
+        queue = SendQueue()
+        for i in range(4):
+            queue.append(b"%d" % i * 10, droppable=True)
+        self.assertEqual(queue.drop_oldest(20), 2)
+        self.assertEqual(list(queue.frames), [b"2" * 10, b"3" * 10])
+
+    def test_partially_sent_frame_is_kept(self):
+        queue = SendQueue()
+        for i in range(3):
+            queue.append(b"%d" % i * 10, droppable=True)
+        queue._consume(4)
+        self.assertEqual(queue.drop_oldest(0), 2)
+        self.assertEqual(list(queue.frames), [b"0" * 10])
+        self.assertEqual(queue.pending_bytes, 6)
+        queue._consume(6)
+        self.assertFalse(queue)
+        self.assertEqual(len(queue.droppable), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from network.connections import Connection, ConnectionRegistry
+from network.framing import PROTOCOL_V1, PROTOCOL_V2
+from network.rooms import RoomIndex
+from network.server_actions import create_json_response_content, negotiate_protocol
+
+
+class RoomActionTest(unittest.TestCase):
+    def setUp(self):
+        self.connections = ConnectionRegistry()
+        self.rooms = RoomIndex()
+        self.client = Connection(('127.0.0.1', 1234), 5)
+        self.connections.add(self.client)
+
+    def respond(self, **request):
+        return create_json_response_content(request, self.client, self.connections, self.rooms)
+
+    def test_invalid_room_names_get_an_error_reply(self):
+        for room in (["dev"], {"dev": 1}, 5, "", "x" * 65):
+            for request in (dict(action="send_message", value="hi", room=room),
+                            dict(action="join_room", value=room), dict(action="leave_room", value=room)):
+                room_to, content = self.respond(**request)
+                self.assertIsNone(room_to)
+                self.assertTrue(content['result'].startswith('Error: '), request)
+        self.assertEqual(len(self.rooms), 0)
+
+    def test_join_send_and_leave(self):
+        self.assertEqual(self.respond(action="join_room", value="dev")[0], "dev")
+        self.assertEqual(self.respond(action="send_message", value="hi", room="dev")[0], "dev")
+        self.assertEqual(self.respond(action="leave_room", value="dev")[0], "dev")
+        room_to, content = self.respond(action="send_message", value="hi", room="dev")
+        self.assertIsNone(room_to)
+        self.assertEqual(content['result'], 'Error: you are not in this room.')
+
+
+class NegotiateProtocolTest(unittest.TestCase):
+    def negotiate(self, **request):
+        client = Connection(('127.0.0.1', 1234), 5)
+        return negotiate_protocol(dict(action="on_connection", **request), client, compression_threshold=256), client
+
+    def test_newest_version_and_compression_are_agreed(self):
+        reply, client = self.negotiate(protocols=[PROTOCOL_V1, PROTOCOL_V2, 99], compression=["deflate"])
+        self.assertEqual(reply, {'protocol': PROTOCOL_V2, 'compression': 'deflate'})
+        self.assertEqual(client.frame_format, (PROTOCOL_V2, 256, False))
+
+    def test_malformed_offers_leave_the_client_on_version_1(self):
+        for protocols in (5, "2", {"2": 2}, True):
+            reply, client = self.negotiate(protocols=protocols, compression=["deflate"])
+            self.assertIsNone(reply)
+            self.assertEqual(client.frame_format, (PROTOCOL_V1, None, False))
+
+    def test_malformed_compression_offer_is_ignored(self):
+        for compression in (5, "deflate", {"deflate": 1}, None):
+            reply, client = self.negotiate(protocols=[PROTOCOL_V2], compression=compression)
+            self.assertEqual(reply, {'protocol': PROTOCOL_V2})
+            self.assertIsNone(client.compression_threshold)
+
+
+if __name__ == '__main__':
+    unittest.main()
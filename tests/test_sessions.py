@@ -0,0 +1,97 @@
+import unittest
+from unittest import mock
+
+from network.connections import Connection
+from network.sessions import ReplayBuffer, SessionStore
+
+
+def chat_message(text):
+    return dict(type="text/json", encoding="utf-8", content={"result": text})
+
+
+class ReplayBufferTest(unittest.TestCase):
+    def test_oldest_messages_are_trimmed(self):
+        buffer = ReplayBuffer(first_sequence=10, size=3)
+        for text in "abcde":
+            buffer.append(text)
+        self.assertEqual(buffer.sequence, 15)
+        self.assertEqual(list(buffer.messages), [(13, "c"), (14, "d"), (15, "e")])
+        self.assertEqual(buffer.since(13), (["d", "e"], True))
+        self.assertEqual(buffer.since(12), (["c", "d", "e"], True))
+        # 11 and 12 are gone, so a client that last saw 11 is told its replay is incomplete
+        self.assertEqual(buffer.since(11), (["c", "d", "e"], False))
+
+
+class SessionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('network.sessions.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sessions = SessionStore(replay_messages=2, resume_timeout=60, replay_rooms=2)
+
+    def connect(self, port, name='guest'):
+        connection = Connection(('127.0.0.1', port), port)
+        connection.name = name
+        return connection
+
+    def test_broadcasts_are_numbered_and_trimmed_per_room(self):
+        messages = [chat_message(text) for text in "abc"]
+        for message in messages:
+            self.sessions.sequence("lobby", message)
+        self.assertEqual([message["content"]["seq"] for message in messages], [1, 2, 3])
+        self.assertEqual(self.sessions.missed("lobby", 1), (messages[1:], True))
+        self.assertEqual(self.sessions.missed("lobby", 0), (messages[1:], False))
+        # a new room starts counting from the highest number given out, so numbers never go backwards
+        other = chat_message("d")
+        self.sessions.sequence("dev", other)
+        self.assertEqual(other["content"]["seq"], 4)
+
+    def test_evicted_room_reports_an_incomplete_replay(self):
+        for room in ("a", "b", "c"):
+            self.sessions.sequence(room, chat_message(room))
+        self.assertEqual(self.sessions.missed("a", 0), ([], False))
+        self.assertEqual(self.sessions.missed("never", 3), ([], True))
+
+    def test_resume_within_the_timeout(self):
+        first = self.connect(1, 'alice')
+        token = self.sessions.create(first)
+        first.name = 'alice2'
+        self.sessions.detach(first, {"lobby", "dev"})
+        self.now += 59
+        second = self.connect(2)
+        session, previous = self.sessions.resume(token, second)
+        self.assertIsNone(previous)
+        self.assertEqual((session.name, session.rooms), ('alice2', {"lobby", "dev"}))
+        self.assertIs(second.session, session)
+        self.assertEqual(self.sessions.resumed, 1)
+
+    def test_token_expires_after_the_timeout(self):
+        first = self.connect(1)
+        token = self.sessions.create(first)
+        self.sessions.detach(first, set())
+        self.now += 61
+        self.assertEqual(self.sessions.resume(token, self.connect(2)), (None, None))
+        self.assertEqual((len(self.sessions), self.sessions.expired), (0, 1))
+
+    def test_connected_session_never_expires(self):
+        connection = self.connect(1)
+        token = self.sessions.create(connection)
+        self.now += 3600
+        self.sessions.expire()
+        self.assertEqual(len(self.sessions), 1)
+        # the client reconnected before its old connection was noticed closing, which is handed back to be closed
+        session, previous = self.sessions.resume(token, self.connect(2))
+        self.assertIs(previous, connection)
+        self.assertIsNone(connection.session)
+
+    def test_unknown_and_ended_tokens_are_refused(self):
+        connection = self.connect(1)
+        token = self.sessions.create(connection)
+        self.sessions.end(connection)
+        for bad_token in (token, 'nope', None, ['x']):
+            self.assertEqual(self.sessions.resume(bad_token, self.connect(2)), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+from network.timer_wheel import TimerWheel
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(tick=0.5, num_slots=8, clock=self.clock)
+        self.fired = []
+
+    def advance_to(self, now):
+        self.clock.now = now
+        return self.wheel.advance()
+
+    def test_timer_fires_once_due_and_not_before(self):
+        self.wheel.schedule(2.0, self.fired.append, 'a')
+        self.assertEqual(self.advance_to(1001.9), 0)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(self.advance_to(1002.5), 1)
+        self.assertEqual(self.fired, ['a'])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.advance_to(1010.0), 0)
+
+    def test_timer_more_than_a_turn_away_waits_its_rounds(self):
+        # 8 slots of half a second make a 4 second turn
+        self.wheel.schedule(9.0, self.fired.append, 'late')
+        self.advance_to(1004.6)
+        self.advance_to(1008.6)
+        self.assertEqual(self.fired, [])
+        self.advance_to(1009.6)
+        self.assertEqual(self.fired, ['late'])
+
+    def test_cancelled_timer_never_fires(self):
+        timer = self.wheel.schedule(1.0, self.fired.append, 'cancelled')
+        self.wheel.schedule(1.0, self.fired.append, 'kept')
+        timer.cancel()
+        timer.cancel()
+        self.assertFalse(timer.active)
+        self.assertEqual(len(self.wheel), 1)
+        self.advance_to(1002.0)
+        self.assertEqual(self.fired, ['kept'])
+
+    def test_time_until_next_tick(self):
+        self.assertIsNone(self.wheel.time_until_next_tick())
+        self.wheel.schedule(1.0, self.fired.append, 'a')
+        self.clock.now = 1000.2
+        self.assertAlmostEqual(self.wheel.time_until_next_tick(), 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()